@@ -0,0 +1,189 @@
+#!/usr/bin/python3
+
+''' Linux only.  Requires PySerial. '''
+
+import os
+import sys
+import getopt
+import asyncio
+import zmq
+import zmq.asyncio
+
+# The serial transport and KISS codec are shared with the UDP demos
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'old'))
+
+import kiss
+import serial_transport
+
+# Status byte flags (see ../PROTOCOL.md)
+FLAG_MORE = 0x01
+
+class Config():
+	''' Configuration for ZMQ/UART bridge '''
+	# Serial device, or None to loop messages back (as ../c++/bin/bridge does)
+	device = None
+	baud = 9600
+	# Where services receive messages from (the bridge publishes), and send
+	# messages to (the bridge subscribes)
+	rx_url = 'ipc:///var/tmp/serial_bridge_rx'
+	tx_url = 'ipc:///var/tmp/serial_bridge_tx'
+	verbose = False
+
+class SerialSide(serial_transport.KissProtocol):
+	''' Frames from the serial link, passed to the bridge '''
+	def __init__(self, bridge):
+		super(SerialSide, self).__init__()
+		self.bridge = bridge
+
+	def packet_received(self, packet):
+		self.bridge.uart_packet(packet)
+
+class Loopback():
+	''' Stands in for the serial link when there is no device: frames sent are encoded, and decoded as if received '''
+	def __init__(self, bridge):
+		self.bridge = bridge
+		self.encoder = kiss.Encoder()
+		self.decoder = kiss.Decoder()
+		# Never closes
+		self.closed = asyncio.get_running_loop().create_future()
+
+	def send_packet(self, packet):
+		for frame in self.decoder.apply(self.encoder.apply(packet)):
+			self.bridge.uart_packet(bytes(frame))
+
+	async def drain(self):
+		pass
+
+class Bridge():
+	'''
+	Python counterpart of ../c++/bin/bridge, on an asyncio event loop.
+
+	Each part of a message received from services is sent over the serial
+	link as a KISS frame, prefixed with a status byte (see ../PROTOCOL.md),
+	and the parts of messages received over the serial link are published
+	to services.
+
+	The bridge may share its ZeroMQ context and event loop with services
+	in the same process (see Launcher.py), which then connect to it over
+	inproc:// endpoints.
+	'''
+
+	uart = None
+
+	def __init__(self, ctx, config):
+		self.config = config
+		self.pub = ctx.socket(zmq.PUB)
+		self.sub = ctx.socket(zmq.SUB)
+		self.pub.setsockopt(zmq.LINGER, 0)
+		self.sub.setsockopt(zmq.LINGER, 0)
+		# Bound now, so that services in the same process can connect to inproc:// endpoints straight away
+		self.pub.bind(config.rx_url)
+		self.sub.bind(config.tx_url)
+		self.sub.setsockopt(zmq.SUBSCRIBE, b'')
+		# Parts received so far of a message from the serial link
+		self.parts = []
+
+	async def run(self):
+		''' Relay until the serial link is closed '''
+		config = self.config
+		transport = None
+		if config.device is None:
+			self.uart = Loopback(self)
+		else:
+			transport, self.uart = await serial_transport.create_serial_connection(asyncio.get_running_loop(), lambda: SerialSide(self), config.device, config.baud)
+		forward = asyncio.ensure_future(self.forward())
+		try:
+			await asyncio.wait([forward, self.uart.closed], return_when=asyncio.FIRST_COMPLETED)
+			if forward.done():
+				forward.result()
+			elif self.uart.closed.result() is not None:
+				print('Serial link failed: ' + str(self.uart.closed.result()))
+		finally:
+			forward.cancel()
+			if transport is not None:
+				transport.abort()
+			self.pub.close()
+			self.sub.close()
+
+	async def forward(self):
+		''' Send messages from services over the serial link '''
+		while True:
+			msg = await self.sub.recv_multipart()
+			for index, part in enumerate(msg):
+				self.uart.send_packet(bytes([FLAG_MORE if index < len(msg) - 1 else 0]) + part)
+			if self.config.verbose:
+				print('Received ' + str(len(msg)) + ' part(s) via ZMQ')
+			await self.uart.drain()
+
+	def uart_packet(self, packet):
+		if not packet:
+			return
+		self.parts.append(packet[1:])
+		if packet[0] & FLAG_MORE:
+			return
+		parts = self.parts
+		self.parts = []
+		# Publishing does not block (messages beyond the high watermark are dropped)
+		self.pub.send_multipart(parts)
+		if self.config.verbose:
+			print('Sent ' + str(len(parts)) + ' part(s) via ZMQ')
+
+#################### DEMO / CLI STUFF COMES BELOW ####################
+
+class Program():
+	''' Wrapper to allow bridge to be invoked from command-line '''
+	def __init__(self, cmdline):
+		config = Config()
+		try:
+			opts, args = getopt.getopt(cmdline, '', ['device=', 'baud=', 'rx_url=', 'tx_url=', 'verbose', 'help'])
+
+			for opt, val in opts:
+				if opt in ('--device'):
+					config.device = val
+				elif opt in ('--baud'):
+					config.baud = int(val)
+				elif opt in ('--rx_url'):
+					config.rx_url = val
+				elif opt in ('--tx_url'):
+					config.tx_url = val
+				elif opt in ('--verbose'):
+					config.verbose = True
+				elif opt in ('--help'):
+					self.usage(config)
+					sys.exit(0)
+				else:
+					raise AssertionError('Unhandled option: ' + opt)
+			if args:
+				raise AssertionError('Unexpected trailing arguments')
+		except (getopt.GetoptError, ValueError, AssertionError) as err:
+			print(err)
+			self.usage(config)
+			sys.exit(1)
+		self.config = config
+
+	async def run(self):
+		ctx = zmq.asyncio.Context()
+		try:
+			await Bridge(ctx, self.config).run()
+		finally:
+			ctx.term()
+
+	def usage(self, config):
+		print('ZMQ/UART bridge, as ../c++/bin/bridge')
+		print('')
+		print('Syntax:')
+		print('')
+		print('  ./Bridge.py')
+		print('                  --device=' + str(config.device) + ' --baud=' + str(config.baud))
+		print('                  --rx_url=' + config.rx_url)
+		print('                  --tx_url=' + config.tx_url)
+		print('                  --verbose')
+		print('')
+		print('  If no device is specified then the bridge will operate in loopback mode')
+		print('')
+
+if __name__ == '__main__':
+	try:
+		asyncio.run(Program(sys.argv[1:]).run())
+	except KeyboardInterrupt:
+		pass
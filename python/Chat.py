@@ -1,13 +1,24 @@
 #!/usr/bin/python3
 
 import asyncio
+import os
 import sys
+import copy
+import time
+import struct
 import getopt
 import signal
+import contextlib
 import aioconsole
 import zmq.asyncio
 
 from Protocol import Socket, InvalidMessageError, OperationFailedError, ReceiveTimeoutError
+from Outbox import Outbox, OutboxFullError
+
+# Percentiles are computed as by the UDP demos
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'old'))
+
+from stats import percentile
 
 class Config():
 	rx_url = 'ipc:///var/tmp/serial_bridge_rx'
@@ -16,6 +27,151 @@ class Config():
 	hostname = 'chat'
 	session = 'test'
 	timeout = 0.2
+	# Load test: number of virtual clients (None for interactive chat),
+	# messages per second per client, message size in bytes, duration in
+	# seconds, and how long to wait for the last replies
+	clients = None
+	rate = 10.0
+	size = 64
+	duration = 10.0
+	drain = 2.0
+	# Echo messages back to their senders instead of chatting
+	echo = False
+	# Directory to keep undelivered messages in (see Outbox), and its size limit
+	outbox = None
+	outbox_bytes = 0x1000000
+
+# Header of load test messages: magic, client index, sequence number and
+# send time (monotonic nanoseconds)
+load_header = struct.Struct('>4sIIQ')
+load_magic = b'LOAD'
+
+class LoadClient():
+	''' A virtual chat client of a load test '''
+	sent = 0
+	invalid = 0
+	done = False
+
+	def __init__(self, index, config, socket):
+		self.index = index
+		self.config = config
+		self.socket = socket
+		self.received = set()
+		self.latencies = []
+
+class LoadTest():
+	'''
+	Capacity test of the bridge: virtual chat clients, each with its own
+	hostname and session, send messages to the remote, which is expected to
+	echo them back (see Echo).
+
+	Messages carry the client index, a sequence number and the send time,
+	so each client measures the round-trip latency of its messages, and
+	which are lost (not echoed within drain seconds of the end of the test).
+	'''
+
+	# Time for subscriptions to reach the bridge before sending
+	warmup = 0.5
+
+	def __init__(self, ctx, config):
+		self.ctx = ctx
+		self.config = config
+
+	def client_config(self, index):
+		config = copy.copy(self.config)
+		config.hostname = self.config.hostname + '-' + str(index)
+		config.session = self.config.session + '-' + str(index)
+		return config
+
+	async def run(self):
+		''' Run the test, returns a report '''
+		config = self.config
+		with contextlib.ExitStack() as stack:
+			clients = []
+			for index in range(config.clients):
+				client_config = self.client_config(index)
+				clients.append(LoadClient(index, client_config, stack.enter_context(Socket(self.ctx, client_config))))
+			await asyncio.sleep(self.warmup)
+			loop = asyncio.get_event_loop()
+			start = loop.time()
+			end = start + config.duration
+			await asyncio.gather(*([self._sender(client, start, end) for client in clients] + [self._receiver(client, end + config.drain) for client in clients]))
+		return self.report(clients, config.duration)
+
+	async def _sender(self, client, start, end):
+		loop = asyncio.get_event_loop()
+		envelope = Socket.Envelope(self.config.remote, client.config.session, 'message')
+		padding = bytes(max(0, self.config.size - load_header.size))
+		interval = 1.0 / self.config.rate
+		# Spread the clients' messages over each interval
+		next = start + interval * client.index / self.config.clients
+		while next < end:
+			await asyncio.sleep(max(0, next - loop.time()))
+			payload = load_header.pack(load_magic, client.index, client.sent, time.monotonic_ns()) + padding
+			await client.socket.send(envelope, payload)
+			client.sent += 1
+			next += interval
+		client.done = True
+
+	async def _receiver(self, client, end):
+		loop = asyncio.get_event_loop()
+		while loop.time() < end and not (client.done and len(client.received) == client.sent):
+			try:
+				envelope, parts = await client.socket.recv(timeout=min(0.5, max(0.001, end - loop.time())))
+			except (ReceiveTimeoutError, InvalidMessageError):
+				continue
+			received = time.monotonic_ns()
+			if envelope is None or len(parts[0]) < load_header.size:
+				client.invalid += 1
+				continue
+			magic, index, seq, sent = load_header.unpack_from(parts[0])
+			if magic != load_magic or index != client.index or seq >= client.sent:
+				client.invalid += 1
+				continue
+			if seq in client.received:
+				continue
+			client.received.add(seq)
+			client.latencies.append((received - sent) / 1e6)
+
+	def report(self, clients, duration):
+		sent = sum(client.sent for client in clients)
+		delivered = sum(len(client.received) for client in clients)
+		latencies = sorted(latency for client in clients for latency in client.latencies)
+		return {
+			'clients': len(clients),
+			'duration': duration,
+			'sent': sent,
+			'delivered': delivered,
+			'invalid': sum(client.invalid for client in clients),
+			'loss': 1 - delivered / sent if sent else 0,
+			'sent_rate': sent / duration,
+			'delivered_rate': delivered / duration,
+			'latency_ms': {
+				'p50': percentile(latencies, 50),
+				'p95': percentile(latencies, 95),
+				'p99': percentile(latencies, 99),
+				'max': latencies[-1] if latencies else None
+			}
+		}
+
+class Echo():
+	''' Responder for load tests, sending each message received back to its sender '''
+	echoed = 0
+
+	def __init__(self, socket):
+		self.socket = socket
+
+	async def step(self, timeout):
+		''' Echo the next message, returns False if none arrived within the timeout '''
+		try:
+			envelope, parts = await self.socket.recv(timeout=timeout)
+		except (ReceiveTimeoutError, InvalidMessageError):
+			return False
+		if envelope is None:
+			return False
+		await self.socket.send(Socket.Envelope(envelope.remote, envelope.session, envelope.command), *parts)
+		self.echoed += 1
+		return True
 
 #################### DEMO / CLI STUFF COMES BELOW ####################
 
@@ -28,7 +184,7 @@ class Program():
 		# Extract configuration from command line arguments
 		config = Config()
 		try:
-			opts, args = getopt.getopt(cmdline, '', ['tx_url=', 'rx_url=', 'remote=', 'topic=', 'hostname='])
+			opts, args = getopt.getopt(cmdline, '', ['tx_url=', 'rx_url=', 'remote=', 'topic=', 'session=', 'hostname=', 'load=', 'rate=', 'size=', 'duration=', 'drain=', 'echo', 'outbox=', 'outbox_bytes='])
 
 			for opt, val in opts:
 				if opt in ('--tx_url'):
@@ -41,24 +197,75 @@ class Program():
 					config.session = val
 				elif opt in ('--hostname'):
 					config.hostname = val
+				elif opt in ('--load'):
+					config.clients = int(val)
+				elif opt in ('--rate'):
+					config.rate = float(val)
+				elif opt in ('--size'):
+					config.size = int(val)
+				elif opt in ('--duration'):
+					config.duration = float(val)
+				elif opt in ('--drain'):
+					config.drain = float(val)
+				elif opt in ('--echo'):
+					config.echo = True
+				elif opt in ('--outbox'):
+					config.outbox = val
+				elif opt in ('--outbox_bytes'):
+					config.outbox_bytes = int(val, 0)
 				else:
 					raise AssertionError('Unhandled option: ' + opt)
 			if None in (config.tx_url, config.rx_url, config.remote, config.session, config.hostname):
 				raise AssertionError('Required parameter missing')
 			if args:
 				raise AssertionError('Unexpected trailing arguments')
-		except (getopt.GetoptError, ValueError) as err:
+			if config.clients is not None and (config.clients <= 0 or config.rate <= 0):
+				raise AssertionError('Number of clients and rate must be positive')
+		except (getopt.GetoptError, ValueError, AssertionError) as err:
 			print(err)
-			self.usage()
+			self.usage(config)
 			sys.exit(1)
 		self.config = config
 
 	async def run(self):
 		ctx = zmq.asyncio.Context(4)
+		if self.config.clients is not None:
+			self.print_report(await LoadTest(ctx, self.config).run())
+			return
 		signal.signal(signal.SIGINT, self._stop)
-		with Socket(ctx, self.config) as socket:
+		outbox = None
+		if self.config.outbox is not None:
+			outbox = Outbox(self.config.outbox, self.config.outbox_bytes)
+		with Socket(ctx, self.config, outbox) as socket:
+			if self.config.echo:
+				await self._echo(socket)
+				return
 			await asyncio.wait([fn(socket) for fn in [self._receiver, self._sender]])
 
+	def print_report(self, report):
+		latency = report['latency_ms']
+		print('Clients:    ' + str(report['clients']) + ', for ' + str(report['duration']) + 's')
+		print('Sent:       ' + str(report['sent']) + ' (' + '%.1f' % report['sent_rate'] + ' msgs/s)')
+		print('Delivered:  ' + str(report['delivered']) + ' (' + '%.1f' % report['delivered_rate'] + ' msgs/s)')
+		print('Loss:       ' + '%.2f' % (report['loss'] * 100) + '%' + (' (' + str(report['invalid']) + ' invalid messages)' if report['invalid'] else ''))
+		if latency['p50'] is not None:
+			print('Latency:    p50 ' + '%.2f' % latency['p50'] + 'ms, p95 ' + '%.2f' % latency['p95'] + 'ms, p99 ' + '%.2f' % latency['p99'] + 'ms, max ' + '%.2f' % latency['max'] + 'ms')
+
+	async def _echo(self, socket):
+		echo = Echo(socket)
+		reported = 0
+		next_report = time.time() + 5
+		try:
+			while not self.exit:
+				await echo.step(0.5)
+				if time.time() >= next_report:
+					next_report = time.time() + 5
+					if echo.echoed != reported:
+						print('(Echoed ' + str(echo.echoed) + ' messages)')
+						reported = echo.echoed
+		except (KeyboardInterrupt, SystemExit):
+			self._stop()
+
 	def _stop(self, *args, **kwargs):
 		self.exit = True
 		sys.exit(0)
@@ -111,7 +318,11 @@ class Program():
 			# Unset flag which is used to notify that a message has been received
 			self.next = False
 			# Send request
-			await socket.send(envelope, bytes(msg, 'utf-8'))
+			try:
+				await socket.send(envelope, bytes(msg, 'utf-8'))
+			except OutboxFullError as err:
+				print('(' + err.message + ', message not sent)')
+				return True
 			# Wait up to 1s for reply, so terminal doesn't get cluttered as easily
 			for i in range(0, 10):
 				if self.next:
@@ -125,7 +336,7 @@ class Program():
 			return False
 		return True
 
-	def usage(self):
+	def usage(self, config):
 		print('Utility for sending messages over ZMQ.')
 		print('')
 		print('Intended to be used with the ZMQ/UART bridge.')
@@ -133,11 +344,19 @@ class Program():
 		print('Syntax:')
 		print('')
 		print('  ./Chat.py')
-		print('                  --tx_host=' + config.tx_host + ' --tx_port=' + int(config.tx_port))
-		print('                  --rx_host=' + config.rx_host + ' --rx_port=' + int(config.rx_port))
+		print('  ./Chat.py --echo')
+		print('  ./Chat.py --load=<clients>')
+		print('                  --tx_url=' + config.tx_url)
+		print('                  --rx_url=' + config.rx_url)
 		print('                  --remote=' + config.remote)
 		print('                  --hostname=' + config.hostname)
 		print('                  --session=' + config.session)
+		print('                  --rate=' + str(config.rate) + ' --size=' + str(config.size))
+		print('                  --duration=' + str(config.duration) + ' --drain=' + str(config.drain))
+		print('                  --outbox=' + str(config.outbox) + ' --outbox_bytes=' + hex(config.outbox_bytes))
+		print('')
+		print('    --outbox=[value]         Directory to keep messages in until delivered, to remotes which also')
+		print('                             run with --outbox (others are sent messages as they are, see ../PROTOCOL.md)')
 		print('')
 
 if __name__ == '__main__':
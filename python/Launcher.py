@@ -0,0 +1,175 @@
+#!/usr/bin/python3
+
+''' Linux only.  Requires PySerial. '''
+
+import sys
+import copy
+import getopt
+import asyncio
+import resource
+import zmq.asyncio
+
+import Chat
+from Bridge import Bridge
+from Protocol import Socket
+
+class Config(Chat.Config):
+	''' Configuration for running a bridge and services in one process '''
+	# Serial device of the bridge, or None for loopback
+	device = None
+	baud = 9600
+	# Endpoints between the bridge and services
+	rx_url = 'inproc://serial_bridge_rx'
+	tx_url = 'inproc://serial_bridge_tx'
+	# Hostnames of echo responders to run (see Chat.py --echo)
+	echoes = ()
+	verbose = False
+
+class Launcher():
+	'''
+	Runs a bridge and services in one process, on one event loop, sharing
+	one ZeroMQ context.  Services connect to the bridge over inproc://
+	endpoints, so messages are passed between them in memory, rather than
+	through the kernel with a context switch for each hop as between
+	processes over ipc://.
+
+	Services are configured as when run on their own (see Chat.Config),
+	with the launcher's endpoints in place of the bridge's.
+	'''
+
+	def __init__(self, config):
+		self.config = config
+		self.ctx = zmq.asyncio.Context()
+
+	def service_config(self, **kwargs):
+		''' Configuration for a service, connecting to the bridge in this process '''
+		config = copy.copy(self.config)
+		for key, value in kwargs.items():
+			setattr(config, key, value)
+		return config
+
+	async def echo(self, config):
+		''' Echo responder (see Chat.py --echo) '''
+		with Socket(self.ctx, config) as socket:
+			echo = Chat.Echo(socket)
+			while True:
+				await echo.step(None)
+
+	async def run(self, services):
+		'''
+		Run the bridge and the given services (coroutines), until the services
+		finish.  If the bridge or an echo responder stops (e.g. the serial
+		device cannot be opened), the services are cancelled and its error is
+		raised.
+		'''
+		# The bridge binds the endpoints before any service connects
+		bridge = Bridge(self.ctx, self.config)
+		tasks = [asyncio.ensure_future(bridge.run())]
+		services = [asyncio.ensure_future(service) for service in services]
+		try:
+			tasks += [asyncio.ensure_future(self.echo(self.service_config(hostname=hostname))) for hostname in self.config.echoes]
+			pending = set(services)
+			while pending:
+				done, _ = await asyncio.wait(pending | set(tasks), return_when=asyncio.FIRST_COMPLETED)
+				for task in done:
+					# Raises the error of a failed service or task
+					task.result()
+					if task in tasks:
+						raise RuntimeError('Bridge stopped' if task is tasks[0] else 'Echo responder stopped')
+				pending -= done
+			return [service.result() for service in services]
+		finally:
+			for task in tasks + services:
+				task.cancel()
+			await asyncio.gather(*tasks, *services, return_exceptions=True)
+			self.ctx.destroy(linger=0)
+
+#################### DEMO / CLI STUFF COMES BELOW ####################
+
+class Program(Chat.Program):
+	''' Wrapper to allow the launcher to be invoked from command-line '''
+	def __init__(self, cmdline):
+		config = Config()
+		try:
+			opts, args = getopt.getopt(cmdline, '', ['device=', 'baud=', 'echo=', 'load=', 'rate=', 'size=', 'duration=', 'drain=', 'remote=', 'hostname=', 'session=', 'verbose', 'help'])
+
+			echoes = []
+			for opt, val in opts:
+				if opt in ('--device'):
+					config.device = val
+				elif opt in ('--baud'):
+					config.baud = int(val)
+				elif opt in ('--echo'):
+					echoes.append(val)
+				elif opt in ('--load'):
+					config.clients = int(val)
+				elif opt in ('--rate'):
+					config.rate = float(val)
+				elif opt in ('--size'):
+					config.size = int(val)
+				elif opt in ('--duration'):
+					config.duration = float(val)
+				elif opt in ('--drain'):
+					config.drain = float(val)
+				elif opt in ('--remote'):
+					config.remote = val
+				elif opt in ('--hostname'):
+					config.hostname = val
+				elif opt in ('--session'):
+					config.session = val
+				elif opt in ('--verbose'):
+					config.verbose = True
+				elif opt in ('--help'):
+					self.usage(config)
+					sys.exit(0)
+				else:
+					raise AssertionError('Unhandled option: ' + opt)
+			config.echoes = tuple(echoes)
+			if args:
+				raise AssertionError('Unexpected trailing arguments')
+			if config.clients is not None and (config.clients <= 0 or config.rate <= 0):
+				raise AssertionError('Number of clients and rate must be positive')
+		except (getopt.GetoptError, ValueError, AssertionError) as err:
+			print(err)
+			self.usage(config)
+			sys.exit(1)
+		self.config = config
+
+	async def run(self):
+		launcher = Launcher(self.config)
+		if self.config.clients is None:
+			# Serve until interrupted
+			await launcher.run([asyncio.get_running_loop().create_future()])
+			return
+		start = resource.getrusage(resource.RUSAGE_SELF)
+		report, = await launcher.run([Chat.LoadTest(launcher.ctx, launcher.service_config()).run()])
+		end = resource.getrusage(resource.RUSAGE_SELF)
+		self.print_report(report)
+		print('CPU:        ' + '%.2f' % (end.ru_utime + end.ru_stime - start.ru_utime - start.ru_stime) + 's, ' + str(end.ru_nvcsw + end.ru_nivcsw - start.ru_nvcsw - start.ru_nivcsw) + ' context switches')
+
+	def usage(self, config):
+		print('Runs a ZMQ/UART bridge and services in one process, connected over inproc://')
+		print('')
+		print('Syntax:')
+		print('')
+		print('  ./Launcher.py --echo=chat')
+		print('  ./Launcher.py --echo=chat --load=<clients>')
+		print('                  --device=' + str(config.device) + ' --baud=' + str(config.baud))
+		print('                  --echo=<hostname> ...')
+		print('                  --remote=' + config.remote)
+		print('                  --hostname=' + config.hostname)
+		print('                  --session=' + config.session)
+		print('                  --rate=' + str(config.rate) + ' --size=' + str(config.size))
+		print('                  --duration=' + str(config.duration) + ' --drain=' + str(config.drain))
+		print('                  --verbose')
+		print('')
+		print('    --device=[value]         Serial device of the bridge, loopback if omitted')
+		print('    --echo=[value]           Run an echo responder with this hostname (may be repeated)')
+		print('    --load=[value]           Run a load test (see Chat.py --load) with this many clients, and exit')
+		print('')
+
+if __name__ == '__main__':
+	try:
+		asyncio.run(Program(sys.argv[1:]).run())
+	except KeyboardInterrupt:
+		pass
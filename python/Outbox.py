@@ -0,0 +1,328 @@
+import os
+import json
+import mmap
+import zlib
+import struct
+import collections
+
+# Record header: body length, CRC-32 of body, sequence number
+record_header = struct.Struct('>IIQ')
+# Body: number of parts, then each part prefixed with its length
+part_count = struct.Struct('>H')
+part_length = struct.Struct('>I')
+
+class OutboxFullError(RuntimeError):
+	def __init__(self, msg):
+		self.message = msg
+
+def encode_record(seq, parts):
+	body = bytearray(part_count.pack(len(parts)))
+	for part in parts:
+		body += part_length.pack(len(part))
+		body += part
+	return record_header.pack(len(body), zlib.crc32(body), seq) + body
+
+def sync_fd(fd):
+	''' Sync a file descriptor (as returned by Outbox.unsynced) to disk, and close it '''
+	try:
+		os.fdatasync(fd)
+	finally:
+		os.close(fd)
+
+def decode_body(body):
+	count, = part_count.unpack_from(body, 0)
+	offset = part_count.size
+	parts = []
+	for i in range(count):
+		length, = part_length.unpack_from(body, offset)
+		offset += part_length.size
+		parts.append(bytes(body[offset:offset + length]))
+		offset += length
+	return parts
+
+def read_records(buf):
+	'''
+	Walk the records of a segment (e.g. an mmap of it), yielding (seq,
+	offset, length) of each record.  Stops at the first torn or corrupt
+	record, after which the segment's end may be found from the last
+	offset and length.
+	'''
+	offset = 0
+	while offset + record_header.size <= len(buf):
+		length, crc, seq = record_header.unpack_from(buf, offset)
+		end = offset + record_header.size + length
+		if end > len(buf) or zlib.crc32(buf[offset + record_header.size:end]) != crc:
+			return
+		yield (seq, offset, end - offset)
+		offset = end
+
+class Outbox():
+	'''
+	Messages waiting to be delivered, kept on disk so that they survive
+	restarts.
+
+	Messages are appended to a log of segment files (<path>/<first
+	sequence number in hex>.log), each a sequence of records with a
+	fixed-size header, so that a segment can be read by mapping it and
+	walking the records (see read_records).  Sequence numbers of delivered
+	messages are recorded in <path>/acked: once all messages of a segment
+	are delivered it is deleted, and when delivered messages take more
+	space than the rest, the log is compacted by rewriting the
+	undelivered messages to a new segment.
+
+	The log is bounded to max_bytes, beyond which appending fails.
+
+	Appending does not wait for the message to reach the disk: the caller
+	syncs the descriptor returned by unsynced(), which may be done on
+	another thread (see sync_fd).
+
+	Remotes which answered a ping (see Protocol.Socket) are recorded as
+	peers in <path>/acked too, so messages to them are kept in the outbox
+	after a restart, before they answer again.
+	'''
+
+	def __init__(self, path, max_bytes=0x1000000, segment_bytes=0x100000, sync=True):
+		self.path = path
+		self.max_bytes = max_bytes
+		self.segment_bytes = segment_bytes
+		self.sync = sync
+		# Undelivered messages: seq => (remote, segment, offset, length)
+		self.index = collections.OrderedDict()
+		# Sequence numbers of undelivered messages to each remote, in order
+		self.by_remote = dict()
+		self.peers = set()
+		# Segment paths => size, in log order
+		self.segments = collections.OrderedDict()
+		# All messages up to acked are delivered, as are those in delivered
+		self.acked = 0
+		self.delivered = set()
+		self.next_seq = 1
+		self.size = 0
+		self.file = None
+		self.dirty = False
+		os.makedirs(path, exist_ok=True)
+		self.load()
+
+	def _segment_path(self, seq):
+		return os.path.join(self.path, '%016x.log' % seq)
+
+	def load(self):
+		try:
+			with open(os.path.join(self.path, 'acked'), 'r') as file:
+				state = json.load(file)
+				self.acked = state['acked']
+				self.delivered = set(state['delivered'])
+				self.peers = set(bytes.fromhex(peer) for peer in state.get('peers', ()))
+		except FileNotFoundError:
+			pass
+		names = sorted(name for name in os.listdir(self.path) if name.endswith('.log'))
+		for name in names:
+			path = os.path.join(self.path, name)
+			end = 0
+			with open(path, 'rb') as file:
+				size = os.fstat(file.fileno()).st_size
+				if size > 0:
+					with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as buf:
+						for seq, offset, length in read_records(buf):
+							end = offset + length
+							self.next_seq = max(self.next_seq, seq + 1)
+							if seq <= self.acked or seq in self.delivered or seq in self.index:
+								continue
+							remote = decode_body(buf[offset + record_header.size:end])[0]
+							self.index[seq] = (remote, path, offset, length)
+							self.by_remote.setdefault(remote, dict())[seq] = None
+			if end < size:
+				# Torn by a crash while appending
+				os.truncate(path, end)
+			self.segments[path] = end
+			self.size += end
+		# Delivered messages may no longer be in the log once it was
+		# compacted, and their sequence numbers must not be reused
+		self.next_seq = max(self.next_seq, self.acked + 1, max(self.delivered, default=0) + 1)
+		self.compact()
+
+	def append(self, parts):
+		''' Append a message (whose first part is its destination), returns its sequence number '''
+		seq = self.next_seq
+		record = encode_record(seq, parts)
+		if self.size + len(record) > self.max_bytes:
+			self.compact(True)
+			if self.size + len(record) > self.max_bytes:
+				raise OutboxFullError('Outbox is full')
+		if self.file is None or self.segments[self.file.name] >= self.segment_bytes:
+			self._open_segment(seq)
+		path = self.file.name
+		offset = self.segments[path]
+		self.file.write(record)
+		self.file.flush()
+		self.dirty = self.sync
+		self.segments[path] += len(record)
+		self.size += len(record)
+		remote = bytes(parts[0])
+		self.index[seq] = (remote, path, offset, len(record))
+		self.by_remote.setdefault(remote, dict())[seq] = None
+		self.next_seq = seq + 1
+		return seq
+
+	def unsynced(self):
+		'''
+		Descriptor to sync (see sync_fd) for the messages appended so far to
+		be on disk, or None if they are.  It is a duplicate, so it remains
+		valid while the log is appended to or compacted.
+		'''
+		if not self.dirty:
+			return None
+		self.dirty = False
+		return os.dup(self.file.fileno())
+
+	def _open_segment(self, seq):
+		if self.file is not None:
+			if self.dirty:
+				os.fdatasync(self.file.fileno())
+				self.dirty = False
+			self.file.close()
+		path = self._segment_path(seq)
+		self.file = open(path, 'ab')
+		self.segments[path] = 0
+
+	def pending(self, remote=None, after=0, limit=None):
+		''' Undelivered messages (to remote, if given) after sequence number after, as a list of (seq, parts) '''
+		messages = []
+		buffers = dict()
+		seqs = self.index.keys() if remote is None else self.by_remote.get(remote, ())
+		try:
+			for seq in seqs:
+				if seq <= after:
+					continue
+				if limit is not None and len(messages) >= limit:
+					break
+				destination, path, offset, length = self.index[seq]
+				buf = buffers.get(path)
+				if buf is None:
+					with open(path, 'rb') as file:
+						buf = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+					buffers[path] = buf
+				messages.append((seq, decode_body(buf[offset + record_header.size:offset + length])))
+		finally:
+			for buf in buffers.values():
+				buf.close()
+		return messages
+
+	def floor(self, remote):
+		''' Sequence number up to which all messages to remote were delivered '''
+		for seq in self.by_remote.get(remote, ()):
+			return seq - 1
+		return self.next_seq - 1
+
+	def remotes(self):
+		''' Destinations of undelivered messages '''
+		return list(self.by_remote.keys())
+
+	def undelivered(self, remote):
+		''' Number of undelivered messages to remote '''
+		return len(self.by_remote.get(remote, ()))
+
+	def add_peer(self, remote):
+		''' Record that remote answered a ping '''
+		if remote not in self.peers:
+			self.peers.add(remote)
+			self._save_acked()
+
+	def ack(self, remote, seq):
+		''' Mark messages to remote up to sequence number seq as delivered '''
+		seqs = self.by_remote.get(remote, ())
+		delivered = []
+		for key in seqs:
+			if key > seq:
+				break
+			delivered.append(key)
+		if not delivered:
+			return
+		for key in delivered:
+			del self.index[key]
+			del seqs[key]
+			self.delivered.add(key)
+		if not seqs:
+			del self.by_remote[remote]
+		while self.acked + 1 in self.delivered:
+			self.acked += 1
+			self.delivered.discard(self.acked)
+		self.delivered.difference_update([key for key in self.delivered if key <= self.acked])
+		self._save_acked()
+		self.compact()
+
+	def _save_acked(self):
+		path = os.path.join(self.path, 'acked')
+		with open(path + '.tmp', 'w') as file:
+			json.dump({ 'acked': self.acked, 'delivered': sorted(self.delivered), 'peers': sorted(peer.hex() for peer in self.peers) }, file)
+			file.flush()
+			if self.sync:
+				os.fdatasync(file.fileno())
+		os.replace(path + '.tmp', path)
+
+	def compact(self, force=False):
+		''' Delete segments of delivered messages, and rewrite the log if delivered messages dominate it '''
+		live = set(path for destination, path, offset, length in self.index.values())
+		for path in list(self.segments.keys()):
+			if path not in live:
+				self._delete_segment(path)
+		live_bytes = sum(length for destination, path, offset, length in self.index.values())
+		if not self.index or (self.size - live_bytes <= max(self.segment_bytes, live_bytes) and not force):
+			return
+		if self.size == live_bytes:
+			return
+		messages = self.pending()
+		first = messages[0][0]
+		temp = os.path.join(self.path, '.compact')
+		index = collections.OrderedDict()
+		path = self._segment_path(first)
+		offset = 0
+		with open(temp, 'wb') as file:
+			for seq, parts in messages:
+				record = encode_record(seq, parts)
+				file.write(record)
+				index[seq] = (bytes(parts[0]), path, offset, len(record))
+				offset += len(record)
+			file.flush()
+			os.fdatasync(file.fileno())
+		if self.file is not None:
+			self.file.close()
+			self.file = None
+		# Undelivered messages are synced in their new segment
+		self.dirty = False
+		# Replace first, so a crash leaves the messages at least once
+		os.replace(temp, path)
+		for old in list(self.segments.keys()):
+			if old != path:
+				self._delete_segment(old)
+		self.segments = collections.OrderedDict([(path, offset)])
+		self.size = offset
+		self.index = index
+
+	def _delete_segment(self, path):
+		if self.file is not None and path == self.file.name:
+			self.file.close()
+			self.file = None
+			self.dirty = False
+		self.size -= self.segments.pop(path)
+		try:
+			os.unlink(path)
+		except FileNotFoundError:
+			pass
+
+	def close(self):
+		if self.file is not None:
+			if self.dirty:
+				os.fdatasync(self.file.fileno())
+				self.dirty = False
+			self.file.close()
+			self.file = None
+
+	def summary(self):
+		return {
+			'pending': len(self.index),
+			'segments': len(self.segments),
+			'size': self.size,
+			'max_bytes': self.max_bytes,
+			'acked': self.acked
+		}
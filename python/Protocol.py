@@ -1,6 +1,9 @@
 import asyncio
+import time
 import zmq
 
+from Outbox import sync_fd
+
 _no_timeout = object()
 
 class Config():
@@ -47,15 +50,86 @@ def decode_label(buf):
 		raise InvalidLabelError('Invalid label')
 	return str(buf[0:-1], 'utf-8')
 
+class Link():
+	''' What is known of the link to a remote, for delivering messages from an outbox '''
+	# Whether the remote answered the last ping, so more messages may be sent
+	up = False
+	# Sequence number of the unanswered ping (0 if it acknowledges nothing),
+	# or None, and the time it was sent
+	awaiting = None
+	pinged = 0
+	# Sequence number of the last message sent, of the last message sent
+	# before the current batch, and number of messages sent since the
+	# previous ping
+	sent = 0
+	base = 0
+	count = 0
+	# Messages to send per ping, halved when some are lost
+	batch = 1
+
+class Sequence():
+	''' What is known of the messages received from the outbox of a remote, for dropping duplicates '''
+	# All messages up to this sequence number were delivered, as last reported by the remote
+	floor = 0
+
+	def __init__(self):
+		# Sequence numbers of messages received after the floor
+		self.received = set()
+
+	def advance(self, floor):
+		if floor < self.floor:
+			# Sequence numbers started again, with a new outbox
+			self.received = set()
+		else:
+			self.received = set(seq for seq in self.received if seq > floor)
+		self.floor = floor
+
+	def duplicate(self, seq):
+		''' Whether a message was received before, noting it if not '''
+		if seq <= self.floor or seq in self.received:
+			return True
+		self.received.add(seq)
+		return False
+
 class Socket():
+	'''
+	Socket for exchanging messages with remotes via the bridge.
+
+	Given an Outbox, messages sent are stored in it until delivered: when
+	a remote is known to be reachable (it answered a ping, or sent a
+	message), a batch of its messages is sent followed by a ping, and the
+	batch is acknowledged if the pong reports all of it received, otherwise
+	sent again (with batches growing to batch_size messages while none are
+	lost, and halving otherwise).  Unreachable remotes are pinged every
+	retry_interval seconds until they answer.
+
+	Messages from an outbox carry their sequence number (as deliver
+	commands), so that those sent again are passed to the service once.
+	Only remotes which also have an outbox answer pings and unwrap them
+	(see ../PROTOCOL.md): until a remote has answered a ping (the outbox
+	records those which did), messages to it are sent as they are, without
+	being stored, while pinging it to find out.  Without an outbox, the
+	ping, pong and deliver commands are passed to the service like any
+	other.
+	'''
 	config = None
 	ctx = None
 	pub = None
 	sub = None
+	outbox = None
+	retry_interval = 2.0
+	batch_size = 16
 
-	def __init__(self, ctx, config):
+	def __init__(self, ctx, config, outbox=None):
 		self.config = config
 		self.ctx = ctx
+		self.outbox = outbox
+		# Links to remotes with undelivered messages, keyed by label
+		self.links = dict()
+		# Messages received from each remote since it last pinged, keyed by label
+		self.received = dict()
+		# Sequences of messages received from the outbox of each remote, keyed by label
+		self.sequences = dict()
 		self.pub = self.ctx.socket(zmq.PUB)
 		self.sub = self.ctx.socket(zmq.SUB)
 		self.pub.connect(config.tx_url)
@@ -82,31 +156,152 @@ class Socket():
 				encode_label(envelope.command),
 		]
 		msg += parts
-		return await self.pub.send_multipart(msg)
+		if self.outbox is None:
+			return await self.pub.send_multipart(msg)
+		if msg[0] not in self.outbox.peers:
+			# Not known to answer pings, so it might not unwrap deliver commands
+			await self.pub.send_multipart(msg)
+			await self.probe(msg[0])
+			return
+		self.outbox.append(msg)
+		fd = self.outbox.unsynced()
+		if fd is not None:
+			# Without blocking the event loop
+			await asyncio.get_running_loop().run_in_executor(None, sync_fd, fd)
+		await self.flush(msg[0])
+
+	async def probe(self, remote):
+		''' Ping a remote (by label) which has not answered a ping yet, at most every retry_interval seconds '''
+		link = self.links.setdefault(remote, Link())
+		now = time.monotonic()
+		if link.awaiting is None or now - link.pinged >= self.retry_interval:
+			link.awaiting = 0
+			link.pinged = now
+			await self.ping(remote, 0)
+
+	async def flush(self, remote=None):
+		''' Send messages from the outbox to the remotes (or given remote label) which are reachable, and ping the others '''
+		now = time.monotonic()
+		for destination in self.outbox.remotes() if remote is None else [remote]:
+			link = self.links.setdefault(destination, Link())
+			if link.up and link.awaiting is None:
+				batch = self.outbox.pending(destination, link.sent, link.batch)
+				if not batch:
+					continue
+				link.base = link.sent
+				for seq, msg in batch:
+					await self.pub.send_multipart(msg[0:3] + [encode_label('deliver'), bytes(str(seq), 'ascii')] + msg[3:])
+				link.sent = batch[-1][0]
+				link.count = len(batch)
+				link.awaiting = link.sent
+				link.pinged = now
+				await self.ping(destination, link.sent)
+			elif now - link.pinged >= self.retry_interval:
+				# Unanswered, so send everything unacknowledged again once it answers
+				link.up = False
+				link.sent = 0
+				link.count = 0
+				link.awaiting = 0
+				link.pinged = now
+				await self.ping(destination, 0)
+
+	async def ping(self, remote, seq):
+		''' Ping a remote (by label), following messages up to sequence number seq '''
+		await self.pub.send_multipart([
+				remote,
+				encode_label(self.config.hostname),
+				encode_label(self.config.session or ''),
+				encode_label('ping'),
+				bytes(str(seq), 'ascii'),
+				bytes(str(self.outbox.floor(remote)), 'ascii')
+		])
+
+	async def heard(self, remote, command, parts):
+		''' Note that a message was received from a remote (by label), flushing messages to it '''
+		link = self.links.get(remote)
+		if link is None:
+			if not self.outbox.undelivered(remote):
+				return
+			link = self.links.setdefault(remote, Link())
+		if command == 'pong':
+			try:
+				seq = int(parts[0])
+				count = int(parts[1])
+			except (ValueError, IndexError):
+				return
+			if seq != link.awaiting:
+				# Answer to an earlier ping
+				return
+			link.awaiting = None
+			self.outbox.add_peer(remote)
+			if seq > 0:
+				if count == link.count:
+					self.outbox.ack(remote, seq)
+					link.batch = min(self.batch_size, link.batch * 2)
+				else:
+					# Some of the batch was lost, send it again
+					link.sent = link.base
+					link.batch = max(1, link.batch // 2)
+		elif link.awaiting is not None:
+			return
+		link.up = True
+		await self.flush(remote)
 
 	async def recv(self, timeout = _no_timeout):
 		global _no_timeout
 		if timeout == _no_timeout:
 			timeout = self.config.timeout
-		if timeout is not None:
-			timeout = timeout * 1000.0
-		events = await self.sub.poll(timeout=timeout, flags=zmq.POLLIN)
-		if not (events & zmq.POLLIN):
-			raise ReceiveTimeoutError('Receive timed out')
-		msg = await self.sub.recv_multipart()
-		if len(msg) < 5:
-			raise InvalidMessageError('Insufficient parts')
-		try:
-			local, remote, session, command = [decode_label(label) for label in msg[0:4]]
-			if local != self.config.hostname:
-				raise InvalidLabelError('Message is addressed to "' + local + '"')
-		except InvalidLabelError as err:
-			if timeout is None:
-				return await recv(timeout)
-			else:
-				return ( None, None )
-		parts = msg[4:]
-		envelope = Envelope(remote, session, command)
-		return ( envelope, parts )
+		deadline = None if timeout is None else time.monotonic() + timeout
+		while True:
+			wait = None if deadline is None else max(0, deadline - time.monotonic())
+			if self.outbox is not None and self.outbox.index:
+				# Wake up to ping remotes with undelivered messages
+				wait = self.retry_interval if wait is None else min(wait, self.retry_interval)
+			events = await self.sub.poll(timeout=None if wait is None else wait * 1000.0, flags=zmq.POLLIN)
+			if not (events & zmq.POLLIN):
+				if self.outbox is not None:
+					await self.flush()
+				if deadline is not None and time.monotonic() >= deadline:
+					raise ReceiveTimeoutError('Receive timed out')
+				continue
+			msg = await self.sub.recv_multipart()
+			if len(msg) < 5:
+				raise InvalidMessageError('Insufficient parts')
+			try:
+				local, remote, session, command = [decode_label(label) for label in msg[0:4]]
+				if local != self.config.hostname:
+					raise InvalidLabelError('Message is addressed to "' + local + '"')
+			except InvalidLabelError as err:
+				if timeout is None:
+					continue
+				else:
+					return ( None, None )
+			parts = msg[4:]
+			if self.outbox is None:
+				return ( Envelope(remote, session, command), parts )
+			if command == 'ping':
+				count = self.received.pop(msg[1], 0)
+				await self.pub.send_multipart([msg[1], msg[0], msg[2], encode_label('pong'), parts[0], bytes(str(count), 'ascii')])
+				if len(parts) > 1 and msg[1] in self.sequences:
+					try:
+						self.sequences[msg[1]].advance(int(parts[1]))
+					except ValueError:
+						pass
+			elif command != 'pong':
+				self.received[msg[1]] = self.received.get(msg[1], 0) + 1
+			await self.heard(msg[1], command, parts)
+			if command in ('ping', 'pong'):
+				continue
+			if command == 'deliver':
+				try:
+					seq = int(parts[0])
+					command = decode_label(parts[1])
+				except (ValueError, IndexError, InvalidLabelError):
+					continue
+				parts = parts[2:]
+				if self.sequences.setdefault(msg[1], Sequence()).duplicate(seq):
+					continue
+			envelope = Envelope(remote, session, command)
+			return ( envelope, parts )
 
 Socket.Envelope = Envelope
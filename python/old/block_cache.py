@@ -0,0 +1,123 @@
+import os
+import json
+import hashlib
+
+from disk_lru import DiskLRU
+
+class BlockCache():
+	'''
+	Blocks of remote files cached on local disk, as <path>/<key>/<offset>
+	where the key is a hash of the remote file's name and <offset> is the
+	offset of the block in hex.  <path>/<key>/meta records the remote file,
+	and the modification time, size and block size which the blocks are
+	valid for, so a single stat of the remote file validates them all.
+
+	Blocks of all remote files share the budget, so reading one large file
+	evicts the blocks of others, least-recently-used first (see DiskLRU),
+	while the blocks of a file which changed are discarded as soon as it
+	is validated again.
+	'''
+
+	def __init__(self, path, budget):
+		self.path = path
+		# Remote files, key => meta
+		self.files = dict()
+		# Blocks keyed by (key, offset)
+		self.blocks = DiskLRU(budget, lambda block: self._path(*block))
+		self.hits = 0
+		self.misses = 0
+		self.invalidations = 0
+		os.makedirs(path, exist_ok=True)
+		self.load()
+
+	def load(self):
+		entries = []
+		with os.scandir(self.path) as dirs:
+			for dir in dirs:
+				if not dir.is_dir():
+					continue
+				try:
+					with open(os.path.join(dir.path, 'meta'), 'r') as file:
+						self.files[dir.name] = json.load(file)
+				except (FileNotFoundError, ValueError):
+					continue
+				with os.scandir(dir.path) as files:
+					for file in files:
+						if file.name == 'meta':
+							continue
+						if file.name.startswith('.'):
+							# Left behind by an interrupted write
+							os.unlink(file.path)
+							continue
+						stat = file.stat()
+						entries.append((stat.st_mtime, (dir.name, int(file.name, 16)), stat.st_size))
+		self.blocks.load(entries)
+
+	def key(self, remote):
+		return hashlib.sha256(bytes(remote, 'utf-8')).hexdigest()[0:32]
+
+	def _path(self, key, offset=None):
+		if offset is None:
+			return os.path.join(self.path, key)
+		return os.path.join(self.path, key, '%x' % offset)
+
+	def validate(self, remote, mtime, size, block_size):
+		'''
+		Check the cached blocks of a remote file against its current
+		modification time and size, discarding them if the file changed.
+		Returns the set of indexes of the blocks which are cached.
+		'''
+		key = self.key(remote)
+		meta = { 'remote': remote, 'mtime': mtime, 'size': size, 'block_size': block_size }
+		if self.files.get(key) != meta:
+			if key in self.files:
+				self.invalidations += 1
+				self.discard(key)
+			os.makedirs(self._path(key), exist_ok=True)
+			temp = os.path.join(self._path(key), '.meta')
+			with open(temp, 'w') as file:
+				json.dump(meta, file)
+			os.replace(temp, os.path.join(self._path(key), 'meta'))
+			self.files[key] = meta
+			return set()
+		return set(offset // block_size for (k, offset) in self.blocks.keys() if k == key)
+
+	def discard(self, key):
+		''' Delete all blocks of a remote file '''
+		for block in [block for block in self.blocks.keys() if block[0] == key]:
+			self.blocks.discard(block)
+
+	def get(self, remote, offset):
+		''' Return the data of a block, or None if it is not cached '''
+		key = self.key(remote)
+		if (key, offset) not in self.blocks:
+			self.misses += 1
+			return None
+		with open(self._path(key, offset), 'rb') as file:
+			data = file.read()
+		self.hits += 1
+		self.blocks.touch((key, offset))
+		return data
+
+	def put(self, remote, offset, data):
+		''' Store a block of a remote file which was validated with validate() '''
+		key = self.key(remote)
+		if key not in self.files:
+			return
+		temp = os.path.join(self._path(key), '.%x' % offset)
+		with open(temp, 'wb') as file:
+			file.write(data)
+		os.replace(temp, self._path(key, offset))
+		self.blocks.add((key, offset), len(data))
+
+	def summary(self):
+		return {
+			'files': len(self.files),
+			'blocks': len(self.blocks),
+			'size': self.blocks.size,
+			'budget': self.blocks.budget,
+			'hits': self.hits,
+			'misses': self.misses,
+			'invalidations': self.invalidations,
+			'evictions': self.blocks.evictions
+		}
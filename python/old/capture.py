@@ -0,0 +1,136 @@
+''' Capture files of traffic over a serial link, see udp_bridge.py --capture and replay.py. '''
+
+import os
+import mmap
+import time
+import struct
+
+# Start of a capture file
+magic = b'QBCAP\x00\x00\x01'
+# Record header: wall-clock time, kind of record, length of data which follows
+record_header = struct.Struct('<dII')
+
+# Kinds of record: bytes read from / written to the serial device, and
+# whole datagrams received over / to be sent over the serial link
+RX_BYTES = 0
+TX_BYTES = 1
+RX_PACKET = 2
+TX_PACKET = 3
+
+kind_names = {
+	RX_BYTES: 'rx bytes',
+	TX_BYTES: 'tx bytes',
+	RX_PACKET: 'rx packet',
+	TX_PACKET: 'tx packet'
+}
+
+class CaptureError(ValueError):
+	pass
+
+class CaptureWriter():
+	'''
+	Appends timestamped records to a capture file.
+
+	Each record is written with a single write to a file opened for
+	appending, so records are never interleaved or rewritten, and a reader
+	(which may map the file while it is still being written) sees at worst
+	a truncated last record.  Captures from several runs can be appended to
+	the same file.
+	'''
+
+	def __init__(self, path):
+		self.fd = os.open(path, os.O_WRONLY | os.O_APPEND | os.O_CREAT | os.O_CLOEXEC, 0o666)
+		try:
+			if os.fstat(self.fd).st_size == 0:
+				os.write(self.fd, magic)
+			else:
+				with open(path, 'rb') as file:
+					if file.read(len(magic)) != magic:
+						raise CaptureError(path + ' is not a capture file')
+		except BaseException:
+			os.close(self.fd)
+			raise
+		self.records = 0
+		self.size = 0
+
+	def write(self, kind, data, now=None):
+		if now is None:
+			now = time.time()
+		os.write(self.fd, record_header.pack(now, kind, len(data)) + data)
+		self.records += 1
+		self.size += record_header.size + len(data)
+
+	def close(self):
+		if self.fd is not None:
+			os.close(self.fd)
+			self.fd = None
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, *args, **kwargs):
+		self.close()
+		return False
+
+class CaptureReader():
+	'''
+	Reads a capture file through a read-only memory map, without copying:
+	records are generated as (time, kind, data), where data is a memoryview
+	of the map, valid until the reader is closed.
+
+	A truncated last record (e.g. of a capture still being written) is
+	ignored, and counted in truncated.
+	'''
+
+	def __init__(self, path):
+		self.map = None
+		self.view = None
+		self.truncated = 0
+		with open(path, 'rb') as file:
+			size = os.fstat(file.fileno()).st_size
+			if size < len(magic):
+				raise CaptureError(path + ' is not a capture file')
+			self.map = mmap.mmap(file.fileno(), size, access=mmap.ACCESS_READ)
+		if self.map[0:len(magic)] != magic:
+			self.close()
+			raise CaptureError(path + ' is not a capture file')
+		self.view = memoryview(self.map)
+
+	def __iter__(self):
+		view = self.view
+		end = len(view)
+		offset = len(magic)
+		while offset < end:
+			if offset + record_header.size > end:
+				self.truncated += 1
+				break
+			now, kind, length = record_header.unpack_from(view, offset)
+			offset += record_header.size
+			if offset + length > end:
+				self.truncated += 1
+				break
+			yield (now, kind, view[offset:offset + length])
+			offset += length
+
+	def records(self, kinds):
+		''' Records of the given kinds, as a list '''
+		return [record for record in self if record[1] in kinds]
+
+	def close(self):
+		if self.view is not None:
+			self.view.release()
+			self.view = None
+		if self.map is not None:
+			try:
+				self.map.close()
+			except BufferError:
+				# Records are still referenced, the map is closed once they are freed
+				pass
+			self.map = None
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, *args, **kwargs):
+		self.close()
+		return False
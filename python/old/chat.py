@@ -2,12 +2,15 @@
 
 import os
 import sys
+import errno
 import getopt
 from serial import Serial
 from asyncio import Queue
 import fcntl
 import select
 
+from ring_buffer import RingBuffer
+
 def configure(args):
 	device = None
 	baud = None
@@ -36,11 +39,105 @@ def configure(args):
 
 	return ( device, baud, args )
 
-def splice(fi, fo):
+class Relay():
+	'''
+	Copies data from one non-blocking file descriptor to another, reading
+	only while there is room to buffer what is read and writing only while
+	there is something to write.
+
+	Where both descriptors support it, data is moved with os.splice through
+	a pipe, so it is never copied into this process.  Otherwise (e.g. the
+	kernel does not splice to or from ttys) it falls back to reading into a
+	ring buffer and writing from it.
+	'''
+
 	BUFSIZE = 0x10000
-	data = os.read(fi, BUFSIZE)
-	if data:
-		os.write(fo, data)
+
+	def __init__(self, src, dst, zero_copy=True):
+		self.src = src
+		self.dst = dst
+		self.eof = False
+		# Pipe which data is spliced through, its capacity and the bytes in it
+		self.pipe = None
+		self.pipe_size = 0
+		self.piped = 0
+		if zero_copy and hasattr(os, 'splice'):
+			self.pipe = os.pipe2(os.O_NONBLOCK | os.O_CLOEXEC)
+			self.pipe_size = fcntl.fcntl(self.pipe[1], fcntl.F_GETPIPE_SZ) if hasattr(fcntl, 'F_GETPIPE_SZ') else self.BUFSIZE
+		# Large enough to take the pipe's contents when falling back to copying
+		self.buf = RingBuffer(max(self.BUFSIZE, self.pipe_size))
+
+	def want_read(self):
+		if self.eof:
+			return False
+		if self.pipe is not None:
+			return self.piped < self.pipe_size
+		return not self.buf.full()
+
+	def want_write(self):
+		return self.piped > 0 or len(self.buf) > 0
+
+	def done(self):
+		''' Whether the source reached end of file and everything read from it was written '''
+		return self.eof and not self.want_write()
+
+	def read(self):
+		if self.pipe is not None:
+			try:
+				count = os.splice(self.src, self.pipe[1], self.pipe_size - self.piped, flags=os.SPLICE_F_MOVE | os.SPLICE_F_NONBLOCK)
+			except BlockingIOError:
+				return
+			except OSError as err:
+				if err.errno != errno.EINVAL:
+					raise
+				self._copy()
+				return self.read()
+			self.piped += count
+		else:
+			count = self.buf.read_from(self.src)
+			if count is None:
+				return
+		if count == 0:
+			self.eof = True
+
+	def write(self):
+		if self.piped > 0:
+			try:
+				count = os.splice(self.pipe[0], self.dst, self.piped, flags=os.SPLICE_F_MOVE | os.SPLICE_F_NONBLOCK)
+			except BlockingIOError:
+				return
+			except OSError as err:
+				if err.errno != errno.EINVAL:
+					raise
+				self._copy()
+				return self.write()
+			self.piped -= count
+		else:
+			self.buf.write_to(self.dst)
+
+	def _copy(self):
+		''' Fall back to copying, keeping any data already in the pipe '''
+		while self.piped > 0:
+			self.piped -= self.buf.read_from(self.pipe[0])
+		self.close()
+
+	def close(self):
+		if self.pipe is not None:
+			for fd in self.pipe:
+				os.close(fd)
+			self.pipe = None
+
+def relay(relays):
+	''' Run relays until all of them reach end of file, sleeping while there is nothing to do '''
+	while not all(item.done() for item in relays):
+		want_read = [item.src for item in relays if item.want_read()]
+		want_write = [item.dst for item in relays if item.want_write()]
+		r, w, e = select.select(want_read, want_write, [])
+		for item in relays:
+			if item.dst in w and item.want_write():
+				item.write()
+			if item.src in r and item.want_read():
+				item.read()
 
 def run(device, baud, args):
 	with Serial(device, baud) as uart:
@@ -49,16 +146,12 @@ def run(device, baud, args):
 		stdout_fileno = sys.stdout.fileno()
 		for fd in [stdin_fileno, uart_fileno, stdout_fileno]:
 			fcntl.fcntl(fd, fcntl.F_SETFL, fcntl.fcntl(fd, fcntl.F_GETFL) | os.O_NONBLOCK)
-		while True:
-			r, w, e = select.select([uart_fileno, stdin_fileno], [uart_fileno, stdout_fileno], [], 0)
-			if e:
-				print('Error occurred')
-				break
-			if uart_fileno in r and stdout_fileno in w:
-				splice(uart_fileno, stdout_fileno)
-			if stdin_fileno in r and uart_fileno in w:
-				splice(stdin_fileno, uart_fileno)
-		proc.wait()
+		relays = [Relay(uart_fileno, stdout_fileno), Relay(stdin_fileno, uart_fileno)]
+		try:
+			relay(relays)
+		finally:
+			for item in relays:
+				item.close()
 
 def main():
 	device, baud, args = configure(sys.argv[1:])
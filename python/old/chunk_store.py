@@ -0,0 +1,100 @@
+import os
+import hashlib
+
+from disk_lru import DiskLRU
+
+def chunk_hash(data):
+	''' Name of a chunk in the store '''
+	return hashlib.sha256(data).hexdigest()
+
+def valid_hash(hash):
+	return isinstance(hash, str) and len(hash) == 64 and not hash.strip('0123456789abcdef')
+
+class InvalidChunkError(ValueError):
+	pass
+
+class ChunkStore():
+	'''
+	Content-addressed store of chunks on disk, each named by its SHA-256
+	hash (as <path>/<first two hex digits>/<hash>).
+
+	Chunks are shared between files and uploads, so rather than being
+	deleted with a file, they are evicted when the store exceeds its
+	budget, least-recently-used first (see DiskLRU).  The most recently
+	used chunk is kept even so, as a chunk larger than the budget is still
+	needed right after it was stored.
+	'''
+
+	def __init__(self, path, budget):
+		self.path = path
+		self.chunks = DiskLRU(budget, self._path, keep=1)
+		self.hits = 0
+		self.misses = 0
+		os.makedirs(path, exist_ok=True)
+		self.load()
+
+	def load(self):
+		entries = []
+		with os.scandir(self.path) as subdirs:
+			for subdir in subdirs:
+				if not subdir.is_dir() or len(subdir.name) != 2:
+					continue
+				with os.scandir(subdir.path) as files:
+					for file in files:
+						if valid_hash(file.name):
+							stat = file.stat()
+							entries.append((stat.st_mtime, file.name, stat.st_size))
+						elif file.name.startswith('.'):
+							# Left behind by an interrupted write
+							os.unlink(file.path)
+		self.chunks.load(entries)
+
+	def _path(self, hash):
+		return os.path.join(self.path, hash[0:2], hash)
+
+	def missing(self, hashes):
+		''' Return which of the given hashes are not in the store, marking the others as used '''
+		missing = []
+		for hash in hashes:
+			if not valid_hash(hash):
+				raise InvalidChunkError('Invalid chunk hash')
+			if hash in self.chunks:
+				self.hits += 1
+				self.chunks.touch(hash)
+			else:
+				self.misses += 1
+				missing.append(hash)
+		return missing
+
+	def put(self, hash, data):
+		if not valid_hash(hash) or chunk_hash(data) != hash:
+			raise InvalidChunkError('Chunk does not match hash')
+		if hash in self.chunks:
+			self.chunks.touch(hash)
+			return
+		path = self._path(hash)
+		os.makedirs(os.path.dirname(path), exist_ok=True)
+		temp = os.path.join(os.path.dirname(path), '.' + hash)
+		with open(temp, 'wb') as file:
+			file.write(data)
+		os.replace(temp, path)
+		self.chunks.add(hash, len(data))
+
+	def get(self, hash):
+		''' Return the data of a chunk, or None if it is not in the store '''
+		if hash not in self.chunks:
+			return None
+		with open(self._path(hash), 'rb') as file:
+			data = file.read()
+		self.chunks.touch(hash)
+		return data
+
+	def summary(self):
+		return {
+			'chunks': len(self.chunks),
+			'size': self.chunks.size,
+			'budget': self.chunks.budget,
+			'hits': self.hits,
+			'misses': self.misses,
+			'evictions': self.chunks.evictions
+		}
@@ -0,0 +1,186 @@
+#!/usr/bin/python3
+
+''' Linux only. '''
+
+import os
+import sys
+import pty
+import time
+import json
+import getopt
+import select
+import subprocess
+
+import kiss
+
+class Config():
+	''' Configuration for CPU benchmark '''
+	script = 'chat.py'
+	baud = 115200
+	# Seconds to measure for with no traffic, and with traffic
+	idle = 5.0
+	duration = 5.0
+	# Bytes to write at a time in each direction during the transfer
+	chunk_size = 0x1000
+	# Send KISS-encoded JSON packets over the serial link (for packet.py) instead of raw bytes
+	packets = False
+
+def cpu_time(pid):
+	''' User and system CPU time used by a process so far, in seconds '''
+	with open('/proc/%d/stat' % pid, 'r') as file:
+		# Fields after the command name, which may contain spaces
+		fields = file.read().rsplit(')', 1)[1].split()
+	return (int(fields[11]) + int(fields[12])) / os.sysconf('SC_CLK_TCK')
+
+class Benchmark():
+	'''
+	Measures the CPU used by a serial demo (chat.py or packet.py) while idle,
+	and while data is sent through it as fast as it will go in both
+	directions.
+
+	A pseudo-terminal stands in for the serial device, and the program's
+	STDIN and STDOUT are pipes.
+	'''
+
+	def __init__(self, config):
+		self.config = config
+		self.seq = 1
+		self.encoder = kiss.Encoder()
+
+	def uart_data(self):
+		''' Data to send to the program over the serial link '''
+		if not self.config.packets:
+			return b'x' * self.config.chunk_size
+		msg = { 'seq': self.seq, 'text': 'x' * self.config.chunk_size }
+		self.seq += 1
+		return bytes(self.encoder.apply(bytes(json.dumps(msg), 'utf-8')))
+
+	def run(self):
+		config = self.config
+		master, slave = pty.openpty()
+		env = dict(os.environ)
+		# Let scripts extracted from other revisions find the modules here
+		env['PYTHONPATH'] = os.pathsep.join(filter(None, [os.path.dirname(os.path.abspath(__file__)), env.get('PYTHONPATH')]))
+		proc = subprocess.Popen([sys.executable, config.script, os.ttyname(slave), str(config.baud)], stdin=subprocess.PIPE, stdout=subprocess.PIPE, env=env)
+		try:
+			# Let it start up
+			time.sleep(1.0)
+			start = cpu_time(proc.pid)
+			time.sleep(config.idle)
+			idle = cpu_time(proc.pid) - start
+			start = cpu_time(proc.pid)
+			sent, received = self.transfer(proc, master)
+			busy = cpu_time(proc.pid) - start
+		finally:
+			proc.kill()
+			proc.wait()
+			os.close(master)
+			os.close(slave)
+		return {
+			'idle_cpu': idle / config.idle,
+			'transfer_cpu': busy / config.duration,
+			'sent': sent,
+			'received': received,
+			'cpu_per_mib': busy / max(1, sum(received.values())) * 0x100000
+		}
+
+	def transfer(self, proc, master):
+		''' Write to STDIN and the serial link as fast as they accept, reading whatever comes out '''
+		stdin = proc.stdin.fileno()
+		stdout = proc.stdout.fileno()
+		for fd in [stdin, stdout, master]:
+			os.set_blocking(fd, False)
+		sent = { 'stdin': 0, 'uart': 0 }
+		received = { 'stdout': 0, 'uart': 0 }
+		out = { stdin: b'', master: b'' }
+		stdin_data = b'x' * self.config.chunk_size
+		end = time.monotonic() + self.config.duration
+		while True:
+			now = time.monotonic()
+			if now >= end:
+				break
+			r, w, e = select.select([stdout, master], [stdin, master], [], end - now)
+			if stdout in r:
+				received['stdout'] += len(os.read(stdout, 0x10000))
+			if master in r:
+				received['uart'] += len(os.read(master, 0x10000))
+			for fd, name in [(stdin, 'stdin'), (master, 'uart')]:
+				if fd not in w:
+					continue
+				if not out[fd]:
+					out[fd] = stdin_data if fd == stdin else self.uart_data()
+				try:
+					written = os.write(fd, out[fd])
+				except BlockingIOError:
+					continue
+				out[fd] = out[fd][written:]
+				sent[name] += written
+		return sent, received
+
+#################### DEMO / CLI STUFF COMES BELOW ####################
+
+class Program():
+	''' Wrapper to allow the benchmark to be invoked from command-line '''
+	def __init__(self, cmdline):
+		config = Config()
+		try:
+			opts, args = getopt.getopt(cmdline, '', ['script=', 'baud=', 'idle=', 'duration=', 'chunk_size=', 'packets', 'help'])
+
+			for opt, val in opts:
+				if opt in ('--script'):
+					config.script = val
+				elif opt in ('--baud'):
+					config.baud = int(val)
+				elif opt in ('--idle'):
+					config.idle = float(val)
+				elif opt in ('--duration'):
+					config.duration = float(val)
+				elif opt in ('--chunk_size'):
+					config.chunk_size = int(val, 0)
+				elif opt in ('--packets'):
+					config.packets = True
+				elif opt in ('--help'):
+					self.usage()
+					sys.exit(0)
+				else:
+					raise AssertionError('Unhandled option: ' + opt)
+			if args:
+				raise AssertionError('Unexpected trailing arguments')
+		except (getopt.GetoptError, ValueError) as err:
+			print(err)
+			self.usage()
+			sys.exit(1)
+		self.config = config
+
+	def run(self):
+		result = Benchmark(self.config).run()
+		print('Script:       ' + self.config.script)
+		print('Idle CPU:     %.1f%%' % (result['idle_cpu'] * 100))
+		print('Transfer CPU: %.1f%%' % (result['transfer_cpu'] * 100))
+		print('Sent:         ' + ', '.join('%s %d bytes' % (name, count) for name, count in result['sent'].items()))
+		print('Received:     ' + ', '.join('%s %d bytes' % (name, count) for name, count in result['received'].items()))
+		print('CPU per MiB:  %.3fs' % result['cpu_per_mib'])
+
+	def usage(self):
+		print('CPU benchmark for the serial demos')
+		print('')
+		print('Runs chat.py or packet.py on a pseudo-terminal and reports the CPU it uses')
+		print('while idle, and while data is sent through it in both directions')
+		print('')
+		print('Syntax:')
+		print('')
+		print('  ./cpu_bench.py')
+		print('                  --script=chat.py --baud=115200')
+		print('                  --idle=5 --duration=5')
+		print('                  --chunk_size=4096')
+		print('                  --packets')
+		print('')
+		print('    --script=[value]         Demo to run, e.g. a copy of an earlier revision to compare against')
+		print('    --idle=[value]           Seconds to measure with no traffic')
+		print('    --duration=[value]       Seconds to measure with traffic')
+		print('    --chunk_size=[value]     Bytes to write at a time in each direction')
+		print('    --packets                Send KISS-encoded JSON packets over the serial link, as packet.py expects')
+		print('')
+
+if __name__ == '__main__':
+	Program(sys.argv[1:]).run()
@@ -0,0 +1,68 @@
+''' Least-recently-used eviction of files on disk, shared by ChunkStore and BlockCache. '''
+
+import os
+import collections
+
+class DiskLRU():
+	'''
+	Sizes of files on disk, ordered by least-recently-used first.  When
+	their total size exceeds the budget, the least-recently-used files are
+	deleted, except for the keep most recently used.  Recency is kept in the
+	file modification times, so it survives restarts.
+	'''
+
+	def __init__(self, budget, path, keep=0):
+		self.budget = budget
+		# Path of the file of a key
+		self.path = path
+		self.keep = keep
+		# Key => size
+		self.files = collections.OrderedDict()
+		self.size = 0
+		self.evictions = 0
+
+	def __contains__(self, key):
+		return key in self.files
+
+	def __len__(self):
+		return len(self.files)
+
+	def keys(self):
+		return self.files.keys()
+
+	def load(self, entries):
+		''' Add the files found on disk, given as a list of (mtime, key, size) '''
+		for mtime, key, size in sorted(entries):
+			self.files[key] = size
+			self.size += size
+		self.gc()
+
+	def touch(self, key):
+		''' Mark a file as used '''
+		self.files.move_to_end(key)
+		os.utime(self.path(key))
+
+	def add(self, key, size):
+		''' Add a file which was just written, or replace one '''
+		self.size += size - self.files.get(key, 0)
+		self.files[key] = size
+		self.files.move_to_end(key)
+		self.gc()
+
+	def discard(self, key):
+		''' Delete a file '''
+		self.size -= self.files.pop(key)
+		self.unlink(key)
+
+	def unlink(self, key):
+		try:
+			os.unlink(self.path(key))
+		except FileNotFoundError:
+			pass
+
+	def gc(self):
+		while self.size > self.budget and len(self.files) > self.keep:
+			key, size = self.files.popitem(last=False)
+			self.size -= size
+			self.evictions += 1
+			self.unlink(key)
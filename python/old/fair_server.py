@@ -0,0 +1,211 @@
+import time
+import collections
+
+import udp_server
+
+class ClientQueue():
+	''' Requests of one client waiting to be served, and its scheduling state '''
+	client = None
+	# Responses of the request being served, and the request
+	job = None
+	request = None
+	deficit = 0
+	tokens = 0
+	refilled = 0
+	sent = 0
+	dropped = 0
+
+	def __init__(self, client, tokens):
+		self.client = client
+		self.requests = collections.deque()
+		self.tokens = tokens
+		self.refilled = time.monotonic()
+
+	def busy(self):
+		return self.job is not None or len(self.requests) > 0
+
+class FairServer(udp_server.Server):
+	'''
+	Server which shares its link fairly between clients.
+
+	Requests are queued per client and served by deficit round-robin,
+	weighted by the bytes of each request and its responses: in each round,
+	every client with queued requests may use up to quantum bytes, any
+	excess being deducted from its next round.  Streamed responses are sent
+	one at a time, so a client's bulk transfer is interleaved with the
+	requests of other clients rather than holding them up.
+
+	Each client may be limited to rate bytes per second (in bursts of up to
+	burst bytes) by a token bucket.  Interactive commands are served as soon
+	as they are received, ahead of queued requests and regardless of limits.
+	'''
+
+	# Most packets to receive before serving a round
+	max_receive = 256
+
+	def __init__(self, config, commands, quantum=0x4000, rate=0, burst=0x10000, max_queue=64, interactive=('ping', 'here', 'stat')):
+		super(FairServer, self).__init__(config, commands)
+		self.quantum = quantum
+		self.rate = rate
+		self.burst = burst
+		self.max_queue = max_queue
+		self.interactive = set(interactive) | set(self.builtins.keys()) | { 'scheduler' }
+		self.builtins['scheduler'] = self.scheduler
+		self.queues = dict()
+		# Queues of clients with requests to serve, in round order
+		self.active = collections.deque()
+		self.dropped = 0
+
+	def handle_request(self, timeout = None):
+		'''
+		Receive requests, waiting for up to timeout seconds (or indefinitely
+		if None) when no client is ready to be served, then serve one round.
+		'''
+		wait = self.ready()
+		if wait is None or (timeout is not None and timeout < wait):
+			wait = timeout
+		self.receive(wait)
+		self.complete_deferred()
+		self.serve()
+
+	def ready(self):
+		''' Seconds until a client can next be served, or None if there are no queued requests '''
+		if not self.active:
+			return None
+		if self.rate <= 0:
+			return 0
+		now = time.monotonic()
+		wait = min(-(queue.tokens + self.rate * (now - queue.refilled)) / self.rate for queue in self.active)
+		# Tokens must be positive to be served, so wait a little longer
+		return 0 if wait < 0 else wait + 0.001
+
+	def receive(self, wait):
+		sock = self.sock
+		if wait is None:
+			sock.settimeout(None)
+		elif wait > 0:
+			sock.settimeout(max(wait, 0.001))
+		else:
+			sock.setblocking(False)
+		for i in range(self.max_receive):
+			packet = self.recv_packet()
+			if packet is None:
+				return
+			# Take whatever else has arrived without waiting
+			sock.setblocking(False)
+			self.requests += 1
+			self.profiled(self.accept, packet)
+
+	def accept(self, packet):
+		''' Serve an interactive request, or queue another request, returns True if accepted '''
+		request = self.parse_request(packet)
+		if request is None:
+			return False
+		if request.command in self.interactive:
+			for msg in self.execute(request):
+				self.send_response(msg, request.stats)
+			return True
+		queue = self.client_queue(request.client)
+		if len(queue.requests) >= self.max_queue:
+			queue.dropped += 1
+			self.dropped += 1
+			self.send_response(self.traced(request, self.make_error(request.client, request.topic, request.command, request.seq, 'Too many requests queued')), request.stats)
+			return False
+		if not queue.busy():
+			self.active.append(queue)
+		request.size = len(packet)
+		queue.requests.append(request)
+		return True
+
+	def client_queue(self, client):
+		queue = self.queues.get(client)
+		if queue is None:
+			# Forget idle clients once they dominate
+			if len(self.queues) > 2 * len(self.active) + 64:
+				self.prune()
+			queue = ClientQueue(client, self.burst)
+			self.queues[client] = queue
+		return queue
+
+	def respond(self, request, job):
+		'''
+		Queue the responses of a deferred request which completed, ahead of
+		the client's other queued requests, so that they are charged to the
+		client when it is next served.
+		'''
+		if request.command in self.interactive:
+			return super(FairServer, self).respond(request, job)
+		queue = self.client_queue(request.client)
+		if not queue.busy():
+			self.active.append(queue)
+		# The request was charged for when it was first served
+		request.size = 0
+		request.job = job
+		queue.requests.appendleft(request)
+
+	def serve(self):
+		''' Serve one round over the clients with queued requests '''
+		for i in range(len(self.active)):
+			queue = self.active.popleft()
+			if self.rate > 0:
+				now = time.monotonic()
+				queue.tokens = min(self.burst, queue.tokens + self.rate * (now - queue.refilled))
+				queue.refilled = now
+			if self.rate <= 0 or queue.tokens > 0:
+				queue.deficit += self.quantum
+				while queue.deficit > 0 and (self.rate <= 0 or queue.tokens > 0) and queue.busy():
+					cost = self.profiled(self.step, queue, False)
+					queue.deficit -= cost
+					queue.tokens -= cost
+					queue.sent += cost
+			if queue.busy():
+				self.active.append(queue)
+			else:
+				# Idle clients keep no credit, but keep any debt to the rate limit
+				queue.deficit = 0
+				if self.rate <= 0:
+					del self.queues[queue.client]
+
+	def prune(self):
+		''' Forget idle clients whose token buckets have refilled '''
+		now = time.monotonic()
+		for client, queue in list(self.queues.items()):
+			if not queue.busy() and (self.rate <= 0 or queue.tokens + self.rate * (now - queue.refilled) >= self.burst):
+				del self.queues[client]
+
+	def step(self, queue):
+		''' Send the next response of a client, returns the bytes used '''
+		cost = 0
+		if queue.job is None:
+			queue.request = queue.requests.popleft()
+			queue.job = queue.request.job
+			if queue.job is None:
+				queue.job = self.execute(queue.request)
+			cost = queue.request.size
+		msg = next(queue.job, None)
+		if msg is None:
+			queue.job = None
+			queue.request = None
+			return cost
+		return cost + self.send_response(msg, queue.request.stats)
+
+	def scheduler(self, data, client):
+		if data == 'help':
+			return {
+				'help': 'Show the fair scheduler settings ("quantum", per-client "rate" and "burst" in bytes, "max_queue" requests), the number of requests "dropped" as queues were full, and for each client with queued requests the number "queued", "deficit", "tokens" and bytes "sent".'
+			}
+		return {
+			'quantum': self.quantum,
+			'rate': self.rate,
+			'burst': self.burst,
+			'max_queue': self.max_queue,
+			'dropped': self.dropped,
+			'clients': {
+				str(queue.client): {
+					'queued': len(queue.requests) + (1 if queue.job is not None else 0),
+					'deficit': queue.deficit,
+					'tokens': queue.tokens if self.rate > 0 else None,
+					'sent': queue.sent
+				} for queue in self.active
+			}
+		}
@@ -0,0 +1,573 @@
+#!/usr/bin/python3
+
+import os
+import sys
+import time
+import math
+import zlib
+import getopt
+import base64
+import struct
+import secrets
+import hashlib
+
+import udp_client
+from file_server import encode_bitmap, decode_bitmap, max_chunk_size, strong_checksum
+from chunk_store import chunk_hash
+from block_cache import BlockCache
+
+class Config(udp_client.Config):
+	topic = 'filesystem'
+	window = 8
+	max_window = 64
+	retries = 10
+	# Block size for delta sync, chosen from the remote file size if None
+	block_size = None
+	# Time to wait for the server to hash a file
+	hash_timeout = 30
+	# Directory to cache blocks of downloaded files in, and its size limit
+	cache_dir = None
+	cache_budget = 0x10000000
+
+# Modulus of Adler-32
+ADLER_MOD = 65521
+
+def delta(data, block_size, weak, strong):
+	'''
+	Find the blocks of data which exist in a basis file with the given block
+	checksums, rsync-style: an Adler-32 checksum is rolled over data one byte
+	at a time, and matches of it are confirmed with the strong checksum.
+
+	Returns a list of ops: ('copy', index, count) to copy basis blocks, or
+	('data', start, end) for literal data.
+	'''
+	table = dict()
+	for index, value in enumerate(weak):
+		table.setdefault(value, []).append(index)
+	ops = []
+	def add(op):
+		prev = ops[-1] if ops else None
+		if op[0] == 'copy' and prev is not None and prev[0] == 'copy' and prev[1] + prev[2] == op[1]:
+			ops[-1] = ('copy', prev[1], prev[2] + 1)
+		else:
+			ops.append(op)
+	length = len(data)
+	literal = 0
+	i = 0
+	value = zlib.adler32(data[0:block_size])
+	a, b = value & 0xffff, value >> 16
+	while i + block_size <= length:
+		candidates = table.get((b << 16) | a)
+		if candidates is not None:
+			digest = strong_checksum(data[i:i + block_size])
+			match = next((index for index in candidates if strong[index] == digest), None)
+			if match is not None:
+				if literal < i:
+					add(('data', literal, i))
+				add(('copy', match, 1))
+				i += block_size
+				literal = i
+				value = zlib.adler32(data[i:i + block_size])
+				a, b = value & 0xffff, value >> 16
+				continue
+		if i + block_size < length:
+			out, new = data[i], data[i + block_size]
+			a = (a - out + new) % ADLER_MOD
+			b = (b - block_size * out + a - 1) % ADLER_MOD
+		i += 1
+	if literal < length:
+		add(('data', literal, length))
+	return ops
+
+class Window():
+	''' Number of chunks in flight: doubles while no chunks are lost, then grows by one, halving on loss '''
+
+	def __init__(self, size, maximum):
+		self.size = size
+		self.maximum = maximum
+		self.threshold = maximum
+
+	def update(self, sent, lost):
+		if lost:
+			self.threshold = max(1, self.size // 2)
+			self.size = self.threshold
+		elif self.size < self.threshold:
+			self.size = min(self.size * 2, self.threshold)
+		else:
+			self.size = min(self.size + 1, self.maximum)
+
+class FileClient():
+	'''
+	Bulk file transfer with a file_server, using windows of chunks with
+	selective acknowledgement so that only lost chunks are sent again.
+	'''
+
+	def __init__(self, client, config, cache=None):
+		self.client = client
+		self.config = config
+		self.chunk_size = max_chunk_size(config.max_read_size)
+		self.cache = cache
+
+	def cache_name(self, remote):
+		''' Name of a remote file in the block cache '''
+		return self.config.tx_host + ':' + str(self.config.tx_port) + '/' + self.config.topic + '/' + remote
+
+	def _request(self, command, data, timeout=None):
+		''' Send a request, retrying if the request or response is lost '''
+		for retries in range(self.config.retries, -1, -1):
+			try:
+				return self.client.request(command, data, timeout)
+			except udp_client.RequestTimeoutError:
+				if not retries:
+					raise
+
+	def _check_progress(self, progress, retries):
+		if progress:
+			return self.config.retries
+		if retries <= 0:
+			raise udp_client.RequestTimeoutError('Transfer stalled')
+		return retries - 1
+
+	def get(self, remote, local):
+		'''
+		Download the remote file to the local path, returns the number of
+		bytes transferred.
+
+		With a block cache, blocks which are cached and still valid (the
+		remote file's modification time and size are unchanged) are not
+		transferred, and when all blocks are cached only a stat is sent.
+		'''
+		client = self.client
+		cache = self.cache
+		if cache is not None:
+			res = self._request('stat', { 'path': remote })
+			size = res['size']
+			cached = cache.validate(self.cache_name(remote), res['mtime_ns'], size, self.chunk_size)
+			if len(cached) == (size + self.chunk_size - 1) // self.chunk_size:
+				with open(local, 'wb') as file:
+					for index in range(len(cached)):
+						block = cache.get(self.cache_name(remote), index * self.chunk_size)
+						if block is None:
+							break
+						file.write(block)
+					else:
+						return size
+		name = 'get-' + secrets.token_urlsafe(6)
+		res = self._request('open', { 'name': name, 'path': remote })
+		size = res['size']
+		try:
+			count = (size + self.chunk_size - 1) // self.chunk_size
+			window = Window(self.config.window, self.config.max_window)
+			retries = self.config.retries
+			received = set()
+			base = 0
+			with open(local, 'wb') as file:
+				file.truncate(size)
+				if cache is not None:
+					# Send the cached blocks as already received
+					for index in cache.validate(self.cache_name(remote), res['mtime_ns'], size, self.chunk_size):
+						block = cache.get(self.cache_name(remote), index * self.chunk_size)
+						if block is not None:
+							file.seek(index * self.chunk_size)
+							file.write(block)
+							received.add(index)
+				while base in received:
+					received.discard(base)
+					base += 1
+				while base < count:
+					n = min(window.size, count - base)
+					expected = n - len([index for index in received if index < base + n])
+					seq = client.send_request('get', {
+						'name': name,
+						'chunk_size': self.chunk_size,
+						'base': base,
+						'count': n,
+						'ack': encode_bitmap(received, base, n)
+					})
+					got = 0
+					for res in client.receive_responses('get', seq, expected):
+						index = res['index']
+						if index in received:
+							continue
+						block = base64.b64decode(bytes(res['data'], 'ascii'))
+						file.seek(index * self.chunk_size)
+						file.write(block)
+						if cache is not None:
+							cache.put(self.cache_name(remote), index * self.chunk_size, block)
+						received.add(index)
+						got += 1
+					window.update(expected, expected - got)
+					retries = self._check_progress(got, retries)
+					while base in received:
+						received.discard(base)
+						base += 1
+		finally:
+			self._request('close', { 'name': name })
+		return size
+
+	def put(self, local, remote):
+		''' Upload the local file to the remote path, returns the number of bytes transferred '''
+		client = self.client
+		name = 'put-' + secrets.token_urlsafe(6)
+		transfer = secrets.token_urlsafe(6)
+		self._request('create', { 'name': name, 'path': remote })
+		try:
+			with open(local, 'rb') as file:
+				size = os.fstat(file.fileno()).st_size
+				count = (size + self.chunk_size - 1) // self.chunk_size
+				window = Window(self.config.window, self.config.max_window)
+				retries = self.config.retries
+				acked = set()
+				base = 0
+				while base < count:
+					n = min(window.size, count - base)
+					pending = [index for index in range(base, base + n) if index not in acked]
+					for index in pending:
+						file.seek(index * self.chunk_size)
+						client.send_request('put', {
+							'name': name,
+							'transfer': transfer,
+							'chunk_size': self.chunk_size,
+							'index': index,
+							'data': str(base64.b64encode(file.read(self.chunk_size)), 'ascii')
+						})
+					try:
+						res = client.request('put_ack', {
+							'name': name,
+							'transfer': transfer,
+							'base': base,
+							'count': n
+						})
+						now = decode_bitmap(res['ack'], base, n)
+					except udp_client.RequestTimeoutError:
+						now = set()
+					got = len(now.difference(acked))
+					acked.update(now)
+					window.update(len(pending), len(pending) - got)
+					retries = self._check_progress(got, retries)
+					while base in acked:
+						acked.discard(base)
+						base += 1
+		finally:
+			self._request('close', { 'name': name })
+		return size
+
+	def sync(self, local, remote):
+		'''
+		Update the remote file to match the local file, sending only the data
+		which is not already in the remote file.  Returns the number of bytes
+		sent literally and the number copied from the remote file.
+		'''
+		client = self.client
+		token = secrets.token_urlsafe(6)
+		basis = 'basis-' + token
+		out = 'sync-' + token
+		temp = remote + '.sync-' + token
+		with open(local, 'rb') as file:
+			data = file.read()
+		try:
+			size = self._request('open', { 'name': basis, 'path': remote })['size']
+		except udp_client.OperationFailedError:
+			# Nothing to patch
+			return (self.put(local, remote), 0)
+		try:
+			block_size = self.config.block_size
+			if block_size is None:
+				block_size = max(512, min(math.isqrt(size), self.chunk_size))
+			weak, strong = self.checksums(basis, block_size)
+			ops = delta(data, block_size, weak, strong)
+			self._request('create', { 'name': out, 'path': temp })
+			try:
+				offset = 0
+				batch = []
+				budget = 0
+				for op in ops:
+					if op[0] == 'copy':
+						batch.append({ 'copy': op[1], 'count': op[2] })
+						budget += 32
+					else:
+						for start in range(op[1], op[2], self.chunk_size):
+							end = min(start + self.chunk_size, op[2])
+							if budget + end - start > self.chunk_size:
+								offset = self._patch(out, basis, block_size, offset, batch)
+								batch, budget = [], 0
+							batch.append({ 'data': str(base64.b64encode(data[start:end]), 'ascii') })
+							budget += end - start
+					if budget > self.chunk_size:
+						offset = self._patch(out, basis, block_size, offset, batch)
+						batch, budget = [], 0
+				offset = self._patch(out, basis, block_size, offset, batch)
+				if offset != len(data):
+					raise udp_client.InvalidResponseError('Patched file has wrong size')
+			finally:
+				self._request('close', { 'name': out })
+		finally:
+			self._request('close', { 'name': basis })
+		self._request('rename', { 'path': temp, 'to': remote })
+		literal = sum(op[2] - op[1] for op in ops if op[0] == 'data')
+		return (literal, len(data) - literal)
+
+	def push(self, local, remote):
+		'''
+		Upload the local file through the remote chunk store, sending only the
+		chunks which the store does not already have.  Returns the number of
+		bytes sent (including any sent again) and the number of bytes which
+		were already in the store.
+		'''
+		client = self.client
+		with open(local, 'rb') as file:
+			data = file.read()
+		chunks = dict()
+		hashes = []
+		for start in range(0, len(data), self.chunk_size):
+			chunk = data[start:start + self.chunk_size]
+			hash = chunk_hash(chunk)
+			chunks[hash] = chunk
+			hashes.append(hash)
+		missing = self._missing_chunks(list(chunks.keys()))
+		stored = len(data) - sum(len(chunks[hash]) for hash in missing)
+		sent = self._upload_chunks(chunks, missing)
+		name = 'push-' + secrets.token_urlsafe(6)
+		temp = remote + '.push-' + secrets.token_urlsafe(6)
+		self._request('create', { 'name': name, 'path': temp })
+		try:
+			# Each hash takes about 70 bytes of a request
+			batch_size = max(1, (self.config.max_read_size - 1024) // 70)
+			offset = 0
+			for start in range(0, len(hashes), batch_size):
+				batch = hashes[start:start + batch_size]
+				for retries in range(self.config.retries, -1, -1):
+					res = self._request('assemble', { 'name': name, 'offset': offset, 'hashes': batch })
+					if not res.get('missing'):
+						break
+					if not retries:
+						raise udp_client.OperationFailedError('Chunks missing from store')
+					# Removed from the store since they were checked
+					sent += self._upload_chunks(chunks, res['missing'])
+				offset = res['offset']
+		finally:
+			self._request('close', { 'name': name })
+		self._request('rename', { 'path': temp, 'to': remote })
+		return (sent, stored)
+
+	def _missing_chunks(self, hashes):
+		''' Ask the chunk store which of the given hashes it does not have '''
+		# Each hash takes about 70 bytes of a request or response
+		batch_size = max(1, (self.config.max_read_size - 1024) // 70)
+		missing = []
+		for start in range(0, len(hashes), batch_size):
+			missing += self._request('have', { 'hashes': hashes[start:start + batch_size] })['missing']
+		return missing
+
+	def _upload_chunks(self, chunks, hashes):
+		''' Send chunks to the chunk store in windows, resending those not stored, returns the number of bytes sent '''
+		window = Window(self.config.window, self.config.max_window)
+		retries = self.config.retries
+		pending = list(hashes)
+		sent = 0
+		while pending:
+			batch = pending[0:window.size]
+			for hash in batch:
+				self.client.send_request('chunk_put', {
+					'hash': hash,
+					'data': str(base64.b64encode(chunks[hash]), 'ascii')
+				})
+				sent += len(chunks[hash])
+			try:
+				lost = set(self._missing_chunks(batch))
+			except udp_client.RequestTimeoutError:
+				lost = set(batch)
+			window.update(len(batch), len(lost))
+			retries = self._check_progress(len(lost) < len(batch), retries)
+			pending = [hash for hash in batch if hash in lost] + pending[len(batch):]
+		return sent
+
+	def resume(self, local, remote):
+		'''
+		Upload the local file in a resumable session: if the transfer is
+		interrupted, uploading the same (unmodified) file to the same path
+		again continues from where it left off.  Returns the number of bytes
+		sent (including any sent again) and the number of bytes which had
+		already been received.
+		'''
+		stat = os.stat(local)
+		key = '\0'.join([os.path.abspath(local), remote, str(stat.st_size), str(stat.st_mtime_ns)])
+		session = chunk_hash(bytes(key, 'utf-8'))[0:32]
+		res = self._request('session_open', { 'session': session, 'path': remote, 'size': stat.st_size })
+		already = res['received']
+		missing = res['missing']
+		window = Window(self.config.window, self.config.max_window)
+		retries = self.config.retries
+		sent = 0
+		with open(local, 'rb') as file:
+			while missing:
+				pieces = []
+				for start, end in missing:
+					for offset in range(start, end, self.chunk_size):
+						pieces.append((offset, min(offset + self.chunk_size, end)))
+				pieces = pieces[0:window.size]
+				for start, end in pieces:
+					self.client.send_request('session_write', {
+						'session': session,
+						'offset': start,
+						'data': str(base64.b64encode(os.pread(file.fileno(), end - start, start)), 'ascii')
+					})
+					sent += end - start
+				try:
+					missing = self.client.request('session_status', { 'session': session })['missing']
+				except udp_client.RequestTimeoutError:
+					pass
+				lost = len([piece for piece in pieces if any(piece[0] < end and start < piece[1] for start, end in missing)])
+				window.update(len(pieces), lost)
+				retries = self._check_progress(lost < len(pieces), retries)
+		self._request('session_commit', { 'session': session })
+		return (sent, already)
+
+	def verify(self, local, remote):
+		''' Compare digests of the local and remote files, returns True if they match '''
+		res = self._request('hash', { 'path': remote }, self.config.hash_timeout)
+		digest = hashlib.new(res['algorithm'])
+		with open(local, 'rb') as file:
+			while True:
+				block = file.read(0x100000)
+				if not block:
+					break
+				digest.update(block)
+		return digest.hexdigest() == res['digest']
+
+	def checksums(self, name, block_size):
+		''' Fetch the block checksums of a remote file '''
+		weak = []
+		strong = []
+		blocks = None
+		while blocks is None or len(weak) < blocks:
+			res = self._request('checksums', { 'name': name, 'block_size': block_size, 'base': len(weak) })
+			blocks = res['blocks']
+			values = base64.b64decode(bytes(res['weak'], 'ascii'))
+			digests = base64.b64decode(bytes(res['strong'], 'ascii'))
+			if not values and len(weak) < blocks:
+				raise udp_client.InvalidResponseError('No checksums in response')
+			weak += struct.unpack('>' + str(len(values) // 4) + 'I', values)
+			strong += [digests[i:i + 8] for i in range(0, len(digests), 8)]
+		return (weak, strong)
+
+	def _patch(self, out, basis, block_size, offset, ops):
+		if not ops:
+			return offset
+		req = {
+			'name': out,
+			'basis': basis,
+			'block_size': block_size,
+			'offset': offset,
+			'ops': ops
+		}
+		return self._request('patch', req)['offset']
+
+#################### DEMO / CLI STUFF COMES BELOW ####################
+
+class Program():
+	def __init__(self, cmdline):
+		# Extract configuration from command line arguments
+		config = Config()
+		try:
+			opts, args = getopt.getopt(cmdline, '', ['tx_host=', 'tx_port=', 'rx_host=', 'rx_port=', 'max_read_size=', 'topic=', 'timeout=', 'window=', 'max_window=', 'retries=', 'block_size=', 'hash_timeout=', 'cache_dir=', 'cache_budget='])
+
+			for opt, val in opts:
+				if opt in ('--tx_host'):
+					config.tx_host = val
+				elif opt in ('--tx_port'):
+					config.tx_port = int(val)
+				elif opt in ('--rx_host'):
+					config.rx_host = val
+				elif opt in ('--rx_port'):
+					config.rx_port = int(val)
+				elif opt in ('--max_read_size'):
+					config.max_read_size = int(val, 0)
+				elif opt in ('--topic'):
+					config.topic = val
+				elif opt in ('--timeout'):
+					config.timeout = float(val)
+				elif opt in ('--window'):
+					config.window = int(val)
+				elif opt in ('--max_window'):
+					config.max_window = int(val)
+				elif opt in ('--retries'):
+					config.retries = int(val)
+				elif opt in ('--block_size'):
+					config.block_size = int(val)
+				elif opt in ('--hash_timeout'):
+					config.hash_timeout = float(val)
+				elif opt in ('--cache_dir'):
+					config.cache_dir = val
+				elif opt in ('--cache_budget'):
+					config.cache_budget = int(val, 0)
+				else:
+					raise AssertionError('Unhandled option: ' + opt)
+			if len(args) != 3 or args[0] not in ('get', 'put', 'sync', 'push', 'resume', 'verify'):
+				raise AssertionError('Expected get <remote> <local>, or put/sync/push/resume/verify <local> <remote>')
+		except (getopt.GetoptError, ValueError, AssertionError) as err:
+			print(err)
+			self.usage(config)
+			sys.exit(1)
+		self.config = config
+		self.args = args
+
+	def run(self):
+		command, source, target = self.args
+		cache = None
+		if self.config.cache_dir is not None:
+			cache = BlockCache(self.config.cache_dir, self.config.cache_budget)
+		with udp_client.Client(self.config) as client:
+			transfer = FileClient(client, self.config, cache)
+			if command == 'verify':
+				if not transfer.verify(source, target):
+					print('Files differ')
+					sys.exit(1)
+				print('Files match')
+				return
+			start = time.time()
+			if command == 'get':
+				size = transfer.get(source, target)
+			elif command == 'put':
+				size = transfer.put(source, target)
+			elif command == 'sync':
+				literal, matched = transfer.sync(source, target)
+				size = literal + matched
+				print('(Sent ' + str(literal) + ' bytes, reused ' + str(matched) + ' bytes of remote file)')
+			elif command == 'push':
+				sent, stored = transfer.push(source, target)
+				size = os.path.getsize(source)
+				print('(Sent ' + str(sent) + ' bytes, ' + str(stored) + ' bytes already in chunk store)')
+			else:
+				sent, received = transfer.resume(source, target)
+				size = os.path.getsize(source)
+				print('(Sent ' + str(sent) + ' bytes, ' + str(received) + ' bytes already received by server)')
+			elapsed = max(time.time() - start, 1e-6)
+			print('(Transferred ' + str(size) + ' bytes in ' + '%.3f' % elapsed + 's, ' + '%.1f' % (size / elapsed / 1024) + ' KiB/s)')
+
+	def usage(self, config):
+		print('Utility for transferring files to/from a file server over UDP.')
+		print('')
+		print('Syntax:')
+		print('')
+		print('  ./file_client.py [options] get <remote-path> <local-path>')
+		print('  ./file_client.py [options] put <local-path> <remote-path>')
+		print('  ./file_client.py [options] sync <local-path> <remote-path>')
+		print('  ./file_client.py [options] push <local-path> <remote-path>')
+		print('  ./file_client.py [options] resume <local-path> <remote-path>')
+		print('  ./file_client.py [options] verify <local-path> <remote-path>')
+		print('')
+		print('                  --tx_host=' + config.tx_host + ' --tx_port=' + str(config.tx_port))
+		print('                  --rx_host=' + config.rx_host + ' --rx_port=' + str(config.rx_port))
+		print('                  --topic=' + config.topic)
+		print('                  --max_read_size=' + hex(config.max_read_size))
+		print('                  --timeout=' + str(config.timeout))
+		print('                  --window=' + str(config.window) + ' --max_window=' + str(config.max_window))
+		print('                  --retries=' + str(config.retries))
+		print('                  --block_size=' + str(config.block_size))
+		print('                  --hash_timeout=' + str(config.hash_timeout))
+		print('                  --cache_dir=' + str(config.cache_dir) + ' --cache_budget=' + hex(config.cache_budget))
+		print('')
+
+if __name__ == '__main__':
+	Program(sys.argv[1:]).run()
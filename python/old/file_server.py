@@ -1,81 +1,798 @@
 #!/usr/bin/python3
 
 import os
+import re
 import sys
+import json
 import time
+import bisect
+import functools
+import mmap
+import zlib
+import heapq
+import struct
 import base64
+import hashlib
+import queue
 import getopt
+import threading
+import collections
+import concurrent.futures
 
 import udp_server
+import workers
+from fair_server import FairServer
+from chunk_store import ChunkStore, InvalidChunkError
+from transfer_journal import TransferJournal, InvalidSessionError
+from watch import Watcher, TooManyWatchesError
+
+# Durability modes of open files: writes are synced to disk never (by the
+# server), when the file is closed, or after every sync_bytes bytes written
+DURABILITY = ('none', 'close', 'bytes')
+
+# Largest block for delta sync (checksums/patch), each being read into memory at once
+MAX_BLOCK_SIZE = 0x1000000
 
 class Config(udp_server.Config):
 	def __init__(self):
 		super(Config, self).__init__()
 		self.topic = 'filesystem'
 		self.quiet = True
+		self.file_timeout = 30
+		self.max_open_files = 256
+		self.mmap_threshold = 0x100000
+		self.chunk_store = None
+		self.chunk_budget = 0x10000000
+		self.readahead = 4
+		self.readahead_budget = 0x800000
+		self.journal_dir = '/var/tmp/file_server_journal'
+		self.journal_ttl = 86400
+		self.watch_interval = 1.0
+		self.watch_poll = 2.0
+		self.watch_ttl = 600
+		self.max_watches = 64
+		self.hash_workers = 2
+		self.hash_cache = 4096
+		self.write_buffer = 0x10000
+		self.write_delay = 0.5
+		self.durability = 'none'
+		self.sync_bytes = 0x100000
+		# Fair scheduling between clients, disabled if the quantum is 0
+		self.quantum = 0x10000
+		self.client_rate = 0
+		self.client_burst = 0x20000
+		self.max_queue = 64
+		self.interactive = 'ping,here,stat'
+
+	options = ['file_timeout=', 'max_open_files=', 'mmap_threshold=', 'chunk_store=', 'chunk_budget=', 'readahead=', 'readahead_budget=', 'journal_dir=', 'journal_ttl=', 'watch_interval=', 'watch_poll=', 'watch_ttl=', 'max_watches=', 'hash_workers=', 'hash_cache=', 'write_buffer=', 'write_delay=', 'durability=', 'sync_bytes=', 'quantum=', 'client_rate=', 'client_burst=', 'max_queue=', 'interactive=']
+
+	def parse_option(self, opt, val):
+		if opt in ('--file_timeout'):
+			self.file_timeout = float(val)
+		elif opt in ('--max_open_files'):
+			self.max_open_files = int(val)
+		elif opt in ('--mmap_threshold'):
+			self.mmap_threshold = int(val, 0)
+		elif opt in ('--chunk_store'):
+			self.chunk_store = val
+		elif opt in ('--chunk_budget'):
+			self.chunk_budget = int(val, 0)
+		elif opt == '--readahead_budget':
+			self.readahead_budget = int(val, 0)
+		elif opt == '--readahead':
+			self.readahead = int(val)
+		elif opt in ('--journal_dir'):
+			self.journal_dir = val
+		elif opt in ('--journal_ttl'):
+			self.journal_ttl = float(val)
+		elif opt in ('--watch_interval'):
+			self.watch_interval = float(val)
+		elif opt in ('--watch_poll'):
+			self.watch_poll = float(val)
+		elif opt in ('--watch_ttl'):
+			self.watch_ttl = float(val)
+		elif opt in ('--max_watches'):
+			self.max_watches = int(val)
+		elif opt in ('--hash_workers'):
+			self.hash_workers = int(val)
+		elif opt in ('--hash_cache'):
+			self.hash_cache = int(val)
+		elif opt in ('--write_buffer'):
+			self.write_buffer = int(val, 0)
+		elif opt in ('--write_delay'):
+			self.write_delay = float(val)
+		elif opt in ('--durability'):
+			if val not in DURABILITY:
+				raise ValueError('Durability must be one of: ' + ', '.join(DURABILITY))
+			self.durability = val
+		elif opt in ('--sync_bytes'):
+			self.sync_bytes = int(val, 0)
+		elif opt in ('--quantum'):
+			self.quantum = int(val, 0)
+		elif opt in ('--client_rate'):
+			self.client_rate = int(val, 0)
+		elif opt in ('--client_burst'):
+			self.client_burst = int(val, 0)
+		elif opt in ('--max_queue'):
+			self.max_queue = int(val)
+		elif opt in ('--interactive'):
+			self.interactive = val
+		else:
+			return False
+		return True
+
+	def show_usage(self):
+		print('                  --file_timeout=' + str(self.file_timeout) + ' --max_open_files=' + str(self.max_open_files))
+		print('                  --mmap_threshold=' + hex(self.mmap_threshold))
+		print('                  --chunk_store=' + str(self.chunk_store) + ' --chunk_budget=' + hex(self.chunk_budget))
+		print('                  --readahead=' + str(self.readahead) + ' --readahead_budget=' + hex(self.readahead_budget))
+		print('                  --journal_dir=' + self.journal_dir + ' --journal_ttl=' + str(self.journal_ttl))
+		print('                  --watch_interval=' + str(self.watch_interval) + ' --watch_poll=' + str(self.watch_poll) + ' --watch_ttl=' + str(self.watch_ttl) + ' --max_watches=' + str(self.max_watches))
+		print('                  --hash_workers=' + str(self.hash_workers) + ' --hash_cache=' + str(self.hash_cache))
+		print('                  --write_buffer=' + hex(self.write_buffer) + ' --write_delay=' + str(self.write_delay))
+		print('                  --durability=' + self.durability + ' (' + '/'.join(DURABILITY) + ') --sync_bytes=' + hex(self.sync_bytes))
+		print('                  --quantum=' + hex(self.quantum) + ' --max_queue=' + str(self.max_queue) + ' --interactive=' + self.interactive)
+		print('                  --client_rate=' + str(self.client_rate) + ' --client_burst=' + hex(self.client_burst))
+
+class ReadAhead():
+	'''
+	Prefetches data for sequential reads.
+
+	When a file is read twice in a row at consecutive offsets, the next
+	"depth" reads of the same length are read by a background thread into
+	memory, so they can be answered without waiting for the disk.  Memory
+	use is bounded by the budget, evicting least-recently-prefetched data.
+
+	Any write discards all prefetched data of the file written, and data
+	which was being prefetched at the time of a write is not kept.
+	'''
+
+	def __init__(self, depth, budget):
+		self.depth = depth
+		self.budget = budget
+		self.lock = threading.Lock()
+		# Prefetched data keyed by (entry, offset, length), oldest first
+		self.data = collections.OrderedDict()
+		self.size = 0
+		# Number of writes to each (device, inode), to discard data
+		# prefetched before a write, kept while any entry has it open
+		self.generations = dict()
+		# Number of open entries of each (device, inode)
+		self.references = dict()
+		self.hits = 0
+		self.misses = 0
+		self.prefetched = 0
+		self.evictions = 0
+		self.jobs = queue.Queue()
+		self.thread = threading.Thread(target=self._worker, name='readahead', daemon=True)
+		self.thread.start()
+
+	def read(self, entry, offset, length):
+		with self.lock:
+			data = self.data.pop((entry, offset, length), None)
+			if data is None:
+				self.misses += 1
+			else:
+				self.hits += 1
+				self.size -= len(data)
+		if data is None:
+			data = os.pread(entry.fd, length, offset)
+		# Detect sequential access and schedule prefetching
+		generation = self.generations.get(entry.inode, 0)
+		if offset != entry.next_offset or generation != entry.prefetch_generation:
+			entry.prefetch_offset = 0
+			entry.prefetch_generation = generation
+		elif len(data) == length:
+			end = offset + len(data)
+			start = max(end, entry.prefetch_offset)
+			entry.prefetch_offset = end + self.depth * length
+			for prefetch in range(start, entry.prefetch_offset, length):
+				self.jobs.put((entry, prefetch, length, generation))
+		entry.next_offset = offset + len(data)
+		return data
+
+	def invalidate(self, key):
+		''' Discard prefetched data of files with the given (device, inode) '''
+		with self.lock:
+			if key in self.references:
+				self.generations[key] = self.generations.get(key, 0) + 1
+			for item in [item for item in self.data.keys() if item[0].inode == key]:
+				self.size -= len(self.data.pop(item))
+
+	def open(self, entry):
+		''' Register an open file, until it is discarded '''
+		with self.lock:
+			self.references[entry.inode] = self.references.get(entry.inode, 0) + 1
+
+	def discard(self, entry):
+		''' Discard prefetched data of a closed file '''
+		with self.lock:
+			for item in [item for item in self.data.keys() if item[0] is entry]:
+				self.size -= len(self.data.pop(item))
+			self.references[entry.inode] -= 1
+			if not self.references[entry.inode]:
+				del self.references[entry.inode]
+				self.generations.pop(entry.inode, None)
+
+	def _worker(self):
+		while True:
+			entry, offset, length, generation = self.jobs.get()
+			with entry.lock:
+				if entry.closed or generation != self.generations.get(entry.inode, 0):
+					continue
+				try:
+					data = os.pread(entry.fd, length, offset)
+				except OSError:
+					continue
+			if not data:
+				continue
+			with self.lock:
+				if entry.closed or generation != self.generations.get(entry.inode, 0):
+					continue
+				self.data[(entry, offset, length)] = data
+				self.size += len(data)
+				self.prefetched += 1
+				while self.size > self.budget:
+					item, evicted = self.data.popitem(last=False)
+					self.size -= len(evicted)
+					self.evictions += 1
+
+	def summary(self):
+		with self.lock:
+			return {
+				'depth': self.depth,
+				'memory': self.size,
+				'budget': self.budget,
+				'hits': self.hits,
+				'misses': self.misses,
+				'hit_rate': self.hits / (self.hits + self.misses) if self.hits + self.misses else None,
+				'prefetched': self.prefetched,
+				'evictions': self.evictions
+			}
 
 class FileCacheEntry():
-	file = None
+	'''
+	An open file, accessed with positional I/O (pread/pwrite) so the file
+	descriptor carries no seek state: the "position" used by reads and
+	writes without an offset is kept here instead.
+
+	Files of at least mmap_threshold bytes are read through a read-only
+	mapping, returning slices of it without copying.  Other files are read
+	through the ReadAhead, if given.
+
+	Writes smaller than write_buffer bytes are held back, and adjacent ones
+	merged, until the buffer fills, a write elsewhere or any other access
+	to the file, or write_delay seconds pass (see FileCache.prune).  Errors
+	writing back are raised by the access which flushed.  Durability sets
+	when written data is synced to disk, as in DURABILITY.
+	'''
+	key = None
+	fd = None
+	inode = None
+	position = 0
+	map = None
+	mmap_threshold = None
+	readahead = None
+	next_offset = None
+	prefetch_offset = 0
+	prefetch_generation = 0
+	closed = False
 	timeout = None
 	deadline = None
+	write_buffer = 0
+	durability = 'none'
+	sync_bytes = None
+	pending = None
+	pending_offset = 0
+	pending_since = None
+	# End of the furthest data written back to the file, and synced to disk
+	flushed = 0
+	synced = 0
+	unsynced = 0
 
-	def __init__(self, file, timeout):
-		self.file = file
+	def __init__(self, key, fd, timeout, mmap_threshold=None, readahead=None, write_buffer=0, durability='none', sync_bytes=None):
+		self.key = key
+		self.fd = fd
+		stat = os.fstat(fd)
+		self.inode = (stat.st_dev, stat.st_ino)
 		self.timeout = timeout
+		self.mmap_threshold = mmap_threshold
+		self.readahead = readahead
+		self.write_buffer = write_buffer
+		self.durability = durability
+		self.sync_bytes = sync_bytes
+		self.pending = bytearray()
+		# Held while reading in the background, so the file is not closed meanwhile
+		self.lock = threading.Lock()
+		if readahead is not None:
+			readahead.open(self)
 		self.kick()
 
 	def kick(self):
 		self.deadline = time.time() + self.timeout
 
+	def read(self, offset, length):
+		''' Read up to length bytes at offset, returns a bytes-like object '''
+		self.flush()
+		size = os.fstat(self.fd).st_size
+		if self.map is not None and len(self.map) != size:
+			# File was resized since it was mapped
+			self._unmap()
+		# Empty files cannot be mapped
+		if self.map is None and self.mmap_threshold is not None and size >= self.mmap_threshold and size > 0:
+			self.map = mmap.mmap(self.fd, 0, access=mmap.ACCESS_READ)
+		if self.map is not None:
+			return memoryview(self.map)[offset:offset + length]
+		if self.readahead is not None:
+			return self.readahead.read(self, offset, length)
+		return os.pread(self.fd, length, offset)
+
+	def write(self, offset, data):
+		''' Write data at offset, returns the number of bytes written (or buffered) '''
+		if self.pending and offset == self.pending_offset + len(self.pending):
+			self.pending += data
+			if len(self.pending) >= self.write_buffer:
+				self.flush()
+			return len(data)
+		self.flush()
+		if len(data) < self.write_buffer:
+			self.pending += data
+			self.pending_offset = offset
+			self.pending_since = time.time()
+			return len(data)
+		return self._write(offset, data)
+
+	def _write(self, offset, data):
+		if self.readahead is not None:
+			self.readahead.invalidate(self.inode)
+		length = 0
+		with memoryview(data) as view:
+			while length < len(view):
+				# pwrite may write less than asked, e.g. when interrupted
+				count = os.pwrite(self.fd, view[length:], offset + length)
+				if count == 0:
+					raise OSError('Nothing written')
+				length += count
+		self.flushed = max(self.flushed, offset + length)
+		self.unsynced += length
+		if self.durability == 'bytes' and self.unsynced >= self.sync_bytes:
+			self.sync()
+		return length
+
+	def flush(self):
+		''' Write back buffered writes '''
+		if self.pending:
+			self._write(self.pending_offset, self.pending)
+			self.pending = bytearray()
+
+	def sync(self):
+		''' Sync written data to disk '''
+		if self.unsynced:
+			os.fdatasync(self.fd)
+			self.unsynced = 0
+		self.synced = self.flushed
+
+	def _unmap(self):
+		try:
+			self.map.close()
+		except BufferError:
+			# Slices are still referenced, the mapping is closed once they are released
+			pass
+		self.map = None
+
+	def close(self):
+		try:
+			self.flush()
+			if self.durability != 'none':
+				self.sync()
+		finally:
+			with self.lock:
+				self.closed = True
+				if self.map is not None:
+					self._unmap()
+				os.close(self.fd)
+			if self.readahead is not None:
+				self.readahead.discard(self)
+
 class FileCache():
-	files = dict()
+	'''
+	Open files, keyed by (client, name).
+
+	Files are closed when unused for longer than the timeout, or when the
+	number of open files exceeds the capacity (least-recently-used first).
+
+	Expiry uses a min-heap of (deadline, sequence, entry).  Kicking an entry
+	does not touch the heap: when a stale heap item is popped, it is pushed
+	again with the entry's current deadline, so pruning costs O(expired).
+
+	Entries with buffered writes are kept in dirty, so that pruning can
+	write them back once they are write_delay seconds old.
+	'''
 
-	def __init__(self, timeout):
+	def __init__(self, timeout, capacity=None, mmap_threshold=None, readahead=None, write_buffer=0, write_delay=0):
 		self.timeout = timeout
+		self.capacity = capacity
+		self.mmap_threshold = mmap_threshold
+		self.readahead = readahead
+		self.write_buffer = write_buffer
+		self.write_delay = write_delay
+		self.dirty = set()
+		# Ordered by least-recently-used first
+		self.files = collections.OrderedDict()
+		# Names of open files for each client
+		self.clients = dict()
+		self.heap = []
+		self.heap_seq = 0
+		self.hits = 0
+		self.misses = 0
+		self.evictions = 0
+		self.expirations = 0
 
-	def _set(self, key, value):
-		prev = self.files.get(key)
-		if prev is not None:
-			prev.file.close()
-			del self.files[key]
+	def _push(self, entry):
+		self.heap_seq += 1
+		heapq.heappush(self.heap, (entry.deadline, self.heap_seq, entry))
+
+	def _remove(self, key, report=False):
+		''' Close an entry, raising errors writing it back if report is set, otherwise only printing them '''
+		entry = self.files.pop(key)
+		self.dirty.discard(entry)
+		names = self.clients[key[0]]
+		names.discard(key[1])
+		if not names:
+			del self.clients[key[0]]
+		# Drop heap items of closed entries once they dominate the heap
+		if len(self.heap) > 2 * len(self.files) + 64:
+			self.heap = [item for item in self.heap if self.files.get(item[2].key) is item[2]]
+			heapq.heapify(self.heap)
+		try:
+			entry.close()
+		except OSError as err:
+			if report:
+				raise
+			print('Error: Failed to write back file "' + str(key[1]) + '": ' + str(err))
+
+	def _set(self, key, value, durability='none', sync_bytes=None):
+		if key in self.files:
+			self._remove(key)
 		if value is not None:
-			entry = FileCacheEntry(value, self.timeout)
+			if self.capacity is not None:
+				while self.files and len(self.files) >= self.capacity:
+					self._remove(next(iter(self.files)))
+					self.evictions += 1
+			entry = FileCacheEntry(key, value, self.timeout, self.mmap_threshold, self.readahead, self.write_buffer, durability, sync_bytes)
 			self.files[key] = entry
+			self.clients.setdefault(key[0], set()).add(key[1])
+			self._push(entry)
 
 	def close(self, client, name):
-		self._set((client, name), None)
+		if (client, name) in self.files:
+			self._remove((client, name), True)
+
+	def open(self, client, name, path, dir_fd=None, durability='none', sync_bytes=None):
+		fd = os.open(path, os.O_RDWR | os.O_CLOEXEC, dir_fd=dir_fd)
+		self._set((client, name), fd, durability, sync_bytes)
+		return self.files[(client, name)]
+
+	def create(self, client, name, path, dir_fd=None, durability='none', sync_bytes=None):
+		fd = os.open(path, os.O_RDWR | os.O_CREAT | os.O_TRUNC | os.O_CLOEXEC, 0o666, dir_fd=dir_fd)
+		self._set((client, name), fd, durability, sync_bytes)
+		return self.files[(client, name)]
+
+	def flush(self, entry):
+		''' Write back an entry's buffered writes '''
+		self.dirty.discard(entry)
+		entry.flush()
 
-	def open(self, client, name, path):
-		file = open(path, "rb+")
-		self._set((client, name), file)
-		return file
+	def written(self, entry):
+		''' Note that an entry was written, which may have left writes buffered '''
+		if entry.pending:
+			self.dirty.add(entry)
+		else:
+			self.dirty.discard(entry)
 
-	def create(self, client, name, path):
-		file = open(path, "wb+")
-		self._set((client, name), file)
-		return file
+	def next_flush(self):
+		''' Seconds until buffered writes are next due to be written back, or None if there are none '''
+		pending = [entry.pending_since for entry in self.dirty if entry.pending]
+		if not pending:
+			return None
+		return max(0, min(pending) + self.write_delay - time.time())
 
 	def get(self, client, name):
-		entry = self.files[(client, name)]
+		key = (client, name)
+		entry = self.files.get(key)
+		if entry is None:
+			self.misses += 1
+			raise KeyError(name)
+		self.hits += 1
+		self.files.move_to_end(key)
 		entry.kick()
-		return entry.file
+		return entry
+
+	def names(self, client):
+		return sorted(self.clients.get(client, ()))
 
 	def prune(self):
-		deadline = time.time()
-		to_remove = []
-		for key, value in self.files.items():
-			if value.deadline < deadline:
-				value.file.close()
-				to_remove.append(key)
-		for key in to_remove:
-			del self.files[key]
+		now = time.time()
+		for entry in list(self.dirty):
+			if not entry.pending:
+				self.dirty.discard(entry)
+			elif entry.pending_since + self.write_delay <= now:
+				self.dirty.discard(entry)
+				try:
+					entry.flush()
+				except OSError as err:
+					print('Error: Failed to write back file "' + str(entry.key[1]) + '": ' + str(err))
+		heap = self.heap
+		while heap and heap[0][0] < now:
+			deadline, seq, entry = heapq.heappop(heap)
+			if self.files.get(entry.key) is not entry:
+				# Closed or replaced since this item was pushed
+				continue
+			if entry.deadline >= now:
+				# Kicked since this item was pushed
+				self._push(entry)
+				continue
+			self._remove(entry.key)
+			self.expirations += 1
+
+	def summary(self):
+		return {
+			'open': len(self.files),
+			'capacity': self.capacity,
+			'hits': self.hits,
+			'misses': self.misses,
+			'evictions': self.evictions,
+			'expirations': self.expirations,
+			'dirty': len(self.dirty)
+		}
+
+class ContentHasher():
+	'''
+	Digests of files (or byte ranges of them), computed by worker threads so
+	that the server keeps handling requests meanwhile.
+
+	Results are cached by (device, inode, mtime, size) of the file along with
+	the range and algorithm, so hashing an unchanged file again costs one
+	fstat.  Requests for a digest which is already being computed share the
+	result.
+	'''
+
+	block_size = 0x100000
+
+	def __init__(self, workers, capacity):
+		self.capacity = capacity
+		self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=workers, thread_name_prefix='hash')
+		self.lock = threading.Lock()
+		self.digests = collections.OrderedDict()
+		self.pending = dict()
+		self.hits = 0
+		self.misses = 0
+		self.bytes = 0
+
+	def hash(self, fd, offset, length, algorithm):
+		'''
+		Return a future for the digest of [offset, offset + length) of the
+		file (to its end if length is None).  The file descriptor is
+		duplicated, so it may be closed once this returns.
+		'''
+		st = os.fstat(fd)
+		if offset < 0 or offset > st.st_size:
+			raise udp_server.RejectRequest('Offset outside of file')
+		if length is None or offset + length > st.st_size:
+			length = st.st_size - offset
+		key = (st.st_dev, st.st_ino, st.st_mtime_ns, st.st_size, offset, length, algorithm)
+		with self.lock:
+			res = self.digests.get(key)
+			if res is not None:
+				self.hits += 1
+				self.digests.move_to_end(key)
+				future = concurrent.futures.Future()
+				future.set_result(dict(res, cached=True))
+				return future
+			self.misses += 1
+			future = self.pending.get(key)
+			if future is not None:
+				return future
+			future = self.executor.submit(self._worker, os.dup(fd), key)
+			self.pending[key] = future
+			return future
+
+	def _worker(self, fd, key):
+		(dev, ino, mtime, size, offset, length, algorithm) = key
+		try:
+			digest = hashlib.new(algorithm)
+			buf = bytearray(min(self.block_size, max(length, 1)))
+			view = memoryview(buf)
+			end = offset + length
+			while offset < end:
+				count = os.preadv(fd, [view[0:min(len(buf), end - offset)]], offset)
+				if count == 0:
+					break
+				# Large updates release the GIL while hashing
+				digest.update(view[0:count])
+				offset += count
+				self.bytes += count
+			st = os.fstat(fd)
+		finally:
+			os.close(fd)
+			with self.lock:
+				self.pending.pop(key, None)
+		res = {
+			'algorithm': algorithm,
+			'digest': digest.hexdigest(),
+			'offset': key[4],
+			'length': length,
+			'size': size
+		}
+		# Only cache a digest if the file was not modified while it was read
+		if (st.st_mtime_ns, st.st_size) == (mtime, size) and offset == end:
+			with self.lock:
+				self.digests[key] = res
+				while len(self.digests) > self.capacity:
+					self.digests.popitem(last=False)
+		return dict(res, cached=False)
+
+	def summary(self):
+		return {
+			'digests': len(self.digests),
+			'capacity': self.capacity,
+			'pending': len(self.pending),
+			'hits': self.hits,
+			'misses': self.misses,
+			'bytes': self.bytes
+		}
+
+def encode_bitmap(indexes, base, count):
+	''' Encode which of chunks [base, base + count) are in indexes, as base64 (LSB first) '''
+	bitmap = bytearray((count + 7) // 8)
+	for index in indexes:
+		if base <= index < base + count:
+			bit = index - base
+			bitmap[bit >> 3] |= 1 << (bit & 7)
+	return str(base64.b64encode(bitmap), 'ascii')
+
+def decode_bitmap(data, base, count):
+	''' Decode a bitmap from encode_bitmap to a set of chunk indexes '''
+	bitmap = base64.b64decode(bytes(data, 'ascii'))
+	return set(base + bit for bit in range(min(count, len(bitmap) * 8)) if bitmap[bit >> 3] & (1 << (bit & 7)))
+
+def max_chunk_size(max_read_size):
+	''' Largest chunk which fits in one datagram once base64-encoded with its JSON envelope '''
+	return (max_read_size - 1024) * 3 // 4
+
+def weak_checksum(data):
+	''' Rolling checksum of a block for delta sync (Adler-32) '''
+	return zlib.adler32(data)
+
+def strong_checksum(data):
+	''' Strong checksum of a block for delta sync '''
+	return hashlib.blake2b(data, digest_size=8).digest()
+
+@functools.lru_cache(maxsize=64)
+def compile_filter(pattern):
+	return re.compile(pattern)
+
+def file_type(entry):
+	''' Type of a directory entry, without following symbolic links '''
+	if entry.is_symlink():
+		return 'link'
+	if entry.is_dir(follow_symlinks=False):
+		return 'dir'
+	if entry.is_file(follow_symlinks=False):
+		return 'file'
+	return 'other'
+
+class Directory():
+	path = None
+	fd = None
+	inode = None
+	refs = 0
+
+	def __init__(self, path, fd):
+		self.path = path
+		self.fd = fd
+		stat = os.fstat(fd)
+		self.inode = (stat.st_dev, stat.st_ino)
+
+class DirectoryCache():
+	'''
+	Working directories held as open directory descriptors, keyed by
+	canonical path and shared between all clients in the same directory.
+
+	Paths relative to a working directory are resolved with the dir_fd=
+	variants of the os functions, so the process working directory is never
+	changed.  Resolved (directory, relative path) pairs are remembered, so
+	entering a directory which is already open costs one stat, to check
+	that the path still refers to it (it may have been renamed, and
+	another directory created in its place).
+	'''
+
+	def __init__(self, max_resolved=1024):
+		self.lock = threading.Lock()
+		self.dirs = dict()
+		self.resolved = collections.OrderedDict()
+		self.max_resolved = max_resolved
+
+	def acquire(self, path, base=None):
+		''' Open the directory at path (relative to base, if given) and add a reference to it '''
+		with self.lock:
+			key = (None if base is None else base.path, path)
+			resolved = self.resolved.get(key)
+			if resolved is not None and resolved in self.dirs:
+				dir = self.dirs[resolved]
+				try:
+					stat = os.stat(path, dir_fd=None if base is None else base.fd)
+					current = (stat.st_dev, stat.st_ino) == dir.inode
+				except OSError:
+					current = False
+				if current:
+					self.resolved.move_to_end(key)
+					dir.refs += 1
+					return dir
+				del self.resolved[key]
+			fd = os.open(path, os.O_RDONLY | os.O_DIRECTORY, dir_fd=None if base is None else base.fd)
+			try:
+				resolved = os.readlink('/proc/self/fd/' + str(fd))
+			except OSError:
+				resolved = os.path.normpath(os.path.join(os.getcwd() if base is None else base.path, path))
+			try:
+				dir = Directory(resolved, fd)
+			except OSError:
+				os.close(fd)
+				raise
+			existing = self.dirs.get(resolved)
+			if existing is not None and existing.inode == dir.inode:
+				os.close(fd)
+				dir = existing
+			else:
+				# A directory which was renamed keeps its old path, but is
+				# no longer shared
+				self.dirs[resolved] = dir
+			dir.refs += 1
+			self.resolved[key] = resolved
+			if len(self.resolved) > self.max_resolved:
+				self.resolved.popitem(last=False)
+			return dir
+
+	def release(self, dir):
+		''' Remove a reference to a directory, closing it when no longer used '''
+		with self.lock:
+			dir.refs -= 1
+			if dir.refs <= 0:
+				if self.dirs.get(dir.path) is dir:
+					del self.dirs[dir.path]
+				os.close(dir.fd)
 
 class FileSystemService():
-	file_cache = FileCache(30)
-	cwds = dict()
+	file_cache = None
+	dir_cache = None
+	chunk_store = None
+	journal = None
+	watcher = None
+	hasher = None
+	cwds = None
 	initial_cwd = None
 
-	def __init__(self):
+	def __init__(self, config=None):
+		if config is None:
+			config = Config()
+		self.config = config
+		readahead = None
+		if config.readahead > 0:
+			readahead = ReadAhead(config.readahead, config.readahead_budget)
+		self.file_cache = FileCache(config.file_timeout, config.max_open_files, config.mmap_threshold, readahead, config.write_buffer, config.write_delay)
+		if config.chunk_store is not None:
+			self.chunk_store = ChunkStore(config.chunk_store, config.chunk_budget)
+		self.journal = TransferJournal(config.journal_dir, config.file_timeout, config.journal_ttl)
+		self.watcher = Watcher(config.watch_interval, config.watch_poll, config.watch_ttl, max_size=config.max_read_size - 1024, max_watches=config.max_watches)
+		self.hasher = ContentHasher(config.hash_workers, config.hash_cache)
+		self.cwds = dict()
+		# Chunks received for windowed uploads, keyed by (client, name)
+		self.transfers = dict()
+		# Sorted directory listings keyed by (device, inode), valid while the
+		# directory's modification time is unchanged
+		self.listings = collections.OrderedDict()
+		self.max_listings = 64
 		self.commands = {
 			'ping': self.ping,
 			'here': self.here,
@@ -86,12 +803,32 @@ class FileSystemService():
 			'close': self.close,
 			'read': self.read,
 			'write': self.write,
+			'get': self.get,
+			'put': self.put,
+			'put_ack': self.put_ack,
+			'checksums': self.checksums,
+			'patch': self.patch,
+			'rename': self.rename,
+			'have': self.have,
+			'chunk_put': self.chunk_put,
+			'assemble': self.assemble,
+			'session_open': self.session_open,
+			'session_write': self.session_write,
+			'session_status': self.session_status,
+			'session_commit': self.session_commit,
+			'session_abort': self.session_abort,
+			'watch': self.watch,
+			'unwatch': self.unwatch,
+			'hash': self.hash,
+			'flush': self.flush,
 			'seek': self.seek,
 			'tell': self.tell,
 			'stat': self.stat,
+			'cache': self.cache,
 			'help': self.help,
 		}
-		self.initial_cwd = os.getcwd()
+		self.dir_cache = DirectoryCache()
+		self.initial_cwd = self.dir_cache.acquire(os.getcwd())
 
 	def ping(self, data, client):
 		if data == 'help':
@@ -100,23 +837,22 @@ class FileSystemService():
 			}
 		return 'pong'
 
-	def switch_to_client(self, client):
+	def client_dir(self, client):
+		''' Working directory of the given client '''
 		cwd = self.cwds.get(client)
 		if cwd is None:
-			cwd = self.initial_cwd
-			self.cwds[client] = cwd
-		os.chdir(cwd)
+			return self.initial_cwd
+		return cwd
 
 	def here(self, data, client):
 		if data == 'help':
 			return {
 				'help': 'Show state information including current working directory and currently open files'
 			}
-		self.switch_to_client(client)
-		cwd = os.getcwd()
-		files = [key[1] for key in self.file_cache.files.keys() if key[0] == client]
+		cwd = self.client_dir(client)
+		files = self.file_cache.names(client)
 		return {
-			'path': cwd,
+			'path': cwd.path,
 			'files': files
 		}
 
@@ -125,52 +861,119 @@ class FileSystemService():
 			return {
 				'help': 'Change the current working directory, to the given "path" which may be absolute or relative to the current working directory'
 			}
-		self.switch_to_client(client)
-		os.chdir(data['path'])
-		self.cwds[client] = os.getcwd()
+		cwd = self.client_dir(client)
+		self.cwds[client] = self.dir_cache.acquire(data['path'], cwd)
+		if cwd is not self.initial_cwd:
+			self.dir_cache.release(cwd)
 		return self.here(data, client)
 
+	def listing(self, fd):
+		''' Sorted names and types of the entries of an open directory '''
+		stat = os.fstat(fd)
+		key = (stat.st_dev, stat.st_ino)
+		stamp = (stat.st_mtime_ns, stat.st_ctime_ns)
+		listing = self.listings.get(key)
+		if listing is not None and listing[0] == stamp:
+			self.listings.move_to_end(key)
+			return listing[1]
+		# scandir closes the descriptor it is given
+		with os.scandir(os.dup(fd)) as entries:
+			items = sorted((entry.name, file_type(entry)) for entry in entries)
+		self.listings[key] = (stamp, items)
+		if len(self.listings) > self.max_listings:
+			self.listings.popitem(last=False)
+		return items
+
 	def list(self, data, client):
 		if data == 'help':
 			return {
-				'help': 'List contents of the current working directory or a given "path" if specified.  Optionally "filter" using a Python regular expression.'
+				'help': 'List contents of the current working directory or a given "path" if specified, sorted by name.  Optionally "filter" using a Python regular expression.  If "stat" is true, each item is an object with the "name", "type", "size", "mtime" and "mode" of the entry.  If not all items fit in one response, a "cursor" is returned which may be given to continue the listing.'
 			}
-		self.switch_to_client(client)
+		cwd = self.client_dir(client)
 		filter = data.get('filter')
-		if filter is None:
-			filter = lambda x: True
+		if filter is not None:
+			try:
+				rx = compile_filter(filter)
+			except re.error as err:
+				raise udp_server.RejectRequest('Invalid filter: ' + str(err))
+		path = data.get('path')
+		if path is None:
+			fd = cwd.fd
 		else:
-			rx = re.compile(filter)
-			filter = lambda x: rx.fullmatch(x)
+			fd = os.open(path, os.O_RDONLY | os.O_DIRECTORY, dir_fd=cwd.fd)
+		try:
+			items = self.listing(fd)
+			cursor = data.get('cursor')
+			start = 0 if cursor is None else bisect.bisect_right(items, (cursor, '~'))
+			budget = self.config.max_read_size - 1024
+			result = []
+			cursor = None
+			for index in range(start, len(items)):
+				name, type = items[index]
+				if filter is not None and not rx.fullmatch(name):
+					continue
+				if data.get('stat'):
+					try:
+						stat = os.stat(name, dir_fd=fd, follow_symlinks=False)
+					except FileNotFoundError:
+						# Removed since it was listed
+						continue
+					item = {
+						'name': name,
+						'type': type,
+						'size': stat.st_size,
+						'mtime': stat.st_mtime,
+						'mode': stat.st_mode
+					}
+				else:
+					item = name
+				budget -= len(json.dumps(item)) + 2
+				if budget < 0 and result:
+					# Continue after the last name returned (at least one is
+					# returned, even if it is too long for the budget)
+					cursor = items[index - 1][0]
+					break
+				result.append(item)
+		finally:
+			if fd != cwd.fd:
+				os.close(fd)
 		return {
-			'list': [item for item in os.listdir(data.get('path')) if filter(item)]
+			'list': result,
+			'cursor': cursor
 		}
 
 	def open(self, data, client):
 		if data == 'help':
 			return {
-				'help': 'Open an existing file for read/write located at the given "path", identifying with the given "name"'
+				'help': 'Open an existing file for read/write located at the given "path", identifying with the given "name".  Written data is synced to disk according to "durability": "none", on "close", or every "sync_bytes" "bytes".'
 			}
-		self.switch_to_client(client)
-		self.file_cache.open(client, data['name'], data['path'])
+		self.file_cache.open(client, data['name'], data['path'], self.client_dir(client).fd, *self.durability(data))
 		return self.stat(data, client)
 
 	def create(self, data, client):
 		if data == 'help':
 			return {
-				'help': 'Create/overwrite a file for read/write located at the given "path", identifying with the given "name"'
+				'help': 'Create/overwrite a file for read/write located at the given "path", identifying with the given "name".  Accepts "durability" and "sync_bytes" as for open.'
 			}
-		self.switch_to_client(client)
-		self.file_cache.create(client, data['name'], data['path'])
+		self.file_cache.create(client, data['name'], data['path'], self.client_dir(client).fd, *self.durability(data))
 		return self.stat(data, client)
 
+	def durability(self, data):
+		durability = data.get('durability', self.config.durability)
+		if durability not in DURABILITY:
+			raise udp_server.RejectRequest('Durability must be one of: ' + ', '.join(DURABILITY))
+		sync_bytes = int(data.get('sync_bytes', self.config.sync_bytes))
+		if sync_bytes <= 0:
+			raise udp_server.RejectRequest('Invalid sync interval')
+		return (durability, sync_bytes)
+
 	def close(self, data, client):
 		if data == 'help':
 			return {
 				'help': 'Close an open file with the given "name"'
 			}
-		self.switch_to_client(client)
 		self.file_cache.close(client, data['name'])
+		self.transfers.pop((client, data['name']), None)
 		return {
 			'closed': data['name']
 		}
@@ -180,12 +983,17 @@ class FileSystemService():
 			return {
 				'help': 'Read "length" bytes from a previously-opened file with the given "name", returning the base64-encoded "data" which was read.'
 			}
-		self.switch_to_client(client)
 		file = self.file_cache.get(client, data['name'])
 		offset = data.get('offset')
-		if offset is not None:
-			file.seek(offset)
-		data = str(base64.b64encode(file.read(data['length'])), 'ascii')
+		if offset is None:
+			offset = file.position
+		offset = int(offset)
+		length = int(data['length'])
+		if offset < 0 or length < 0:
+			raise udp_server.RejectRequest('Invalid range')
+		chunk = file.read(offset, length)
+		file.position = offset + len(chunk)
+		data = str(base64.b64encode(chunk), 'ascii')
 		return {
 			'data': data
 		}
@@ -193,35 +1001,381 @@ class FileSystemService():
 	def write(self, data, client):
 		if data == 'help':
 			return {
-				'help': 'Write the given base64-encoded "data" to a previously-opened file with the given "name", returning the actual "length" of data written.'
+				'help': 'Write the given base64-encoded "data" to a previously-opened file with the given "name", returning the actual "length" of data written and the "flushed" offset (see flush).  Small writes are buffered and merged with adjacent writes before being written back.'
 			}
-		self.switch_to_client(client)
 		file = self.file_cache.get(client, data['name'])
 		offset = data.get('offset')
-		if offset is not None:
-			file.seek(offset)
-		data = base64.b64decode(bytes(data['data'], 'ascii'))
+		if offset is None:
+			offset = file.position
+		length = file.write(offset, base64.b64decode(bytes(data['data'], 'ascii')))
+		self.file_cache.written(file)
+		file.position = offset + length
+		return {
+			'length': length,
+			'flushed': file.flushed
+		}
+
+	def flush(self, data, client):
+		if data == 'help':
+			return {
+				'help': 'Write back buffered writes to a previously-opened file with the given "name", and sync them to disk unless its durability is "none" (or if "sync" is given).  Returns the "flushed" and "synced" offsets: the end of the furthest data written back, and synced to disk.'
+			}
+		file = self.file_cache.get(client, data['name'])
+		self.file_cache.flush(file)
+		if data.get('sync', file.durability != 'none'):
+			file.sync()
+		return {
+			'flushed': file.flushed,
+			'synced': file.synced
+		}
+
+	def chunk_size(self, data):
+		chunk_size = int(data['chunk_size'])
+		if chunk_size <= 0 or chunk_size > max_chunk_size(self.config.max_read_size):
+			raise udp_server.RejectRequest('Invalid chunk size')
+		return chunk_size
+
+	def block_size(self, data):
+		block_size = int(data['block_size'])
+		if block_size <= 0 or block_size > MAX_BLOCK_SIZE:
+			raise udp_server.RejectRequest('Invalid block size')
+		return block_size
+
+	def get(self, data, client):
+		if data == 'help':
+			return {
+				'help': 'Stream chunks of "chunk_size" bytes from a previously-opened file with the given "name", one response per chunk.  Chunks "base" to "base" + "count" are sent, except those marked in the base64 "ack" bitmap (LSB first) as already received.  Each response has the chunk "index" and base64-encoded "data".'
+			}
+		file = self.file_cache.get(client, data['name'])
+		chunk_size = self.chunk_size(data)
+		base = int(data.get('base', 0))
+		count = int(data['count'])
+		ack = data.get('ack')
+		received = set() if ack is None else decode_bitmap(ack, base, count)
+		def chunks():
+			for index in range(base, base + count):
+				if index in received:
+					continue
+				chunk = file.read(index * chunk_size, chunk_size)
+				if not chunk:
+					break
+				yield {
+					'index': index,
+					'data': str(base64.b64encode(chunk), 'ascii')
+				}
+		return udp_server.Stream(chunks())
+
+	def put(self, data, client):
+		if data == 'help':
+			return {
+				'help': 'Write chunk "index" of "chunk_size" bytes (base64-encoded "data") to a previously-opened file with the given "name", as part of upload "transfer".  No response is sent: use put_ack to find which chunks were received.'
+			}
+		file = self.file_cache.get(client, data['name'])
+		chunk_size = self.chunk_size(data)
+		index = int(data['index'])
+		transfer = self.transfers.get((client, data['name']))
+		if transfer is None or transfer[0] != data['transfer']:
+			transfer = (data['transfer'], set())
+			self.transfers[(client, data['name'])] = transfer
+		file.write(index * chunk_size, base64.b64decode(bytes(data['data'], 'ascii')))
+		self.file_cache.written(file)
+		transfer[1].add(index)
+		return udp_server.Stream(())
+
+	def put_ack(self, data, client):
+		if data == 'help':
+			return {
+				'help': 'Return a base64 "ack" bitmap (LSB first) of which chunks "base" to "base" + "count" of upload "transfer" to the file with the given "name" have been received.'
+			}
+		file = self.file_cache.get(client, data['name'])
+		# Report errors writing back before acknowledging
+		self.file_cache.flush(file)
+		base = int(data.get('base', 0))
+		count = int(data['count'])
+		transfer = self.transfers.get((client, data['name']))
+		if transfer is None or transfer[0] != data['transfer']:
+			received = set()
+		else:
+			received = transfer[1]
+			# Chunks before the window have been acknowledged, forget them
+			received.difference_update([index for index in received if index < base])
+		return {
+			'ack': encode_bitmap(received, base, count)
+		}
+
+	def checksums(self, data, client):
+		if data == 'help':
+			return {
+				'help': 'Return checksums of the "block_size"-byte blocks of a previously-opened file with the given "name", starting at block "base" (up to "count" blocks, or as many as fit in one response).  Returns the file "size", total number of "blocks", and base64-encoded "weak" (big-endian 32-bit Adler-32) and "strong" (8-byte BLAKE2b) checksums.'
+			}
+		file = self.file_cache.get(client, data['name'])
+		block_size = self.block_size(data)
+		self.file_cache.flush(file)
+		size = os.fstat(file.fd).st_size
+		blocks = (size + block_size - 1) // block_size
+		base = int(data.get('base', 0))
+		# Each block takes 12 bytes, or 16 once base64-encoded
+		count = min(blocks - base, (self.config.max_read_size - 1024) // 16)
+		if data.get('count') is not None:
+			count = min(count, int(data['count']))
+		weak = []
+		strong = bytearray()
+		for index in range(base, base + max(count, 0)):
+			chunk = file.read(index * block_size, block_size)
+			weak.append(weak_checksum(chunk))
+			strong += strong_checksum(chunk)
+		return {
+			'size': size,
+			'blocks': blocks,
+			'base': base,
+			'weak': str(base64.b64encode(struct.pack('>' + str(len(weak)) + 'I', *weak)), 'ascii'),
+			'strong': str(base64.b64encode(strong), 'ascii')
+		}
+
+	def patch(self, data, client):
+		if data == 'help':
+			return {
+				'help': 'Write a list of "ops" to a previously-opened file with the given "name", starting at "offset".  Each op is either {"copy": index, "count": n}, copying n blocks of "block_size" bytes from the previously-opened "basis" file, or {"data": base64} for literal data.  Returns the "offset" after the last op.'
+			}
+		out = self.file_cache.get(client, data['name'])
+		basis = self.file_cache.get(client, data['basis'])
+		block_size = self.block_size(data)
+		offset = int(data['offset'])
+		for op in data['ops']:
+			if 'copy' in op:
+				first = int(op['copy'])
+				for index in range(first, first + int(op.get('count', 1))):
+					offset += out.write(offset, basis.read(index * block_size, block_size))
+			else:
+				offset += out.write(offset, base64.b64decode(bytes(op['data'], 'ascii')))
+		self.file_cache.written(out)
+		return {
+			'offset': offset
+		}
+
+	def rename(self, data, client):
+		if data == 'help':
+			return {
+				'help': 'Rename the file at the given "path" to the path given by "to", replacing any existing file.'
+			}
+		cwd = self.client_dir(client)
+		os.replace(data['path'], data['to'], src_dir_fd=cwd.fd, dst_dir_fd=cwd.fd)
+		return {
+			'renamed': data['to']
+		}
+
+	def get_chunk_store(self):
+		if self.chunk_store is None:
+			raise udp_server.RejectRequest('Chunk store is not enabled')
+		return self.chunk_store
+
+	def have(self, data, client):
+		if data == 'help':
+			return {
+				'help': 'Return which of the given SHA-256 "hashes" (hex) are "missing" from the chunk store.'
+			}
+		try:
+			return {
+				'missing': self.get_chunk_store().missing(data['hashes'])
+			}
+		except InvalidChunkError as err:
+			raise udp_server.RejectRequest(str(err))
+
+	def chunk_put(self, data, client):
+		if data == 'help':
+			return {
+				'help': 'Add a chunk of base64-encoded "data" with the given SHA-256 "hash" (hex) to the chunk store.  No response is sent: use have to find which chunks were stored.'
+			}
+		store = self.get_chunk_store()
+		try:
+			store.put(data['hash'], base64.b64decode(bytes(data['data'], 'ascii')))
+		except InvalidChunkError as err:
+			# Corrupted chunks are reported as missing by have
+			if not self.config.quiet:
+				print(err)
+		return udp_server.Stream(())
+
+	def assemble(self, data, client):
+		if data == 'help':
+			return {
+				'help': 'Write the chunks with the given SHA-256 "hashes" from the chunk store to a previously-opened file with the given "name", starting at "offset".  Returns the "offset" after the last chunk, or the hashes which are "missing" from the store (writing nothing).'
+			}
+		store = self.get_chunk_store()
+		file = self.file_cache.get(client, data['name'])
+		offset = int(data['offset'])
+		hashes = data['hashes']
+		try:
+			missing = store.missing(hashes)
+		except InvalidChunkError as err:
+			raise udp_server.RejectRequest(str(err))
+		if missing:
+			return {
+				'missing': missing
+			}
+		for hash in hashes:
+			chunk = store.get(hash)
+			if chunk is None:
+				# Removed to stay within budget since it was checked
+				return {
+					'missing': [hash],
+					'offset': offset
+				}
+			offset += file.write(offset, chunk)
+		self.file_cache.written(file)
+		return {
+			'offset': offset
+		}
+
+	def get_session(self, data):
+		try:
+			transfer = self.journal.get(data['session'])
+		except InvalidSessionError as err:
+			raise udp_server.RejectRequest(str(err))
+		if transfer is None:
+			raise udp_server.RejectRequest('No such session')
+		return transfer
+
+	def session_status_of(self, transfer):
+		missing = transfer.missing()
 		return {
-			'length': file.write(data)
+			'session': transfer.session,
+			'path': transfer.path,
+			'size': transfer.size,
+			'received': transfer.size - sum(end - start for start, end in missing),
+			# Keep the response within one datagram
+			'missing': missing[0:(self.config.max_read_size - 1024) // 32]
 		}
 
+	def session_open(self, data, client):
+		if data == 'help':
+			return {
+				'help': 'Start (or resume) resumable upload "session" of "size" bytes to the given "path".  Returns the number of bytes "received" and the byte ranges which are "missing", as a list of [start, end] (the first few, if there are many).'
+			}
+		path = os.path.join(self.client_dir(client).path, data['path'])
+		try:
+			transfer = self.journal.create(data['session'], path, int(data['size']))
+		except InvalidSessionError as err:
+			raise udp_server.RejectRequest(str(err))
+		return self.session_status_of(transfer)
+
+	def session_write(self, data, client):
+		if data == 'help':
+			return {
+				'help': 'Write base64-encoded "data" at "offset" in the file of upload "session".  No response is sent: use session_status to find which ranges were received.'
+			}
+		transfer = self.get_session(data)
+		try:
+			transfer.write(int(data['offset']), base64.b64decode(bytes(data['data'], 'ascii')))
+		except InvalidSessionError as err:
+			if not self.config.quiet:
+				print(err)
+		return udp_server.Stream(())
+
+	def session_status(self, data, client):
+		if data == 'help':
+			return {
+				'help': 'Return the byte ranges of upload "session" which are "missing", as a list of [start, end].  Ranges received are recorded in the journal, so they survive restarts.'
+			}
+		return self.session_status_of(self.get_session(data))
+
+	def session_commit(self, data, client):
+		if data == 'help':
+			return {
+				'help': 'Complete upload "session", moving the received file to its path.'
+			}
+		transfer = self.get_session(data)
+		try:
+			transfer.commit()
+		except InvalidSessionError as err:
+			raise udp_server.RejectRequest(str(err))
+		return {
+			'committed': transfer.path
+		}
+
+	def session_abort(self, data, client):
+		if data == 'help':
+			return {
+				'help': 'Abandon upload "session", deleting the data received.'
+			}
+		transfer = self.get_session(data)
+		transfer.abort()
+		return {
+			'aborted': transfer.session
+		}
+
+	def watch(self, data, client):
+		if data == 'help':
+			return {
+				'help': 'Watch the directory or file at the given "path" for changes, returning the "watch" identifier.  Changes are sent as "watch" events, coalesced and at most one per watch per interval, with the "changes" (name => created/modified/deleted) and whether changes were lost ("overflow").  Watches expire unless renewed by watching the same path again, and end once the watched path is removed.'
+			}
+		path = os.path.join(self.client_dir(client).path, data['path'])
+		try:
+			watch = self.watcher.watch(client, path)
+		except TooManyWatchesError as err:
+			raise udp_server.RejectRequest(str(err))
+		return {
+			'watch': watch.id,
+			'path': watch.path,
+			'inotify': self.watcher.inotify is not None,
+			'ttl': self.watcher.ttl
+		}
+
+	def unwatch(self, data, client):
+		if data == 'help':
+			return {
+				'help': 'Stop watching, given the "watch" identifier returned by watch.'
+			}
+		if not self.watcher.unwatch(client, data['watch']):
+			raise udp_server.RejectRequest('No such watch')
+		return {
+			'unwatched': data['watch']
+		}
+
+	def hash(self, data, client):
+		if data == 'help':
+			return {
+				'help': 'Digest of a previously-opened file with the given "name", or of the file at the given "path", optionally of "length" bytes from "offset".  Uses the given "algorithm" (default sha256), returning the hex "digest", the "offset", "length" and file "size", and whether the result was "cached".'
+			}
+		algorithm = data.get('algorithm', 'sha256')
+		if algorithm not in hashlib.algorithms_guaranteed or algorithm.startswith('shake_'):
+			raise udp_server.RejectRequest('Unsupported algorithm')
+		offset = int(data.get('offset', 0))
+		length = data.get('length')
+		if length is not None:
+			length = int(length)
+		if offset < 0 or (length is not None and length < 0):
+			raise udp_server.RejectRequest('Invalid range')
+		if 'name' in data:
+			file = self.file_cache.get(client, data['name'])
+			self.file_cache.flush(file)
+			future = self.hasher.hash(file.fd, offset, length, algorithm)
+		else:
+			fd = os.open(data['path'], os.O_RDONLY | os.O_CLOEXEC, dir_fd=self.client_dir(client).fd)
+			try:
+				future = self.hasher.hash(fd, offset, length, algorithm)
+			finally:
+				os.close(fd)
+		return udp_server.Deferred(future)
+
 	def seek(self, data, client):
 		if data == 'help':
 			return {
 				'help': 'Seek a previously-opened file with the given "name" to the given "offset".  An optional "whence" parameter specifies whether this offset is \'absolute\' from start (or end if negative offset) or is \'relative\' to the current position.  Returns the new absolute "position".'
 			}
-		self.switch_to_client(client)
 		file = self.file_cache.get(client, data['name'])
 		offset = data['offset']
 		whence = data.get('whence')
-		if whence is not None:
-			whence, offset = {
-				'absolute': lambda x: (os.SEEK_SET, x) if x >= 0 else (os.SEEK_END, -x),
-				'relative': lambda x: (os.SEEK_CUR, x)
-			}[whence](offset)
+		if whence is None or whence == 'absolute':
+			if offset < 0:
+				self.file_cache.flush(file)
+			position = offset if offset >= 0 else os.fstat(file.fd).st_size + offset
+		elif whence == 'relative':
+			position = file.position + offset
 		else:
-			whence = os.SEEK_SET
-		position = file.seek(offset, whence)
+			raise udp_server.RejectRequest('Invalid whence')
+		if position < 0:
+			raise udp_server.RejectRequest('Invalid offset')
+		file.position = position
 		return {
 			'position': position
 		}
@@ -231,20 +1385,23 @@ class FileSystemService():
 			return {
 				'help': 'Return the current "position" in a previously-opened file with the given "name", in bytes.'
 			}
-		self.switch_to_client(client)
 		file = self.file_cache.get(client, data['name'])
 		return {
-			'position': file.tell()
+			'position': file.position
 		}
 
 	def stat(self, data, client):
 		if data == 'help':
 			return {
-				'help': 'Returns stat info about the previously-opened file with the given "name".'
+				'help': 'Returns stat info about the previously-opened file with the given "name", or about the file at the given "path".'
 			}
-		self.switch_to_client(client)
-		file = self.file_cache.get(client, data['name'])
-		(mode, ino, dev, nlink, uid, gid, size, atime, mtime, ctime) = os.fstat(file.fileno())
+		if 'name' in data:
+			file = self.file_cache.get(client, data['name'])
+			self.file_cache.flush(file)
+			st = os.fstat(file.fd)
+		else:
+			st = os.stat(data['path'], dir_fd=self.client_dir(client).fd)
+		(mode, ino, dev, nlink, uid, gid, size, atime, mtime, ctime) = st
 		return {
 			'mode': mode,
 			'inode': ino,
@@ -252,16 +1409,38 @@ class FileSystemService():
 			'uid': uid,
 			'gid': gid,
 			'size': size,
-			'mtime': mtime
+			'mtime': mtime,
+			'mtime_ns': st.st_mtime_ns
 		}
 
+	def timeout(self):
+		''' Seconds until prune() or the watcher next need to run, or None if they do not '''
+		timeouts = [timeout for timeout in (self.watcher.timeout(), self.file_cache.next_flush()) if timeout is not None]
+		return min(timeouts) if timeouts else None
+
+	def prune(self):
+		self.file_cache.prune()
+		self.journal.prune()
+
+	def cache(self, data, client):
+		if data == 'help':
+			return {
+				'help': 'Show open-file cache statistics: number of "open" files, "capacity", "hits", "misses", "evictions", "expirations" and files with buffered writes ("dirty"), and statistics of the "readahead" and "chunk_store" if enabled, and of the "hash" cache.'
+			}
+		res = self.file_cache.summary()
+		if self.file_cache.readahead is not None:
+			res['readahead'] = self.file_cache.readahead.summary()
+		if self.chunk_store is not None:
+			res['chunk_store'] = self.chunk_store.summary()
+		res['hash'] = self.hasher.summary()
+		return res
+
 	def help(self, data, client):
 		if data == 'help':
 			return {
 				'help': 'Show a command list'
 			}
 		try:
-			self.switch_to_client(client)
 			help = [
 				'Commands available:'
 			]
@@ -285,14 +1464,35 @@ class Program():
 		config, args = udp_server.parse_config(args, Config())
 		if args:
 			raise AssertionError('Unexpected trailing arguments')
+		if config.workers > 1 and config.chunk_store is not None:
+			# Each worker would keep its own index and budget of the same directory
+			raise AssertionError('--chunk_store cannot be used with --workers')
 		self.config = config
 
 	def run(self):
-		service = FileSystemService()
-		server = udp_server.Server(self.config, service.commands)
+		if self.config.workers > 1:
+			workers.Supervisor(self.config.workers, self.serve).run()
+		else:
+			self.serve(None)
+
+	def serve(self, worker):
+		config = self.config
+		service = FileSystemService(config)
+		if config.quantum > 0:
+			interactive = [command for command in config.interactive.split(',') if command]
+			server = FairServer(config, service.commands, config.quantum, config.client_rate, config.client_burst, config.max_queue, interactive)
+		else:
+			server = udp_server.Server(config, service.commands)
+		if worker is not None:
+			server.worker = worker.attach(server)
 		while True:
-			server.handle_request() #timeout=1)
-			service.file_cache.prune()
+			server.handle_request(service.timeout())
+			service.prune()
+			for client, data in service.watcher.poll():
+				try:
+					server.notify(client, 'watch', data)
+				except OSError as err:
+					print('Error: Failed to notify client ' + str(client) + ': ' + str(err))
 
 	def usage(self):
 		print('File server for use over UDP/UART bridge and compatible interfaces')
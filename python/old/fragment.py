@@ -0,0 +1,156 @@
+import time
+import struct
+import collections
+
+# Fragment header: packet id, index of fragment, number of fragments
+fragment_header = struct.Struct('>HHH')
+
+class Fragmenter():
+	'''
+	Splits packets into fragments of at most mtu bytes (plus header), and
+	chooses which fragment to send next.
+
+	Packets which fit in one fragment are sent first, so short messages slip
+	in between the fragments of bulk transfers.  The fragments of longer
+	packets are interleaved round-robin.  With an mtu of 0, packets are
+	sent whole, without a header.
+	'''
+
+	def __init__(self, mtu):
+		self.mtu = mtu
+		self.next_id = 0
+		# Single-fragment packets as (fragment, done), and longer packets as
+		# [fragments, next index, done]
+		self.urgent = collections.deque()
+		self.bulk = collections.deque()
+		# Bytes of fragments waiting to be sent
+		self.size = 0
+
+	def __len__(self):
+		return len(self.urgent) + len(self.bulk)
+
+	def add(self, packet, done=None):
+		''' Queue a packet to be sent, calling done() (if given) when its last fragment is taken '''
+		if self.mtu == 0:
+			self.urgent.append((packet, done))
+			self.size += len(packet)
+			return
+		id = self.next_id
+		self.next_id = (self.next_id + 1) & 0xffff
+		count = max(1, -(-len(packet) // self.mtu))
+		if count > 0xffff:
+			raise ValueError('Packet of ' + str(len(packet)) + ' bytes needs too many fragments')
+		view = memoryview(packet)
+		fragments = [fragment_header.pack(id, index, count) + view[index * self.mtu:(index + 1) * self.mtu] for index in range(count)]
+		self.size += sum(len(fragment) for fragment in fragments)
+		if count == 1:
+			self.urgent.append((fragments[0], done))
+		else:
+			self.bulk.append([fragments, 0, done])
+
+	def next(self):
+		''' Take the next fragment to send, or None if there are none '''
+		if self.urgent:
+			fragment, done = self.urgent.popleft()
+		elif self.bulk:
+			job = self.bulk.popleft()
+			fragments, index, done = job
+			fragment = fragments[index]
+			job[1] = index + 1
+			if job[1] < len(fragments):
+				self.bulk.append(job)
+				done = None
+		else:
+			return None
+		self.size -= len(fragment)
+		if done is not None:
+			done()
+		return fragment
+
+class Reassembler():
+	'''
+	Reassembles packets from fragments (see Fragmenter), which may arrive
+	interleaved with those of other packets.
+
+	A partly received packet is dropped when no fragment of it arrives for
+	timeout seconds, or to keep the fragments held below max_bytes and
+	max_packets (dropping the least recently added to first), so lost
+	fragments cannot exhaust memory.
+	'''
+
+	def __init__(self, timeout=10.0, max_bytes=0x400000, max_packets=64):
+		self.timeout = timeout
+		self.max_bytes = max_bytes
+		self.max_packets = max_packets
+		# Partly received packets, id => [count, fragments by index, size,
+		# time of last fragment], least recently added to first
+		self.partial = collections.OrderedDict()
+		self.size = 0
+		self.completed = 0
+		self.expired = 0
+		self.evicted = 0
+		self.malformed = 0
+
+	def add(self, frame, now=None):
+		''' Add a received fragment, returns the packet if it is now complete '''
+		if now is None:
+			now = time.monotonic()
+		self.expire(now)
+		if len(frame) < fragment_header.size:
+			self.malformed += 1
+			return None
+		id, index, count = fragment_header.unpack_from(frame, 0)
+		if index >= count:
+			self.malformed += 1
+			return None
+		data = frame[fragment_header.size:]
+		if count == 1:
+			self.completed += 1
+			return bytes(data)
+		entry = self.partial.get(id)
+		if entry is not None and entry[0] != count:
+			# Id was reused by a new packet before the old one completed
+			self._drop(id)
+			self.expired += 1
+			entry = None
+		if entry is None:
+			entry = [count, dict(), 0, now]
+			self.partial[id] = entry
+		else:
+			self.partial.move_to_end(id)
+		if index not in entry[1]:
+			entry[1][index] = data
+			entry[2] += len(data)
+			self.size += len(data)
+		entry[3] = now
+		if len(entry[1]) == count:
+			self._drop(id)
+			self.completed += 1
+			return b''.join(entry[1][i] for i in range(count))
+		while self.partial and (self.size > self.max_bytes or len(self.partial) > self.max_packets):
+			self._drop(next(iter(self.partial)))
+			self.evicted += 1
+		return None
+
+	def expire(self, now):
+		''' Drop packets whose fragments stopped arriving '''
+		while self.partial:
+			id, entry = next(iter(self.partial.items()))
+			if now - entry[3] < self.timeout:
+				break
+			self._drop(id)
+			self.expired += 1
+
+	def _drop(self, id):
+		entry = self.partial.pop(id)
+		self.size -= entry[2]
+
+	def summary(self):
+		return {
+			'partial': len(self.partial),
+			'size': self.size,
+			'completed': self.completed,
+			'expired': self.expired,
+			'evicted': self.evicted,
+			'malformed': self.malformed
+		}
@@ -38,27 +38,30 @@ class Decoder(object):
 	def apply(self, data):
 		packets = []
 		for byte in data:
-			if self.packet is not None:
+			if byte == FEND:
+				# End of a packet (or start of the next), empty packets are ignored
+				if self.packet and not self.error:
+					packets.append(self.packet)
+				self.packet = None
+				self.escape = False
+				self.error = False
+			elif self.error:
+				# Discard the rest of a malformed packet
+				continue
+			else:
+				if self.packet is None:
+					self.packet = bytearray()
 				if self.escape:
+					self.escape = False
 					if byte == TFEND:
-						self.packet.add(FEND)
+						self.packet.append(FEND)
 					elif byte == TFESC:
-						self.packet.add(FESC)
+						self.packet.append(FESC)
 					else:
 						self.packet = None
-						self.escape = False
 						self.error = True
-					self.escape = False
 				elif byte == FESC:
 					self.escape = True
-				elif byte == FEND:
-					packets.append(self.packet)
-					self.packet = None
 				else:
 					self.packet.append(byte)
-			elif byte != FEND and not self.error:
-				self.packet = bytearray()
-				self.packet.append(byte)
-			elif byte == FEND:
-				self.error = False
 		return packets
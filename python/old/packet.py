@@ -8,24 +8,21 @@ import getopt
 import fcntl
 import select
 import json
+import collections
 from serial import Serial
 
 import kiss
+from ring_buffer import RingBuffer
 
 
 class PacketDemo():
 
-	# Buffer of data from STDIN to send to UART
-	#
-	# Note: we currently do not enforce a maximum size on this buffer.
-	#
-	# If you use this code in production, you definitely should set an upper limit,
-	# and also use a proper queue instead of shifting an array.
-	send_buf = bytearray()
-
 	# Maximum amount of data to read at once
 	BUFSIZE = 0x10000
 
+	# Capacity of the buffer of data to send to UART
+	TX_BUFSIZE = 0x100000
+
 	# Codec for packet access over character device
 	encoder = kiss.Encoder()
 	decoder = kiss.Decoder()
@@ -33,6 +30,9 @@ class PacketDemo():
 	# Sequence number (added for educational use, not needed for demo)
 	seq = 1
 
+	# Whether STDIN has not reached end of file
+	stdin_open = True
+
 	def usage(self):
 		print('UART communications demo')
 		print('')
@@ -100,6 +100,11 @@ class PacketDemo():
 		self.device = device
 		self.baud = baud
 
+		# Buffer of encoded packets to send to UART, and packets which did not
+		# fit in it yet (STDIN is not read until they do)
+		self.send_buf = RingBuffer(self.TX_BUFSIZE)
+		self.pending = collections.deque()
+
 		# Encode arguments into TX buffer
 		for arg in args:
 			msg = {
@@ -118,12 +123,16 @@ class PacketDemo():
 			for fd in [stdin_fileno, uart_fileno]:
 				fcntl.fcntl(fd, fcntl.F_SETFL, fcntl.fcntl(fd, fcntl.F_GETFL) | os.O_NONBLOCK)
 			while True:
-				# Wait for UART or STDIN to become readable
-				want_read = [uart_fileno, stdin_fileno]
+				# Move packets which now fit into the TX buffer
+				while self.pending and self.send_buf.put(self.pending[0]):
+					self.pending.popleft()
+				# Wait for UART to become readable, and STDIN unless the TX buffer
+				# is full or STDIN was closed
+				want_read = [uart_fileno] if self.pending or not self.stdin_open else [uart_fileno, stdin_fileno]
 				# If we have data buffered to send, also wait for UART to become writeable
 				want_write = [uart_fileno] if self.send_buf else []
-				# Wait for event
-				r, w, e = select.select(want_read, want_write, [], 0)
+				# Sleep until there is something to do
+				r, w, e = select.select(want_read, want_write, [])
 				# Error
 				if e:
 					print('Error occurred')
@@ -132,17 +141,20 @@ class PacketDemo():
 				if stdin_fileno in r:
 					# Form JSON packet from newly-read data
 					text = os.read(stdin_fileno, self.BUFSIZE)
-					msg = {
-						"seq": self.seq,
-						"text": str(text, "utf-8")
-					}
-					self.send_json(msg)
+					if text:
+						msg = {
+							"seq": self.seq,
+							"text": str(text, "utf-8")
+						}
+						self.send_json(msg)
+					else:
+						# End of file, but keep receiving
+						self.stdin_open = False
 				# Write to UART
 				if uart_fileno in w:
-					# Write data from TX buffer then remove the amount written from
-					# the buffer
-					written = os.write(uart_fileno, self.send_buf)
-					self.send_buf = self.send_buf[written:]
+					# Write data from TX buffer, which removes the amount written
+					# from the buffer
+					self.send_buf.write_to(uart_fileno)
 				# Read from UART
 				if uart_fileno in r:
 					data = os.read(uart_fileno, self.BUFSIZE)
@@ -154,14 +166,20 @@ class PacketDemo():
 						self.recv_json(msg)
 
 	def send_json(self, msg):
-		''' Call to send a JSON packet '''
+		''' Call to send a JSON packet, returns False if it was queued as the TX buffer is full '''
 		packet = bytes(json.dumps(msg), "utf-8")
 		# Encode packet to KISS byte stream
 		data = self.encoder.apply(packet)
-		# Append KISS data to TX buffer
-		self.send_buf += data
+		if len(data) > self.send_buf.capacity:
+			print('Packet of ' + str(len(data)) + ' bytes is too large for TX buffer, dropped')
+			return False
 		# Bump sequence number
 		self.seq = self.seq + 1
+		# Append KISS data to TX buffer, or queue it until there is room
+		if self.pending or not self.send_buf.put(data):
+			self.pending.append(data)
+			return False
+		return True
 
 	def recv_json(self, msg):
 		''' Called when receiving a JSON packet '''
@@ -0,0 +1,343 @@
+#!/usr/bin/python3
+
+import sys
+import json
+import time
+import socket
+import getopt
+import select
+
+import kiss
+import capture
+import fragment
+from stats import percentile
+
+class Config():
+	''' Configuration for capture replay '''
+	# What to replay the capture into: 'decoder' or 'server'
+	target = 'decoder'
+	# Replay what was received over the serial link ('rx') or sent over it ('tx')
+	direction = 'rx'
+	# Keep the timing of the capture, instead of replaying as fast as possible
+	realtime = False
+	# Times to replay the capture (into the decoder)
+	repeat = 1
+	# Reassemble decoded frames into datagrams (if the bridge ran with --mtu)
+	fragmented = False
+	# Server to send requests to, and where it sends its responses
+	tx_host = 'localhost'
+	tx_port = 5556
+	rx_host = 'localhost'
+	rx_port = 5555
+	max_read_size = 0x10000
+	# Most requests to have awaiting a response, and seconds to wait for one
+	window = 16
+	timeout = 1.0
+
+class Schedule():
+	''' When each record is due, relative to the first, when replaying in real time '''
+
+	def __init__(self, realtime):
+		self.realtime = realtime
+		self.first = None
+		self.start = None
+		# Seconds behind the capture's timing, at worst
+		self.lag = 0.0
+
+	def delay(self, t):
+		''' Seconds until a record captured at t is due '''
+		if not self.realtime:
+			return 0.0
+		now = time.monotonic()
+		if self.first is None:
+			self.first = t
+			self.start = now
+		delay = self.start + (t - self.first) - now
+		if delay > 0:
+			return delay
+		self.lag = max(self.lag, -delay)
+		return 0.0
+
+	def wait(self, t):
+		delay = self.delay(t)
+		if delay > 0:
+			time.sleep(delay)
+
+class DecoderReplay():
+	'''
+	Feeds the bytes read from (or written to) the serial device into a
+	kiss.Decoder, in the chunks they were captured in, and checks the
+	datagrams decoded against those captured.
+	'''
+
+	def __init__(self, config, reader):
+		self.config = config
+		kind = capture.RX_BYTES if config.direction == 'rx' else capture.TX_BYTES
+		packet_kind = capture.RX_PACKET if config.direction == 'rx' else capture.TX_PACKET
+		self.chunks = reader.records((kind,))
+		self.captured = sum(1 for record in reader if record[1] == packet_kind)
+
+	def run(self):
+		config = self.config
+		size = sum(len(data) for t, kind, data in self.chunks)
+		frames = 0
+		packets = 0
+		busy = 0.0
+		lag = 0.0
+		cpu_start = time.process_time()
+		wall_start = time.perf_counter()
+		for i in range(config.repeat):
+			schedule = Schedule(config.realtime)
+			decoder = kiss.Decoder()
+			reassembler = fragment.Reassembler() if config.fragmented else None
+			for t, kind, data in self.chunks:
+				schedule.wait(t)
+				start = time.perf_counter()
+				for frame in decoder.apply(data):
+					frames += 1
+					if reassembler is None or reassembler.add(frame, t) is not None:
+						packets += 1
+				busy += time.perf_counter() - start
+			lag = max(lag, schedule.lag)
+		wall = time.perf_counter() - wall_start
+		cpu = time.process_time() - cpu_start
+		return {
+			'chunks': len(self.chunks) * config.repeat,
+			'bytes': size * config.repeat,
+			'frames': frames,
+			'packets': packets,
+			'captured': self.captured * config.repeat,
+			'wall': wall,
+			'cpu': cpu,
+			'busy': busy,
+			'lag': lag
+		}
+
+	def report(self, result):
+		print('Replayed %d bytes in %d chunks into the decoder' % (result['bytes'], result['chunks']))
+		print('Decoded:      %d frames, %d datagrams (%d captured)' % (result['frames'], result['packets'], result['captured']))
+		print('Elapsed:      %.3fs, CPU %.3fs (%.1f%%)' % (result['wall'], result['cpu'], result['cpu'] * 100 / max(result['wall'], 1e-9)))
+		print('Decoding:     %.3fs, %.2f MiB/s, %.0f datagrams/s' % (result['busy'], result['bytes'] / max(result['busy'], 1e-9) / 0x100000, result['packets'] / max(result['busy'], 1e-9)))
+		if self.config.realtime:
+			print('Worst lag:    %.3fms behind the capture' % (result['lag'] * 1000))
+
+class ServerReplay():
+	'''
+	Sends the requests in the datagrams captured to a udp_server (or
+	file_server), and times its responses.  Responses are matched to
+	requests by client and seq, and at most window requests await a
+	response at once, so that replaying as fast as possible keeps the
+	server busy without its socket dropping requests.
+	'''
+
+	def __init__(self, config, reader):
+		self.config = config
+		kind = capture.RX_PACKET if config.direction == 'rx' else capture.TX_PACKET
+		self.requests = []
+		for t, record_kind, data in reader.records((kind,)):
+			try:
+				msg = json.loads(str(data, 'utf-8'))
+			except ValueError:
+				continue
+			if isinstance(msg, dict) and msg.get('type') == 'request':
+				self.requests.append((t, (msg.get('client'), msg.get('seq')), bytes(data)))
+
+	def run(self):
+		config = self.config
+		sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+		with sock:
+			sock.bind((config.rx_host, config.rx_port))
+			sock.setblocking(False)
+			schedule = Schedule(config.realtime)
+			# Requests awaiting a response, key => time sent
+			waiting = dict()
+			latencies = []
+			responses = 0
+			lost = 0
+			start = time.perf_counter()
+			index = 0
+			while index < len(self.requests) or waiting:
+				now = time.perf_counter()
+				for key in [key for key, sent in waiting.items() if now - sent > config.timeout]:
+					del waiting[key]
+					lost += 1
+				timeout = config.timeout
+				if index < len(self.requests) and len(waiting) < config.window:
+					t, key, packet = self.requests[index]
+					timeout = schedule.delay(t)
+					if timeout == 0:
+						index += 1
+						sock.sendto(packet, (config.tx_host, config.tx_port))
+						if key in waiting:
+							# Same request sent again, e.g. by a client retrying
+							lost += 1
+						waiting[key] = time.perf_counter()
+						continue
+				r, w, e = select.select([sock], [], [], timeout)
+				if not r:
+					continue
+				while True:
+					try:
+						packet, addr = sock.recvfrom(config.max_read_size)
+					except BlockingIOError:
+						break
+					responses += 1
+					try:
+						msg = json.loads(str(packet, 'utf-8'))
+					except ValueError:
+						continue
+					sent = waiting.pop((msg.get('client'), msg.get('seq')), None) if isinstance(msg, dict) else None
+					if sent is not None:
+						latencies.append(time.perf_counter() - sent)
+			elapsed = time.perf_counter() - start
+		latencies.sort()
+		return {
+			'requests': len(self.requests),
+			'answered': len(latencies),
+			'responses': responses,
+			'lost': lost,
+			'elapsed': elapsed,
+			'latencies': latencies,
+			'lag': schedule.lag
+		}
+
+	def report(self, result):
+		latencies = result['latencies']
+		print('Replayed %d requests to %s:%d' % (result['requests'], self.config.tx_host, self.config.tx_port))
+		print('Answered:     %d (%d responses, %d unanswered)' % (result['answered'], result['responses'], result['lost']))
+		print('Elapsed:      %.3fs, %.0f requests/s' % (result['elapsed'], result['answered'] / max(result['elapsed'], 1e-9)))
+		if latencies:
+			print('Latency:      p50 %.3fms, p95 %.3fms, p99 %.3fms, max %.3fms' % tuple(value * 1000 for value in (percentile(latencies, 50), percentile(latencies, 95), percentile(latencies, 99), latencies[-1])))
+		if self.config.realtime:
+			print('Worst lag:    %.3fms behind the capture' % (result['lag'] * 1000))
+
+def summarise(reader):
+	''' Count the records of each kind in a capture, and the time it spans '''
+	counts = dict()
+	first = None
+	last = None
+	for t, kind, data in reader:
+		count = counts.setdefault(kind, [0, 0])
+		count[0] += 1
+		count[1] += len(data)
+		if first is None:
+			first = t
+		last = t
+	return counts, first, last
+
+#################### DEMO / CLI STUFF COMES BELOW ####################
+
+class Program():
+	''' Wrapper to allow captures to be replayed from command-line '''
+	def __init__(self, cmdline):
+		config = Config()
+		try:
+			opts, args = getopt.getopt(cmdline, '', ['target=', 'direction=', 'realtime', 'repeat=', 'fragmented', 'tx_host=', 'tx_port=', 'rx_host=', 'rx_port=', 'max_read_size=', 'window=', 'timeout=', 'summary', 'help'])
+
+			self.summary = False
+			for opt, val in opts:
+				if opt in ('--target'):
+					config.target = val
+				elif opt in ('--direction'):
+					config.direction = val
+				elif opt in ('--realtime'):
+					config.realtime = True
+				elif opt in ('--repeat'):
+					config.repeat = int(val)
+				elif opt in ('--fragmented'):
+					config.fragmented = True
+				elif opt in ('--tx_host'):
+					config.tx_host = val
+				elif opt in ('--tx_port'):
+					config.tx_port = int(val)
+				elif opt in ('--rx_host'):
+					config.rx_host = val
+				elif opt in ('--rx_port'):
+					config.rx_port = int(val)
+				elif opt in ('--max_read_size'):
+					config.max_read_size = int(val, 0)
+				elif opt in ('--window'):
+					config.window = int(val)
+				elif opt in ('--timeout'):
+					config.timeout = float(val)
+				elif opt in ('--summary'):
+					self.summary = True
+				elif opt in ('--help'):
+					self.usage()
+					sys.exit(0)
+				else:
+					raise AssertionError('Unhandled option: ' + opt)
+			if config.target not in ('decoder', 'server'):
+				raise AssertionError('--target must be decoder or server')
+			if config.direction not in ('rx', 'tx'):
+				raise AssertionError('--direction must be rx or tx')
+			if config.repeat < 1 or config.window < 1:
+				raise AssertionError('--repeat and --window must be at least 1')
+			if len(args) != 1:
+				raise AssertionError('One capture file is required')
+		except (getopt.GetoptError, ValueError, AssertionError) as err:
+			print(err)
+			self.usage()
+			sys.exit(1)
+		self.config = config
+		self.path = args[0]
+
+	def run(self):
+		try:
+			reader = capture.CaptureReader(self.path)
+		except (OSError, capture.CaptureError) as err:
+			print(err)
+			sys.exit(1)
+		with reader:
+			if self.summary:
+				counts, first, last = summarise(reader)
+				if first is not None:
+					print('%.3fs of traffic, from %s' % (last - first, time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(first))))
+				for kind, (records, size) in sorted(counts.items()):
+					print('%-12s %8d records %12d bytes' % (capture.kind_names.get(kind, 'kind ' + str(kind)), records, size))
+			elif self.config.target == 'decoder':
+				replay = DecoderReplay(self.config, reader)
+				replay.report(replay.run())
+				del replay
+			else:
+				replay = ServerReplay(self.config, reader)
+				replay.report(replay.run())
+			if reader.truncated:
+				print('(Capture ends with a truncated record, which was ignored)')
+
+	def usage(self):
+		print('Capture replay')
+		print('')
+		print('Replays a capture of serial traffic (see udp_bridge.py --capture) into a KISS')
+		print('decoder or a udp_server, at the original timing or as fast as possible, to')
+		print('reproduce problems seen in the field and to benchmark changes with real traffic')
+		print('')
+		print('Syntax:')
+		print('')
+		print('  ./replay.py')
+		print('                  --target=decoder --direction=rx')
+		print('                  --realtime --repeat=1 --fragmented')
+		print('                  --tx_host=localhost --tx_port=5556 --rx_host=localhost --rx_port=5555')
+		print('                  --window=16 --timeout=1')
+		print('                  --summary')
+		print('                  <capture file>')
+		print('')
+		print('    --target=[value]         decoder: decode the bytes read from the serial device')
+		print('                             server: send the requests in the datagrams received to a server')
+		print('    --direction=[value]      Replay what the bridge received over the serial link (rx), or sent (tx)')
+		print('    --realtime               Keep the timing of the capture, instead of replaying as fast as possible')
+		print('    --repeat=[value]         Times to replay the capture into the decoder')
+		print('    --fragmented             Frames are fragments of datagrams (the bridge ran with --mtu)')
+		print('')
+		print('    --tx_host=[value]        Host and port the server receives requests on')
+		print('    --tx_port=[value]')
+		print('    --rx_host=[value]        Host and port the server sends responses to')
+		print('    --rx_port=[value]')
+		print('    --window=[value]         Most requests awaiting a response at once')
+		print('    --timeout=[value]        Seconds after which a request is counted as unanswered')
+		print('')
+		print('    --summary                Only list the records in the capture')
+		print('')
+
+if __name__ == '__main__':
+	Program(sys.argv[1:]).run()
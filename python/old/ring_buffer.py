@@ -0,0 +1,101 @@
+import os
+
+class RingBuffer():
+	'''
+	Fixed-capacity FIFO of bytes, kept in a circular buffer so that neither
+	adding nor removing data moves the rest of it.
+
+	Data is accessed through memoryviews of the underlying buffer, without
+	copying: readable() returns views of the buffered data (to write out,
+	then consume()), and writable() returns views of the free space (to
+	read into, then commit()).  Each returns one or two views, as the data
+	or free space may wrap around the end of the buffer.
+
+	put() only accepts data which fits entirely, returning False otherwise,
+	so a producer can hold on to the data and stop producing until the
+	buffer drains (see free()).
+	'''
+
+	def __init__(self, capacity):
+		if capacity <= 0:
+			raise ValueError('Capacity must be positive')
+		self.capacity = capacity
+		self.view = memoryview(bytearray(capacity))
+		# Offset of the first byte of data, and bytes of data
+		self.start = 0
+		self.size = 0
+
+	def __len__(self):
+		return self.size
+
+	def free(self):
+		return self.capacity - self.size
+
+	def full(self):
+		return self.size == self.capacity
+
+	def _span(self, begin, length):
+		end = begin + length
+		if end <= self.capacity:
+			return [self.view[begin:end]]
+		return [self.view[begin:], self.view[:end - self.capacity]]
+
+	def readable(self):
+		''' Views of the buffered data, in order '''
+		return self._span(self.start, self.size)
+
+	def writable(self):
+		''' Views of the free space, in order '''
+		return self._span((self.start + self.size) % self.capacity, self.free())
+
+	def consume(self, length):
+		''' Remove length bytes from the front, after they were read from readable() '''
+		if length > self.size:
+			raise ValueError('Consuming more than is buffered')
+		self.size -= length
+		# Keep the data contiguous for as long as possible
+		self.start = 0 if self.size == 0 else (self.start + length) % self.capacity
+
+	def commit(self, length):
+		''' Append length bytes, after they were written into writable() '''
+		if length > self.free():
+			raise ValueError('Committing more than is free')
+		self.size += length
+
+	def put(self, data):
+		''' Append data if it fits, returns False (appending nothing) if not '''
+		length = len(data)
+		if length > self.free():
+			return False
+		data = memoryview(data)
+		offset = 0
+		for view in self.writable():
+			count = min(len(view), length - offset)
+			view[:count] = data[offset:offset + count]
+			offset += count
+			if offset == length:
+				break
+		self.commit(length)
+		return True
+
+	def write_to(self, fd):
+		''' Write as much buffered data as a non-blocking file accepts, returns the bytes written '''
+		if self.size == 0:
+			return 0
+		try:
+			written = os.writev(fd, self.readable())
+		except BlockingIOError:
+			return 0
+		self.consume(written)
+		return written
+
+	def read_from(self, fd):
+		''' Read from a non-blocking file into the free space, returns the bytes read (0 at end of file) or None if none were available '''
+		if self.full():
+			return None
+		try:
+			count = os.readv(fd, self.writable())
+		except BlockingIOError:
+			return None
+		self.commit(count)
+		return count
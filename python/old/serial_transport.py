@@ -0,0 +1,264 @@
+''' Linux only.  Requires PySerial. '''
+
+import os
+import fcntl
+import struct
+import asyncio
+import termios
+import itertools
+import collections
+from serial import Serial
+
+import kiss
+
+class SerialTransport(asyncio.Transport):
+	'''
+	asyncio transport for a serial device, which reads and writes the
+	device's file descriptor when the event loop reports it ready
+	(loop.add_reader/add_writer) instead of running a loop of its own, so
+	it can share the event loop with sockets.
+
+	Data which the device does not accept at once is queued (without
+	copying bytes objects) and written as it becomes writable.  As with
+	other asyncio transports, the protocol's pause_writing() is called when
+	the queue grows beyond the high watermark, and resume_writing() once it
+	drains to the low watermark (see set_write_buffer_limits).
+	'''
+
+	# Maximum amount of data to read at once
+	max_read_size = 0x10000
+	# Most queued chunks to write in one call
+	max_write_chunks = 64
+
+	def __init__(self, loop, serial, protocol, extra=None):
+		super(SerialTransport, self).__init__(extra)
+		self._extra.setdefault('serial', serial)
+		self.loop = loop
+		self.serial = serial
+		self.fd = serial.fileno()
+		self.protocol = protocol
+		# Chunks of data waiting to be written, and their total size
+		self.buffer = collections.deque()
+		self.buffer_size = 0
+		self.reading = True
+		self.writing_paused = False
+		self.closing = False
+		self.closed = False
+		self.set_write_buffer_limits()
+		os.set_blocking(self.fd, False)
+		self.protocol.connection_made(self)
+		self.loop.add_reader(self.fd, self._read_ready)
+
+	def get_protocol(self):
+		return self.protocol
+
+	def set_protocol(self, protocol):
+		self.protocol = protocol
+
+	def is_closing(self):
+		return self.closing
+
+	def close(self):
+		''' Close once queued data is written '''
+		if self.closing:
+			return
+		self.closing = True
+		self.loop.remove_reader(self.fd)
+		if not self.buffer:
+			self.loop.call_soon(self._finish, None)
+
+	def abort(self):
+		''' Close without writing queued data '''
+		self._finish(None)
+
+	def _finish(self, exc):
+		if self.closed:
+			return
+		self.closing = True
+		self.closed = True
+		self.loop.remove_reader(self.fd)
+		self.loop.remove_writer(self.fd)
+		self.buffer.clear()
+		self.buffer_size = 0
+		try:
+			self.protocol.connection_lost(exc)
+		finally:
+			self.serial.close()
+
+	def is_reading(self):
+		return self.reading and not self.closing
+
+	def pause_reading(self):
+		if not self.is_reading():
+			return
+		self.reading = False
+		self.loop.remove_reader(self.fd)
+
+	def resume_reading(self):
+		if self.reading or self.closing:
+			return
+		self.reading = True
+		self.loop.add_reader(self.fd, self._read_ready)
+
+	def _read_ready(self):
+		try:
+			data = os.read(self.fd, self.max_read_size)
+		except (BlockingIOError, InterruptedError):
+			return
+		except OSError as exc:
+			self._finish(exc)
+			return
+		if not data:
+			# Device hung up
+			self.protocol.eof_received()
+			self.close()
+			return
+		self.protocol.data_received(data)
+
+	def write(self, data):
+		if self.closing:
+			raise RuntimeError('Transport is closing')
+		if not data:
+			return
+		written = 0
+		if not self.buffer:
+			# Nothing queued, so try to write it straight away
+			try:
+				written = os.write(self.fd, data)
+			except (BlockingIOError, InterruptedError):
+				pass
+			except OSError as exc:
+				self._finish(exc)
+				return
+			if written == len(data):
+				return
+			self.loop.add_writer(self.fd, self._write_ready)
+		# Mutable data may be changed by the caller once this returns
+		rest = memoryview(data)[written:] if isinstance(data, bytes) else bytes(data[written:])
+		self.buffer.append(rest)
+		self.buffer_size += len(rest)
+		self._maybe_pause()
+
+	def writelines(self, list_of_data):
+		for data in list_of_data:
+			self.write(data)
+
+	def _write_ready(self):
+		try:
+			written = os.writev(self.fd, list(itertools.islice(self.buffer, self.max_write_chunks)))
+		except (BlockingIOError, InterruptedError):
+			return
+		except OSError as exc:
+			self._finish(exc)
+			return
+		self.buffer_size -= written
+		while written > 0:
+			chunk = self.buffer[0]
+			if written < len(chunk):
+				self.buffer[0] = memoryview(chunk)[written:]
+				break
+			written -= len(chunk)
+			self.buffer.popleft()
+		self._maybe_resume()
+		if not self.buffer:
+			self.loop.remove_writer(self.fd)
+			if self.closing:
+				self._finish(None)
+
+	def can_write_eof(self):
+		return False
+
+	def get_write_buffer_size(self):
+		return self.buffer_size
+
+	def get_output_queue_size(self):
+		''' Bytes written to the device which it has not sent yet, as reported by its driver (0 if it does not) '''
+		try:
+			return struct.unpack('i', fcntl.ioctl(self.fd, termios.TIOCOUTQ, b'\0\0\0\0'))[0]
+		except OSError:
+			return 0
+
+	def get_write_buffer_limits(self):
+		return (self.low_water, self.high_water)
+
+	def set_write_buffer_limits(self, high=None, low=None):
+		if high is None:
+			high = 0x10000 if low is None else 4 * low
+		if low is None:
+			low = high // 4
+		if not high >= low >= 0:
+			raise ValueError('High watermark must be at least the low watermark, which must not be negative')
+		self.high_water = high
+		self.low_water = low
+		self._maybe_pause()
+		self._maybe_resume()
+
+	def _maybe_pause(self):
+		if not self.writing_paused and self.buffer_size > self.high_water:
+			self.writing_paused = True
+			self.protocol.pause_writing()
+
+	def _maybe_resume(self):
+		if self.writing_paused and self.buffer_size <= self.low_water:
+			self.writing_paused = False
+			self.protocol.resume_writing()
+
+async def create_serial_connection(loop, protocol_factory, device, baud):
+	''' Open a serial device and connect a protocol to it, returns (transport, protocol) '''
+	serial = Serial(device, baud)
+	protocol = protocol_factory()
+	try:
+		transport = SerialTransport(loop, serial, protocol)
+	except Exception:
+		serial.close()
+		raise
+	return transport, protocol
+
+class KissProtocol(asyncio.Protocol):
+	'''
+	Packets over a serial link, framed with KISS (see kiss.py).
+
+	Subclasses override packet_received(), which is called with each whole
+	packet received, and send with send_packet().  A producer may await
+	drain() before sending, which waits while the transport's write buffer
+	is above its high watermark.  closed is a future which completes (with
+	the exception, if any) when the connection is lost.
+	'''
+
+	transport = None
+	closed = None
+
+	def __init__(self):
+		self.encoder = kiss.Encoder()
+		self.decoder = kiss.Decoder()
+		self.writable = asyncio.Event()
+		self.writable.set()
+
+	def connection_made(self, transport):
+		self.transport = transport
+		self.closed = asyncio.get_event_loop().create_future()
+
+	def connection_lost(self, exc):
+		# Do not leave producers waiting
+		self.writable.set()
+		if not self.closed.done():
+			self.closed.set_result(exc)
+
+	def data_received(self, data):
+		for packet in self.decoder.apply(data):
+			self.packet_received(bytes(packet))
+
+	def packet_received(self, packet):
+		pass
+
+	def send_packet(self, packet):
+		self.transport.write(self.encoder.apply(packet))
+
+	def pause_writing(self):
+		self.writable.clear()
+
+	def resume_writing(self):
+		self.writable.set()
+
+	async def drain(self):
+		await self.writable.wait()
@@ -0,0 +1,8 @@
+''' Summary statistics shared by the load tests and the trace analyzer. '''
+
+def percentile(values, p):
+	''' Nearest-rank percentile of sorted values, with p in percent, or None if there are none '''
+	if not values:
+		return None
+	# Rounding up in integers, as p / 100 is not exact in floating point
+	return values[max(0, -(-p * len(values) // 100) - 1)]
@@ -0,0 +1,108 @@
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from fragment import Fragmenter, Reassembler, fragment_header
+
+def fragments(fragmenter):
+	result = []
+	while True:
+		fragment = fragmenter.next()
+		if fragment is None:
+			return result
+		result.append(bytes(fragment))
+
+class FragmentTest(unittest.TestCase):
+
+	def test_short_packets_first(self):
+		fragmenter = Fragmenter(4)
+		fragmenter.add(b'0123456789')
+		fragmenter.add(b'ab')
+		sent = fragments(fragmenter)
+		self.assertEqual(len(sent), 4)
+		self.assertEqual(sent[0][fragment_header.size:], b'ab')
+		self.assertEqual(fragmenter.size, 0)
+
+	def test_interleaved_reassembly(self):
+		fragmenter = Fragmenter(3)
+		packets = [b'first packet', b'second packet', b'x']
+		for packet in packets:
+			fragmenter.add(packet)
+		reassembler = Reassembler()
+		received = [packet for packet in (reassembler.add(fragment, now=0) for fragment in fragments(fragmenter)) if packet is not None]
+		self.assertEqual(sorted(received), sorted(packets))
+		self.assertEqual(reassembler.size, 0)
+		self.assertEqual(reassembler.summary()['completed'], 3)
+
+	def test_unfragmented(self):
+		fragmenter = Fragmenter(0)
+		fragmenter.add(b'whole')
+		self.assertEqual(fragments(fragmenter), [b'whole'])
+
+	def test_timeout(self):
+		fragmenter = Fragmenter(2)
+		fragmenter.add(b'abcdef')
+		first, second, third = fragments(fragmenter)
+		reassembler = Reassembler(timeout=1.0)
+		self.assertIsNone(reassembler.add(first, now=10.0))
+		# Each fragment restarts the timeout
+		self.assertIsNone(reassembler.add(second, now=10.9))
+		self.assertEqual(reassembler.add(third, now=11.8), b'abcdef')
+		fragmenter.add(b'ghijkl')
+		first, second, third = fragments(fragmenter)
+		self.assertIsNone(reassembler.add(first, now=20.0))
+		self.assertIsNone(reassembler.add(second, now=21.0))
+		self.assertIsNone(reassembler.add(third, now=21.1))
+		summary = reassembler.summary()
+		self.assertEqual(summary['expired'], 1)
+		self.assertEqual(summary['partial'], 1)
+		reassembler.expire(22.1)
+		self.assertEqual(reassembler.summary()['partial'], 0)
+		self.assertEqual(reassembler.size, 0)
+
+	def test_max_packets(self):
+		fragmenter = Fragmenter(2)
+		for index in range(4):
+			fragmenter.add(bytes([index]) * 4)
+		sent = fragments(fragmenter)
+		reassembler = Reassembler(max_packets=2)
+		# First fragments of each packet, the oldest are evicted
+		for fragment in sent[0:4]:
+			self.assertIsNone(reassembler.add(fragment, now=0))
+		self.assertEqual(reassembler.summary()['evicted'], 2)
+		# Second fragments of the packets which were kept complete them
+		self.assertEqual(reassembler.add(sent[6], now=0), bytes([2]) * 4)
+		self.assertEqual(reassembler.add(sent[7], now=0), bytes([3]) * 4)
+		self.assertIsNone(reassembler.add(sent[4], now=0))
+		self.assertEqual(reassembler.summary()['partial'], 1)
+
+	def test_max_bytes(self):
+		fragmenter = Fragmenter(4)
+		fragmenter.add(b'a' * 8)
+		fragmenter.add(b'b' * 8)
+		sent = fragments(fragmenter)
+		reassembler = Reassembler(max_bytes=6)
+		self.assertIsNone(reassembler.add(sent[0], now=0))
+		self.assertIsNone(reassembler.add(sent[1], now=0))
+		summary = reassembler.summary()
+		self.assertEqual(summary['evicted'], 1)
+		self.assertEqual(summary['size'], 4)
+		self.assertEqual(reassembler.add(sent[3], now=0), b'b' * 8)
+
+	def test_malformed(self):
+		reassembler = Reassembler()
+		self.assertIsNone(reassembler.add(b'\x00', now=0))
+		self.assertIsNone(reassembler.add(fragment_header.pack(1, 2, 2) + b'x', now=0))
+		self.assertEqual(reassembler.summary()['malformed'], 2)
+
+	def test_reused_id(self):
+		reassembler = Reassembler()
+		self.assertIsNone(reassembler.add(fragment_header.pack(7, 0, 3) + b'old', now=0))
+		self.assertIsNone(reassembler.add(fragment_header.pack(7, 0, 2) + b'ne', now=0))
+		self.assertEqual(reassembler.add(fragment_header.pack(7, 1, 2) + b'w', now=0), b'new')
+		self.assertEqual(reassembler.size, 0)
+
+if __name__ == '__main__':
+	unittest.main()
@@ -0,0 +1,81 @@
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import kiss
+from kiss import FEND, FESC, TFEND, TFESC
+
+try:
+	import serial_transport
+except ImportError:
+	# Requires PySerial
+	serial_transport = None
+
+# Packets which need escaping, including those starting or ending with an
+# escaped byte (see BUGS.md)
+packets = [
+	bytes([FESC, TFESC]),
+	bytes([FEND, 1, 2]),
+	bytes([1, 2, FESC]),
+	bytes([FESC]),
+	bytes([FEND, FEND, FESC, FESC]),
+	bytes([TFEND, TFESC]),
+	bytes(range(256))
+]
+
+class KissTest(unittest.TestCase):
+
+	def test_escaped_bytes(self):
+		self.assertEqual(kiss.Encoder().apply(bytes([FEND, FESC])), bytes([FEND, FESC, TFEND, FESC, TFESC, FEND]))
+
+	def test_round_trip(self):
+		encoder = kiss.Encoder()
+		decoder = kiss.Decoder()
+		for packet in packets:
+			self.assertEqual(decoder.apply(encoder.apply(packet)), [packet])
+
+	def test_round_trip_byte_by_byte(self):
+		encoder = kiss.Encoder()
+		decoder = kiss.Decoder()
+		stream = b''.join(encoder.apply(packet) for packet in packets)
+		received = []
+		for byte in stream:
+			received += decoder.apply(bytes([byte]))
+		self.assertEqual(received, packets)
+
+	def test_malformed_escape_drops_packet(self):
+		decoder = kiss.Decoder()
+		stream = bytes([FEND, 1, FESC, 2, 3, FEND]) + kiss.Encoder().apply(bytes([FESC, 4]))
+		self.assertEqual(decoder.apply(stream), [bytes([FESC, 4])])
+
+	def test_empty_frames_ignored(self):
+		self.assertEqual(kiss.Decoder().apply(bytes([FEND, FEND, FEND])), [])
+
+class Transport():
+	''' Collects what a protocol writes '''
+	def __init__(self):
+		self.data = bytearray()
+
+	def write(self, data):
+		self.data += data
+
+@unittest.skipIf(serial_transport is None, 'PySerial is not installed')
+class KissProtocolTest(unittest.TestCase):
+
+	def test_round_trip(self):
+		received = []
+		protocol = serial_transport.KissProtocol()
+		protocol.packet_received = received.append
+		protocol.transport = Transport()
+		for packet in packets:
+			protocol.send_packet(packet)
+		# Split between the bytes of escape sequences
+		data = bytes(protocol.transport.data)
+		for offset in range(0, len(data), 3):
+			protocol.data_received(data[offset:offset + 3])
+		self.assertEqual(received, packets)
+
+if __name__ == '__main__':
+	unittest.main()
@@ -0,0 +1,77 @@
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from ring_buffer import RingBuffer
+
+class RingBufferTest(unittest.TestCase):
+
+	def wrapped(self):
+		''' A buffer of 8 bytes whose data wraps around the end: b'ghij' from offset 6 '''
+		buffer = RingBuffer(8)
+		self.assertTrue(buffer.put(b'abcdef'))
+		buffer.consume(4)
+		self.assertTrue(buffer.put(b'gh'))
+		self.assertEqual(buffer.start, 4)
+		self.assertTrue(buffer.put(b'ij'))
+		buffer.consume(2)
+		return buffer
+
+	def test_put_wraps_around(self):
+		buffer = self.wrapped()
+		self.assertEqual(buffer.start, 6)
+		self.assertEqual(len(buffer), 4)
+		views = buffer.readable()
+		self.assertEqual(len(views), 2)
+		self.assertEqual(b''.join(views), b'ghij')
+		self.assertEqual(sum(len(view) for view in buffer.writable()), 4)
+
+	def test_put_fails_without_partial_write(self):
+		buffer = self.wrapped()
+		self.assertFalse(buffer.put(b'12345'))
+		self.assertEqual(b''.join(buffer.readable()), b'ghij')
+		self.assertTrue(buffer.put(b'1234'))
+		self.assertTrue(buffer.full())
+		self.assertEqual(b''.join(buffer.readable()), b'ghij1234')
+
+	def test_consume_across_end(self):
+		buffer = self.wrapped()
+		buffer.consume(3)
+		self.assertEqual(buffer.start, 1)
+		self.assertEqual(b''.join(buffer.readable()), b'j')
+		buffer.consume(1)
+		# Empty buffers start again at the front, keeping data contiguous
+		self.assertEqual(buffer.start, 0)
+		self.assertEqual(len(buffer.writable()), 1)
+
+	def test_consume_and_commit_limits(self):
+		buffer = self.wrapped()
+		with self.assertRaises(ValueError):
+			buffer.consume(5)
+		with self.assertRaises(ValueError):
+			buffer.commit(5)
+
+	def test_write_to_and_read_from_wrapped(self):
+		buffer = self.wrapped()
+		rx, tx = os.pipe()
+		try:
+			os.set_blocking(rx, False)
+			self.assertEqual(buffer.write_to(tx), 4)
+			self.assertEqual(len(buffer), 0)
+			self.assertEqual(buffer.write_to(tx), 0)
+			buffer = RingBuffer(8)
+			buffer.put(b'abcdef')
+			buffer.consume(4)
+			# Free space wraps around the end
+			self.assertEqual(len(buffer.writable()), 2)
+			self.assertEqual(buffer.read_from(rx), 4)
+			self.assertEqual(b''.join(buffer.readable()), b'efghij')
+			self.assertIsNone(buffer.read_from(rx))
+		finally:
+			os.close(rx)
+			os.close(tx)
+
+if __name__ == '__main__':
+	unittest.main()
@@ -0,0 +1,173 @@
+#!/usr/bin/python3
+
+import sys
+import json
+import socket
+import getopt
+
+from stats import percentile
+
+class Config():
+	''' Configuration for trace analyzer '''
+	# Collect spans from components on this host and port (see tracing.py) into out
+	listen = None
+	out = 'trace.log'
+	# Print the breakdown of each trace, not just the summary
+	traces = False
+
+def load(paths):
+	'''
+	Read spans from files, returns them grouped by trace id, in hop order.
+	Each response of a streamed request carries its own copy of the trace,
+	so a hop may have several spans: the nth response is taken to be the
+	nth span of each such hop, by the time of the component recording it,
+	and is returned as a trace of its own, with "/n" appended to the id.
+	'''
+	traces = dict()
+	for path in paths:
+		with open(path, 'r') as file:
+			for line in file:
+				try:
+					span = json.loads(line)
+				except ValueError:
+					continue
+				traces.setdefault(span['trace'], dict()).setdefault((span['index'], span['component'], span['event']), []).append(span)
+	result = dict()
+	for id, spans in traces.items():
+		keys = sorted(spans.keys(), key=lambda key: key[0])
+		for key in keys:
+			spans[key].sort(key=lambda span: span['t'])
+		count = max(len(spans[key]) for key in keys)
+		for response in range(count):
+			# Hops before the server responded are shared by all responses
+			result[id if count == 1 else id + '/' + str(response)] = [spans[key][response if len(spans[key]) > 1 else 0] for key in keys if response < len(spans[key]) or len(spans[key]) == 1]
+	return result
+
+def name(span):
+	return span['component'] + ' ' + span['event']
+
+def breakdown(spans):
+	'''
+	Durations between consecutive spans of a trace, as a list of (label,
+	seconds), where seconds is None if the spans were timed by different
+	clocks (e.g. bridges at either end of a serial link).  The list ends
+	with the total, from the first span to the last, and the time between
+	spans timed by different clocks, if both are known.
+	'''
+	hops = []
+	known = 0.0
+	for a, b in zip(spans, spans[1:]):
+		seconds = b['t'] - a['t'] if a['clock'] == b['clock'] else None
+		if seconds is not None:
+			known += seconds
+		hops.append((name(a) + ' -> ' + name(b), seconds))
+	if len(spans) > 1 and spans[0]['clock'] == spans[-1]['clock']:
+		total = spans[-1]['t'] - spans[0]['t']
+		hops.append(('total', total))
+		if None in (seconds for label, seconds in hops):
+			hops.append(('between clocks', total - known))
+	return hops
+
+def ms(seconds):
+	return '-' if seconds is None else '%.3f' % (seconds * 1000)
+
+class Analyzer():
+	''' Stitches spans into traces, and summarises the latency of each hop '''
+
+	def __init__(self, traces):
+		self.traces = traces
+
+	def report(self, show_traces=False):
+		hops = dict()
+		# Mean position of each hop, to list them in path order
+		positions = dict()
+		for id, spans in sorted(self.traces.items(), key=lambda item: item[1][0]['t']):
+			result = breakdown(spans)
+			if show_traces:
+				print('Trace ' + id + ':')
+				for label, seconds in result:
+					print('  %-60s %10s ms' % (label, ms(seconds)))
+				print('')
+			for position, (label, seconds) in enumerate(result):
+				hops.setdefault(label, []).append(seconds)
+				positions.setdefault(label, []).append(position if label not in ('total', 'between clocks') else 1e9)
+		print('%d traces' % len(self.traces))
+		print('')
+		print('%-60s %7s %10s %10s %10s %10s' % ('Hop', 'count', 'p50 ms', 'p95 ms', 'p99 ms', 'max ms'))
+		for label in sorted(hops.keys(), key=lambda label: sum(positions[label]) / len(positions[label])):
+			values = sorted(seconds for seconds in hops[label] if seconds is not None)
+			if not values:
+				print('%-60s %7d %10s (timed by different clocks)' % (label, len(hops[label]), '-'))
+				continue
+			print('%-60s %7d %10s %10s %10s %10s' % (label, len(hops[label]), ms(percentile(values, 50)), ms(percentile(values, 95)), ms(percentile(values, 99)), ms(values[-1])))
+
+def collect(config):
+	''' Append spans received from components to a file, until interrupted '''
+	host, port = config.listen.rsplit(':', 1)
+	with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock, open(config.out, 'a') as file:
+		sock.bind((host, int(port)))
+		print('Collecting spans on ' + config.listen + ' into ' + config.out)
+		while True:
+			packet, addr = sock.recvfrom(0x10000)
+			file.write(str(packet, 'utf-8').strip() + '\n')
+			file.flush()
+
+#################### DEMO / CLI STUFF COMES BELOW ####################
+
+class Program():
+	''' Wrapper to allow the analyzer to be invoked from command-line '''
+	def __init__(self, cmdline):
+		config = Config()
+		try:
+			opts, args = getopt.getopt(cmdline, '', ['listen=', 'out=', 'traces', 'help'])
+
+			for opt, val in opts:
+				if opt in ('--listen'):
+					config.listen = val
+				elif opt in ('--out'):
+					config.out = val
+				elif opt in ('--traces'):
+					config.traces = True
+				elif opt in ('--help'):
+					self.usage()
+					sys.exit(0)
+				else:
+					raise AssertionError('Unhandled option: ' + opt)
+			if config.listen is None and not args:
+				raise AssertionError('Files of spans to analyze are required, unless collecting with --listen')
+		except (getopt.GetoptError, ValueError, AssertionError) as err:
+			print(err)
+			self.usage()
+			sys.exit(1)
+		self.config = config
+		self.paths = args
+
+	def run(self):
+		if self.config.listen is not None:
+			try:
+				collect(self.config)
+			except KeyboardInterrupt:
+				pass
+			return
+		Analyzer(load(self.paths)).report(self.config.traces)
+
+	def usage(self):
+		print('Trace analyzer')
+		print('')
+		print('Stitches together the spans written by clients, bridges and servers run')
+		print('with --trace, and prints the latency of each hop with percentiles')
+		print('')
+		print('Syntax:')
+		print('')
+		print('  ./trace_analyze.py [--traces] <span file>...')
+		print('  ./trace_analyze.py --listen=localhost:7000 --out=trace.log')
+		print('')
+		print('    --traces                 Also print the breakdown of each trace')
+		print('    --listen=[host:port]     Collect spans sent to udp://host:port into the --out file')
+		print('')
+		print('  Hops between components timed by different clocks (i.e. on different hosts)')
+		print('  cannot be measured, so their sum is reported as "between clocks"')
+		print('')
+
+if __name__ == '__main__':
+	Program(sys.argv[1:]).run()
@@ -0,0 +1,119 @@
+''' Optional tracing of requests through clients, bridges and servers. '''
+
+import json
+import time
+import socket
+import secrets
+
+def clock_id():
+	''' Identifies the monotonic clock, so only timestamps from the same clock (host and boot) are compared '''
+	try:
+		with open('/proc/sys/kernel/random/boot_id', 'r') as file:
+			return socket.gethostname() + '/' + file.read().strip()
+	except OSError:
+		return socket.gethostname()
+
+class TraceSink():
+	'''
+	Where trace spans are written: a file (one JSON object per line,
+	appended to), or a collector given as udp://host:port, which receives
+	each span as a datagram (see trace_analyze.py --listen).
+	'''
+
+	def __init__(self, target):
+		self.file = None
+		self.sock = None
+		if target.startswith('udp://'):
+			host, port = target[len('udp://'):].rsplit(':', 1)
+			self.addr = (host, int(port))
+			self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+		else:
+			self.file = open(target, 'a')
+
+	def write(self, span):
+		line = json.dumps(span)
+		if self.sock is not None:
+			try:
+				self.sock.sendto(bytes(line, 'utf-8'), self.addr)
+			except OSError:
+				pass
+		else:
+			self.file.write(line + '\n')
+			self.file.flush()
+
+	def close(self):
+		if self.sock is not None:
+			self.sock.close()
+		if self.file is not None:
+			self.file.close()
+
+class Tracer():
+	'''
+	Records the hops of traced messages for one component.
+
+	A trace travels in a message as { "id": ..., "hops": [[component, event,
+	timestamp, clock], ...] }, each component appending its hops with the
+	time of its monotonic clock.  Each hop is also written to the sink as a
+	span, with its index in the list of hops, so that spans from all
+	components can be put back in order (see trace_analyze.py).  Spans
+	which cannot be carried in the message (e.g. a bridge dequeuing a
+	message it already encoded) are written with a fractional index
+	following the hop they belong to.
+	'''
+
+	def __init__(self, target, component):
+		self.sink = TraceSink(target)
+		self.component = component
+		self.clock = clock_id()
+
+	def start(self):
+		''' Start a trace for a new message '''
+		trace = { 'id': secrets.token_hex(8), 'hops': [] }
+		self.hop(trace, 'send')
+		return trace
+
+	def hop(self, trace, event):
+		''' Append a hop to a trace, returns its index '''
+		index = len(trace['hops'])
+		now = time.monotonic()
+		trace['hops'].append([self.component, event, now, self.clock])
+		self.span(trace['id'], event, index, now)
+		return index
+
+	def span(self, id, event, index, now=None):
+		''' Record a span which is not carried in the message '''
+		self.sink.write({
+			'trace': id,
+			'component': self.component,
+			'event': event,
+			'index': index,
+			't': time.monotonic() if now is None else now,
+			'clock': self.clock
+		})
+
+	def close(self):
+		self.sink.close()
+
+def get_trace(msg):
+	''' The trace carried by a message, or None '''
+	trace = msg.get('trace') if isinstance(msg, dict) else None
+	if not isinstance(trace, dict) or not isinstance(trace.get('id'), str) or not isinstance(trace.get('hops'), list):
+		return None
+	return trace
+
+def extract(packet):
+	'''
+	Decode a traced JSON packet, returns (message, trace), or (None, None)
+	if the packet is not traced.  Only packets mentioning a trace are
+	decoded, so untraced traffic costs a substring search.
+	'''
+	if b'"trace"' not in packet:
+		return (None, None)
+	try:
+		msg = json.loads(str(packet, 'utf-8'))
+	except ValueError:
+		return (None, None)
+	trace = get_trace(msg)
+	if trace is None:
+		return (None, None)
+	return (msg, trace)
@@ -0,0 +1,262 @@
+import os
+import json
+import time
+import bisect
+
+def valid_session(session):
+	return isinstance(session, str) and 0 < len(session) <= 64 and not session.strip('ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz0123456789-_')
+
+class InvalidSessionError(ValueError):
+	pass
+
+class RangeSet():
+	''' Sorted, non-overlapping [start, end) byte ranges '''
+
+	def __init__(self):
+		self.starts = []
+		self.ends = []
+
+	def add(self, start, end):
+		if start >= end:
+			return
+		# Merge with every range which overlaps or touches [start, end)
+		first = bisect.bisect_left(self.ends, start)
+		last = bisect.bisect_right(self.starts, end)
+		if first < last:
+			start = min(start, self.starts[first])
+			end = max(end, self.ends[last - 1])
+		self.starts[first:last] = [start]
+		self.ends[first:last] = [end]
+
+	def total(self):
+		return sum(end - start for start, end in zip(self.starts, self.ends))
+
+	def missing(self, size):
+		''' Ranges of [0, size) which are not in the set '''
+		missing = []
+		offset = 0
+		for start, end in zip(self.starts, self.ends):
+			if start > offset:
+				missing.append([offset, min(start, size)])
+			offset = max(offset, end)
+			if offset >= size:
+				break
+		if offset < size:
+			missing.append([offset, size])
+		return missing
+
+	def __len__(self):
+		return len(self.starts)
+
+class TransferSession():
+	'''
+	An upload to a path, written to a partial file alongside it.
+
+	Byte ranges written are recorded in an append-only journal so the upload
+	can resume after the link (or the server) goes down.  Data is synced to
+	disk before the ranges covering it are journaled, which happens whenever
+	the client asks which ranges are missing.
+	'''
+
+	def __init__(self, journal, session, path, size):
+		self.journal = journal
+		self.session = session
+		self.path = path
+		self.size = size
+		self.partial = path + '.' + session[0:8] + '.part'
+		self.received = RangeSet()
+		self.pending = []
+		self.records = 0
+		self.fd = None
+		self.deadline = None
+		# When the session was last used, to abandon it after the journal's ttl
+		self.used = time.time()
+
+	def header(self):
+		return json.dumps({ 'path': self.path, 'size': self.size })
+
+	def open(self):
+		if self.fd is None:
+			self.fd = os.open(self.partial, os.O_RDWR | os.O_CREAT | os.O_CLOEXEC, 0o666)
+		self.used = time.time()
+		self.deadline = self.used + self.journal.timeout
+		return self.fd
+
+	def write(self, offset, data):
+		if offset < 0 or offset + len(data) > self.size:
+			raise InvalidSessionError('Write outside of file')
+		length = os.pwrite(self.open(), data, offset)
+		self.pending.append((offset, offset + length))
+		return length
+
+	def sync(self):
+		''' Make received data durable, then record it in the journal '''
+		if not self.pending:
+			return
+		os.fdatasync(self.open())
+		lines = ''.join(str(start) + ' ' + str(end) + '\n' for start, end in self.pending)
+		for start, end in self.pending:
+			self.received.add(start, end)
+		self.pending = []
+		self.records += lines.count('\n')
+		with open(self.journal.path_of(self.session), 'a') as file:
+			file.write(lines)
+			file.flush()
+			os.fdatasync(file.fileno())
+		if self.records > 2 * len(self.received) + 64:
+			self.compact()
+
+	def compact(self):
+		''' Rewrite the journal with one record per received range '''
+		path = self.journal.path_of(self.session)
+		with open(path + '.tmp', 'w') as file:
+			file.write(self.header() + '\n')
+			for start, end in zip(self.received.starts, self.received.ends):
+				file.write(str(start) + ' ' + str(end) + '\n')
+			file.flush()
+			os.fdatasync(file.fileno())
+		os.replace(path + '.tmp', path)
+		self.records = len(self.received)
+
+	def missing(self):
+		self.sync()
+		return self.received.missing(self.size)
+
+	def close(self):
+		if self.fd is not None:
+			os.close(self.fd)
+			self.fd = None
+
+	def commit(self):
+		if self.missing():
+			raise InvalidSessionError('Transfer is incomplete')
+		os.ftruncate(self.open(), self.size)
+		self.close()
+		os.replace(self.partial, self.path)
+		self.journal.remove(self.session)
+
+	def abort(self):
+		self.close()
+		try:
+			os.unlink(self.partial)
+		except FileNotFoundError:
+			pass
+		self.journal.remove(self.session)
+
+class TransferJournal():
+	'''
+	Transfer sessions, persisted as one journal file per session in a
+	directory.
+
+	Sessions unused for ttl seconds are abandoned, deleting their journal
+	and partial file, including those left by earlier runs of the server
+	(found by the modification time of their journal).  Journals whose
+	header cannot be read are discarded.
+	'''
+
+	# Seconds between looking for abandoned journals left by earlier runs
+	scan_interval = 60.0
+
+	def __init__(self, path, timeout, ttl=86400):
+		self.path = path
+		self.timeout = timeout
+		self.ttl = ttl
+		self.sessions = dict()
+		self.next_scan = 0
+		os.makedirs(path, exist_ok=True)
+
+	def path_of(self, session):
+		return os.path.join(self.path, session + '.journal')
+
+	def create(self, session, path, size):
+		''' Start a new session, or return the existing session for the same upload '''
+		existing = self.get(session)
+		if existing is not None:
+			if existing.path != path or existing.size != size:
+				raise InvalidSessionError('Session exists for a different transfer')
+			return existing
+		transfer = TransferSession(self, session, path, size)
+		with open(self.path_of(session), 'w') as file:
+			file.write(transfer.header() + '\n')
+			file.flush()
+			os.fdatasync(file.fileno())
+		self.sessions[session] = transfer
+		return transfer
+
+	def get(self, session):
+		''' Return a session, loading it from its journal if needed, or None if there is no such session '''
+		if not valid_session(session):
+			raise InvalidSessionError('Invalid session identifier')
+		transfer = self.sessions.get(session)
+		if transfer is not None:
+			transfer.used = time.time()
+			return transfer
+		try:
+			with open(self.path_of(session), 'r') as file:
+				header = self.read_header(file)
+				if header is None:
+					print('Discarding session "' + session + '" with a corrupt journal')
+					self.remove(session)
+					return None
+				transfer = TransferSession(self, session, header['path'], header['size'])
+				for line in file:
+					fields = line.split()
+					# Ignore a record torn by a crash
+					if len(fields) == 2 and line.endswith('\n') and fields[0].isdigit() and fields[1].isdigit():
+						transfer.received.add(int(fields[0]), int(fields[1]))
+						transfer.records += 1
+		except FileNotFoundError:
+			return None
+		self.sessions[session] = transfer
+		return transfer
+
+	def read_header(self, file):
+		''' Read the header of a journal, returns None if it is torn or corrupt '''
+		try:
+			header = json.loads(file.readline())
+		except (ValueError, UnicodeDecodeError):
+			return None
+		if not isinstance(header, dict) or not isinstance(header.get('path'), str) or not isinstance(header.get('size'), int):
+			return None
+		return header
+
+	def remove(self, session):
+		self.sessions.pop(session, None)
+		try:
+			os.unlink(self.path_of(session))
+		except FileNotFoundError:
+			pass
+
+	def prune(self):
+		''' Close files of idle sessions, which are reopened when next used, and abandon unused sessions '''
+		now = time.time()
+		for transfer in list(self.sessions.values()):
+			if transfer.used + self.ttl < now:
+				transfer.abort()
+			elif transfer.fd is not None and transfer.deadline < now:
+				transfer.sync()
+				transfer.close()
+		if now >= self.next_scan:
+			self.next_scan = now + self.scan_interval
+			self.scan(now)
+
+	def scan(self, now):
+		''' Abandon sessions of earlier runs whose journals were not written for ttl seconds '''
+		with os.scandir(self.path) as entries:
+			for entry in entries:
+				if not entry.name.endswith('.journal'):
+					continue
+				session = entry.name[0:-len('.journal')]
+				if session in self.sessions or not valid_session(session):
+					continue
+				try:
+					if entry.stat().st_mtime + self.ttl >= now:
+						continue
+					with open(entry.path, 'r') as file:
+						header = self.read_header(file)
+				except FileNotFoundError:
+					continue
+				if header is not None:
+					TransferSession(self, session, header['path'], header['size']).abort()
+				else:
+					self.remove(session)
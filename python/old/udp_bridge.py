@@ -2,16 +2,17 @@
 
 ''' Linux only.  Requires PySerial. '''
 
-import os
 import sys
 import getopt
-import fcntl
-import select
-from serial import Serial
 import socket
-from asyncio import Queue
+import asyncio
 
-import kiss
+import json
+
+import capture
+import fragment
+import tracing
+import serial_transport
 
 class Config():
 	''' Configuration for UART/UDP bridge '''
@@ -23,113 +24,189 @@ class Config():
 	client_port = 5556
 	ttl = 2
 	max_read_size = 0x10000
+	# Bytes waiting to be sent to UART beyond which UDP is not read
+	tx_buffer = 0x100000
+	# Largest fragment of a datagram to send over UART, or 0 to send
+	# datagrams whole as bridges without fragmentation do (both ends of the
+	# link must agree), and limits on datagrams being reassembled from fragments
+	mtu = 0
+	reassembly_timeout = 10.0
+	reassembly_bytes = 0x400000
+	reassembly_packets = 64
+	# File or udp://host:port collector to write trace spans of traced
+	# messages to, and name of this bridge in traces
+	trace = None
+	trace_name = 'bridge'
+	# File to append a capture of the traffic over the serial link to (see
+	# capture.py and replay.py)
+	capture = None
 	quiet = False
 
-''' UART/UDP bridge implementation '''
-class Bridge():
+class SerialSide(serial_transport.KissProtocol):
+	''' Packets from the serial link, passed to the bridge '''
+	def __init__(self, bridge):
+		super(SerialSide, self).__init__()
+		self.bridge = bridge
+
+	def data_received(self, data):
+		if self.bridge.capture is not None:
+			self.bridge.capture.write(capture.RX_BYTES, data)
+		super(SerialSide, self).data_received(data)
+
+	def packet_received(self, packet):
+		self.bridge.uart_packet(packet)
+
+	def send_packet(self, packet):
+		data = self.encoder.apply(packet)
+		if self.bridge.capture is not None:
+			self.bridge.capture.write(capture.TX_BYTES, data)
+		self.transport.write(data)
 
-	# Note: we currently do not enforce a maximum size on the buffers.
-	#
-	# If you use this code in production, you definitely should set an upper
-	# limit.
+	def resume_writing(self):
+		super(SerialSide, self).resume_writing()
+		self.bridge.feed()
 
-	# Buffer of bytes's from UDP to send to UART
-	send_buf = Queue()
+class DatagramSide(asyncio.DatagramProtocol):
+	''' Datagrams from UDP, passed to the bridge '''
+	def __init__(self, bridge):
+		self.bridge = bridge
+
+	def datagram_received(self, packet, addr):
+		self.bridge.udp_packet(packet, addr)
+
+	def error_received(self, exc):
+		print('Socket error: ' + str(exc))
+
+	def pause_writing(self):
+		self.bridge.uart.transport.pause_reading()
+
+	def resume_writing(self):
+		self.bridge.uart.transport.resume_reading()
+
+''' UART/UDP bridge implementation '''
+class Bridge():
+	'''
+	Relays datagrams over a serial link, on one asyncio event loop.
 
-	# Buffer of packets from UART to send to UDP
-	recv_buf = Queue()
+	Datagrams are split into fragments of up to mtu bytes (see
+	fragment.py), which are passed to the serial transport one at a time
+	as it drains, so that short datagrams can be sent between the
+	fragments of long ones.
 
-	next_uart_write = None
+	Data waiting to be sent either way is bounded: while more than
+	tx_buffer bytes wait to be written to the serial link, the UDP socket is
+	not read (so datagrams queue up in, and are eventually dropped by, the
+	kernel), and while the socket's send buffer is full the serial link is
+	not read.
+	'''
 
-	# Codec for packet access over character device
-	encoder = kiss.Encoder()
-	decoder = kiss.Decoder()
+	# Serial protocol and datagram transport
+	uart = None
+	udp = None
+	udp_paused = False
+	# Pending call to feed() once the device has sent what it has
+	feed_handle = None
 
 	def __init__(self, config):
-		''' Main event loop '''
 		self.config = config
+		self.fragmenter = fragment.Fragmenter(config.mtu)
+		self.reassembler = fragment.Reassembler(config.reassembly_timeout, config.reassembly_bytes, config.reassembly_packets)
+		self.tracer = tracing.Tracer(config.trace, config.trace_name) if config.trace else None
+		self.capture = capture.CaptureWriter(config.capture) if config.capture else None
+		# Largest fragment, KISS-encoded
+		self.frame_size = 2 * ((config.mtu + fragment.fragment_header.size) if config.mtu else config.max_read_size) + 2
+
+	async def run(self):
+		''' Relay until the serial link is closed '''
+		config = self.config
+		loop = asyncio.get_running_loop()
 		# Open serial port and socket
-		with Serial(config.device, config.baud) as uart, socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
-			self.uart = uart
-			self.sock = sock
-			# Get file descriptors and configure them for non-blocking IO
-			uart_fileno = uart.fileno()
-			sock_fileno = sock.fileno()
-			self.uart_fileno = uart_fileno
-			self.sock_fileno = sock_fileno
-			for fd in [uart_fileno, sock_fileno]:
-				fcntl.fcntl(fd, fcntl.F_SETFL, fcntl.fcntl(fd, fcntl.F_GETFL) | os.O_NONBLOCK)
-			# Configure socket
-			sock.bind((config.server_host, config.server_port))
-			sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_TTL, config.ttl)
-			while True:
-				# Wait for UART or STDIN to become readable (TODO: conditionally add descriptors if send/recv buffer are not full)
-				want_read = []
-				want_read.append(uart_fileno)
-				want_read.append(sock_fileno)
-				# If we have data buffered to send, also wait for UART to become writeable
-				want_write = []
-				if not self.send_buf.empty() or self.next_uart_write is not None:
-					want_write.append(uart_fileno)
-				if not self.recv_buf.empty():
-					want_write.append(sock_fileno)
-				# Wait for event
-				r, w, e = select.select(want_read, want_write, [])
-				# Error
-				if e:
-					print('Error occurred')
-					break
-				# Read/write
-				if sock_fileno in r:
-					self.read_socket()
-				if uart_fileno in w:
-					self.write_uart()
-				if uart_fileno in r:
-					self.read_uart()
-				if sock_fileno in w:
-					self.write_socket()
-
-	def read_socket(self):
-		# Read packet from UDP
+		uart_transport, self.uart = await serial_transport.create_serial_connection(loop, lambda: SerialSide(self), config.device, config.baud)
 		try:
-			packet, addr = self.sock.recvfrom(self.config.max_read_size)
-		except BlockingIOError:
-			print('Unexpected BlockingIOError while reading socket')
+			uart_transport.max_read_size = config.max_read_size
+			# Buffer no more than one fragment in the transport
+			uart_transport.set_write_buffer_limits(high=self.frame_size, low=0)
+			self.udp, protocol = await loop.create_datagram_endpoint(lambda: DatagramSide(self), local_addr=(config.server_host, config.server_port))
+			try:
+				# Configure socket
+				self.udp.get_extra_info('socket').setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_TTL, config.ttl)
+				exc = await self.uart.closed
+				if exc is not None:
+					print('Serial link failed: ' + str(exc))
+			finally:
+				self.udp.close()
+		finally:
+			uart_transport.abort()
+			if self.capture is not None:
+				self.capture.close()
+
+	def udp_packet(self, packet, addr):
+		if len(packet) > self.config.max_read_size:
+			print("Packet of " + str(len(packet)) + " bytes received from " + str(addr) + " is too large, dropped")
 			return
 		if not self.config.quiet:
 			print("Packet of " + str(len(packet)) + " bytes received from " + str(addr))
-		data = self.encoder.apply(packet)
-		self.send_buf.put_nowait(data)
-
-	def write_uart(self):
-		# Write data from TX buffer then remove the amount written
-		# from the buffer
-		if self.next_uart_write is None:
-			data = self.send_buf.get_nowait()
-		else:
-			data = self.next_uart_write
-		written = os.write(self.uart_fileno, data)
-		if written < len(data):
-			self.next_uart_write = data[written:]
-		else:
-			self.next_uart_write = None
-
-	def read_uart(self):
-		try:
-			data = os.read(self.uart_fileno, self.config.max_read_size)
-		except BlockingIOError:
-			print('Unexpected BlockingIOError while reading serial link, is another program using it?')
-			return
-		# Decode byte stream to packets using KISS decoder
-		packets = self.decoder.apply(data)
-		for packet in packets:
-			if not self.config.quiet:
-				print("Packet of " + str(len(packet)) + " bytes received from serial link")
-			self.recv_buf.put_nowait(packet)
+		done = None
+		if self.tracer is not None:
+			packet, done = self.trace_enqueue(packet)
+		if self.capture is not None:
+			self.capture.write(capture.TX_PACKET, packet)
+		self.fragmenter.add(packet, done)
+		if self.fragmenter.size > self.config.tx_buffer and not self.udp_paused:
+			self.udp_paused = True
+			self.udp.pause_reading()
+		self.feed()
+
+	def feed(self):
+		''' Pass fragments to the serial transport until it, or the device, has one buffered '''
+		while self.uart.writable.is_set() and self.fragmenter:
+			queued = self.uart.transport.get_output_queue_size()
+			if queued > self.frame_size:
+				# Come back when the device has sent most of it (at about 10
+				# bits per byte), so later fragments do not queue behind it
+				if self.feed_handle is None:
+					self.feed_handle = asyncio.get_running_loop().call_later((queued - self.frame_size) * 10 / self.config.baud, self._feed_later)
+				break
+			self.uart.send_packet(self.fragmenter.next())
+		if self.udp_paused and self.fragmenter.size <= self.config.tx_buffer // 4:
+			self.udp_paused = False
+			self.udp.resume_reading()
+
+	def trace_enqueue(self, packet):
+		'''
+		Add an enqueue hop to a traced packet, returns the packet and a
+		function recording when it is dequeued, which can only be written
+		as a span as the packet has been sent by then.
+		'''
+		msg, trace = tracing.extract(packet)
+		if trace is None:
+			return (packet, None)
+		index = self.tracer.hop(trace, 'enqueue')
+		return (bytes(json.dumps(msg), 'utf-8'), lambda: self.tracer.span(trace['id'], 'dequeue', index + 0.5))
 
-	def write_socket(self):
-		packet = self.recv_buf.get_nowait()
-		self.sock.sendto(packet, (self.config.client_host, self.config.client_port))
+	def _feed_later(self):
+		self.feed_handle = None
+		self.feed()
+
+	def uart_packet(self, packet):
+		if self.config.mtu:
+			dropped = self.reassembler.expired + self.reassembler.evicted + self.reassembler.malformed
+			packet = self.reassembler.add(packet)
+			dropped = self.reassembler.expired + self.reassembler.evicted + self.reassembler.malformed - dropped
+			if dropped:
+				print("Dropped " + str(dropped) + " incomplete packet(s) received from serial link")
+			if packet is None:
+				return
+		if not self.config.quiet:
+			print("Packet of " + str(len(packet)) + " bytes received from serial link")
+		if self.tracer is not None:
+			msg, trace = tracing.extract(packet)
+			if trace is not None:
+				self.tracer.hop(trace, 'receive')
+				packet = bytes(json.dumps(msg), 'utf-8')
+		if self.capture is not None:
+			self.capture.write(capture.RX_PACKET, packet)
+		self.udp.sendto(packet, (self.config.client_host, self.config.client_port))
 
 #################### DEMO / CLI STUFF COMES BELOW ####################
 
@@ -150,6 +227,11 @@ class Program():
 				'rx_host=', 'rx_port=',
 				'ttl=',
 				'max_read_size=',
+				'tx_buffer=',
+				'mtu=',
+				'reassembly_timeout=', 'reassembly_bytes=', 'reassembly_packets=',
+				'trace=', 'trace_name=',
+				'capture=',
 				'quiet'])
 
 			for opt, val in opts:
@@ -169,19 +251,40 @@ class Program():
 					config.ttl = int(val)
 				elif opt in ('--max_read_size'):
 					config.max_read_size = int(val)
+				elif opt in ('--tx_buffer'):
+					config.tx_buffer = int(val, 0)
+				elif opt in ('--mtu'):
+					config.mtu = int(val)
+				elif opt in ('--reassembly_timeout'):
+					config.reassembly_timeout = float(val)
+				elif opt in ('--reassembly_bytes'):
+					config.reassembly_bytes = int(val, 0)
+				elif opt in ('--reassembly_packets'):
+					config.reassembly_packets = int(val)
+				elif opt in ('--trace'):
+					config.trace = val
+				elif opt in ('--trace_name'):
+					config.trace_name = val
+				elif opt in ('--capture'):
+					config.capture = val
 				elif opt in ('--quiet'):
 					config.quiet = True
 				else:
 					raise AssertionError('Unhandled option: ' + opt)
 			if None in (config.device, config.baud, config.server_host, config.server_port, config.client_host, config.client_port, config.ttl, config.max_read_size):
 				raise AssertionError('Required parameter missing')
+			if config.mtu < 0 or (config.mtu > 0 and -(-config.max_read_size // config.mtu) > 0xffff):
+				raise AssertionError('--mtu must be 0, or large enough to split a datagram into at most 65535 fragments')
 			if args:
 				raise AssertionError('Unexpected trailing arguments')
 		except (getopt.GetoptError, ValueError) as err:
 			print(err)
 			self.usage()
 			sys.exit(1)
-		Bridge(config)
+		self.config = config
+
+	def run(self):
+		asyncio.run(Bridge(self.config).run())
 
 	def usage(self):
 		print('UART communications demo')
@@ -200,6 +303,11 @@ class Program():
 		print('                  --client_host=localhost --client_port=5556')
 		print('                  --ttl=2')
 		print('                  --max_read_size=65536')
+		print('                  --tx_buffer=1048576')
+		print('                  --mtu=0')
+		print('                  --reassembly_timeout=10 --reassembly_bytes=4194304 --reassembly_packets=64')
+		print('                  --trace=[file or udp://host:port] --trace_name=bridge')
+		print('                  --capture=[file]')
 		print('                  --quiet')
 		print('')
 		print('    --device=[value]         Path to serial device  ')
@@ -213,6 +321,24 @@ class Program():
 		print('    --ttl=[value]            TTL value for packets sent to client (useful if sending to multicast group)')
 		print('')
 		print('    --max_read_size=[value]  Maximum amount of data to read in one operation, in bytes')
+		print('    --tx_buffer=[value]      Bytes waiting to be sent over the serial link beyond which')
+		print('                             datagrams are left queued in the socket')
+		print('')
+		print('    --mtu=[value]            Largest fragment of a datagram to send over the serial link, in bytes,')
+		print('                             with short datagrams sent between the fragments of long ones.  0 (the')
+		print('                             default) sends datagrams whole.  Both ends of the link must fragment,')
+		print('                             or both not')
+		print('    --reassembly_timeout=[value]  Seconds to wait for the next fragment of a datagram before dropping it')
+		print('    --reassembly_bytes=[value]    Most bytes of fragments to hold, and datagrams to reassemble at once,')
+		print('    --reassembly_packets=[value]  beyond which the least recently updated datagram is dropped')
+		print('')
+		print('    --trace=[value]          Add hops to traced messages (see udp_client --trace) and write')
+		print('                             their spans to a file, or a udp://host:port collector')
+		print('    --trace_name=[value]     Name of this bridge in traces')
+		print('')
+		print('    --capture=[value]        Append the bytes read from and written to the serial device, and the')
+		print('                             datagrams received and sent over it, with timestamps, to a capture')
+		print('                             file (see replay.py)')
 		print('')
 		print('    --quiet                  Suppresses logging of each packet length and origin')
 		print('')
@@ -225,4 +351,4 @@ class Program():
 		print('')
 
 if __name__ == '__main__':
-	Program(sys.argv[1:])
+	Program(sys.argv[1:]).run()
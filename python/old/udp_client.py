@@ -2,12 +2,15 @@
 
 import sys
 import socket
+import collections
 import getopt
 import json
 import datetime
 import time
 import secrets
 
+import tracing
+
 class Config():
 	tx_host = 'localhost'
 	tx_port = 5555
@@ -16,6 +19,10 @@ class Config():
 	max_read_size = 0x10000
 	topic = 'demo'
 	timeout = 1
+	# File or udp://host:port collector to write trace spans to (which also
+	# makes requests carry a trace), and name of this component in traces
+	trace = None
+	trace_name = 'client'
 
 class UdpClientError(RuntimeError):
 	def __init__(self, msg):
@@ -35,9 +42,14 @@ class Client():
 	config = None
 	client = None
 	seq = 0
+	tracer = None
 
 	def __init__(self, config):
 		self.client = secrets.token_urlsafe(10)
+		if config.trace:
+			self.tracer = tracing.Tracer(config.trace, config.trace_name)
+		# Events received while waiting for responses
+		self.events = collections.deque(maxlen=100)
 		sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
 		self.config = config
 		self.sock = sock
@@ -49,29 +61,41 @@ class Client():
 
 	def __exit__(self, *args, **kwargs):
 		self.sock.__exit__(*args, **kwargs)
-		return self
+		# Do not suppress exceptions
+		return False
 
 	def request(self, command, data, timeout=None):
-		if timeout is None:
-			timeout = self.config.timeout
-		timeout = float(timeout)
-		self.sock.settimeout(self.config.timeout)
-		deadline = time.time() + float(timeout)
-		client = self.client
+		seq = self.send_request(command, data)
+		for res in self.receive_responses(command, seq, 1, timeout):
+			return res
+		raise RequestTimeoutError('Timed out while waiting for response')
+
+	def send_request(self, command, data):
+		''' Send a request without waiting for a response, returns the sequence value '''
 		seq = self.seq
 		self.seq = self.seq + 1
-		topic = self.config.topic
 		req = {
 			'type': 'request',
-			'client': client,
-			'topic': topic,
+			'client': self.client,
+			'topic': self.config.topic,
 			'seq': seq,
 			'command': command,
 			'data': data
 		}
+		if self.tracer is not None:
+			req['trace'] = self.tracer.start()
 		self.sock.sendto(bytes(json.dumps(req), "utf-8"), (self.config.tx_host, self.config.tx_port))
+		return seq
+
+	def receive_responses(self, command, seq, count, timeout=None):
+		''' Generate the data of up to "count" responses to a request, until the timeout expires '''
+		if timeout is None:
+			timeout = self.config.timeout
+		deadline = time.time() + float(timeout)
+		client = self.client
+		topic = self.config.topic
 		do_while = True
-		while do_while or time.time() < deadline:
+		while count > 0 and (do_while or time.time() < deadline):
 			do_while = False
 			try:
 				timeout = max(deadline - time.time(), 0)
@@ -80,14 +104,20 @@ class Client():
 			except socket.timeout:
 				break
 			res = json.loads(str(packet, "utf-8"))
-			if res.get('type') != 'response':
-				continue
 			if res.get('client') != client:
 				continue
 			if res.get('topic') != topic:
 				continue
+			if res.get('type') == 'event':
+				self.events.append(res)
+				continue
+			if res.get('type') != 'response':
+				continue
 			if res.get('seq') != seq:
 				continue
+			trace = tracing.get_trace(res)
+			if trace is not None and self.tracer is not None:
+				self.tracer.hop(trace, 'receive')
 			if res.get('command') != command:
 				raise InvalidResponseError('Command mismatch')
 			err = res.get('error')
@@ -96,8 +126,29 @@ class Client():
 			data = res.get('data')
 			if data is None:
 				raise InvalidResponseError('No data in response')
-			return data
-		raise RequestTimeoutError('Timed out while waiting for response')
+			count -= 1
+			yield data
+
+	def receive_events(self, timeout=None):
+		''' Generate events (command, data) received so far, then any received until the timeout expires '''
+		if timeout is None:
+			timeout = self.config.timeout
+		deadline = time.time() + float(timeout)
+		while True:
+			while self.events:
+				event = self.events.popleft()
+				yield (event.get('command'), event.get('data'))
+			timeout = deadline - time.time()
+			if timeout <= 0:
+				break
+			try:
+				self.sock.settimeout(timeout)
+				packet, addr = self.sock.recvfrom(self.config.max_read_size)
+			except socket.timeout:
+				break
+			res = json.loads(str(packet, "utf-8"))
+			if res.get('type') == 'event' and res.get('client') == self.client and res.get('topic') == self.config.topic:
+				self.events.append(res)
 
 #################### DEMO / CLI STUFF COMES BELOW ####################
 
@@ -106,7 +157,7 @@ class Program():
 		# Extract configuration from command line arguments
 		config = Config()
 		try:
-			opts, args = getopt.getopt(cmdline, '', ['tx_host=', 'tx_port=', 'rx_host=', 'rx_port=', 'max_read_size=', 'timeout='])
+			opts, args = getopt.getopt(cmdline, '', ['tx_host=', 'tx_port=', 'rx_host=', 'rx_port=', 'max_read_size=', 'topic=', 'timeout=', 'trace=', 'trace_name='])
 
 			for opt, val in opts:
 				if opt in ('--tx_host'):
@@ -123,6 +174,10 @@ class Program():
 					config.topic = val
 				elif opt in ('--timeout'):
 					config.timeout = float(val)
+				elif opt in ('--trace'):
+					config.trace = val
+				elif opt in ('--trace_name'):
+					config.trace_name = val
 				else:
 					raise AssertionError('Unhandled option: ' + opt)
 			if None in (config.tx_host, config.tx_port, config.rx_host, config.rx_port, config.max_read_size, config.topic, config.timeout):
@@ -155,11 +210,14 @@ class Program():
 					elif command == 'quit':
 						print('(Quitting)')
 						break
+					elif command == 'events':
+						for event, data in client.receive_events():
+							print('(Event "' + str(event) + '") ' + str(data))
 					else:
 						res = client.request(command, json.loads(req))
 						print(res)
 					if command == 'help':
-						print('(Extra client-side commands: topic, quit)')
+						print('(Extra client-side commands: topic, events, quit)')
 				except InvalidResponseError as err:
 					print('(Received invalid response from server: ' + err.message + ')')
 					print('')
@@ -181,11 +239,13 @@ class Program():
 		print('')
 		print('Syntax:')
 		print('')
+		config = Config()
 		print('  ./udp_client.py')
-		print('                  --tx_host=' + config.tx_host + ' --tx_port=' + int(config.tx_port))
-		print('                  --rx_host=' + config.rx_host + ' --rx_port=' + int(config.rx_port))
+		print('                  --tx_host=' + config.tx_host + ' --tx_port=' + str(config.tx_port))
+		print('                  --rx_host=' + config.rx_host + ' --rx_port=' + str(config.rx_port))
 		print('                  --topic=' + config.topic)
 		print('                  --max_read_size=' + hex(config.max_read_size))
+		print('                  --trace=' + str(config.trace) + ' --trace_name=' + config.trace_name + '  (trace requests, writing spans to a file or udp://host:port collector)')
 		print('')
 
 if __name__ == '__main__':
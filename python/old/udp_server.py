@@ -1,12 +1,20 @@
 #!/usr/bin/python3
 
+import os
 import sys
 import socket
 import getopt
 import json
 import time
+import select
 import datetime
+import collections
 import traceback
+import cProfile
+import pstats
+
+import tracing
+import workers
 
 class Config(object):
 	def __init__(self):
@@ -17,11 +25,155 @@ class Config(object):
 		self.topic = 'demo'
 		self.max_read_size = 0x10000
 		self.quiet = False
+		# File or udp://host:port collector to write trace spans to, and
+		# name of this component in traces
+		self.trace = None
+		self.trace_name = 'server'
+		# Processes to serve requests with (see workers.py)
+		self.workers = 1
+
+	# Extra long options (getopt syntax) accepted by parse_config, for
+	# programs which extend this configuration
+	options = []
+
+	def parse_option(self, opt, val):
+		''' Handle an extra option, return False if not recognised '''
+		return False
+
+	def show_usage(self):
+		''' Print usage for extra options '''
+		pass
 
 class RejectRequest(BaseException):
 	def __init__(self, message):
 		self.message = message
 
+class Stream():
+	'''
+	Returned by a command handler to send zero or more responses to one
+	request, each item of the iterable becoming the data of one response.
+
+	Items are produced as the responses are sent, so handler time recorded
+	for streamed commands includes producing the items (but not sending).
+	'''
+	def __init__(self, items):
+		self.items = items
+
+class Deferred():
+	'''
+	Returned by a command handler which completes its work elsewhere (e.g.
+	in a worker thread), wrapping a concurrent.futures.Future.  The response
+	is sent when the future completes, its result becoming the data of the
+	response.  Exceptions raised by the future are reported as by a handler.
+
+	The future may complete on any thread: the response is sent by the
+	thread handling requests (see Server.complete_deferred), and a
+	FairServer charges it to the client as any other response.
+
+	Handler time recorded for deferred commands runs until completion.
+	'''
+	def __init__(self, future):
+		self.future = future
+
+class Histogram():
+	''' Histogram of durations with power-of-two microsecond buckets '''
+
+	def __init__(self):
+		self.buckets = dict()
+		self.count = 0
+		self.total = 0.0
+		self.max = 0.0
+
+	def add(self, seconds):
+		# Bucket n holds durations in [2^(n-1), 2^n) microseconds
+		bucket = int(seconds * 1e6).bit_length()
+		self.buckets[bucket] = self.buckets.get(bucket, 0) + 1
+		self.count += 1
+		self.total += seconds
+		self.max = max(self.max, seconds)
+
+	def percentile(self, p):
+		''' Upper bound of the bucket containing the given percentile, in seconds '''
+		if not self.count:
+			return None
+		threshold = self.count * p / 100.0
+		seen = 0
+		for bucket in sorted(self.buckets.keys()):
+			seen += self.buckets[bucket]
+			if seen >= threshold:
+				return min((1 << bucket) / 1e6, self.max)
+		return self.max
+
+	def merge(self, other):
+		for bucket, count in other.buckets.items():
+			self.buckets[bucket] = self.buckets.get(bucket, 0) + count
+		self.count += other.count
+		self.total += other.total
+		self.max = max(self.max, other.max)
+
+	def summary(self):
+		return {
+			'count': self.count,
+			'mean': self.total / self.count if self.count else None,
+			'max': self.max,
+			'p50': self.percentile(50),
+			'p95': self.percentile(95),
+			'p99': self.percentile(99),
+			'buckets_us': { str(1 << bucket): count for bucket, count in sorted(self.buckets.items()) }
+		}
+
+class CommandStats():
+	''' Metrics recorded for one command '''
+
+	def __init__(self):
+		self.calls = 0
+		self.errors = 0
+		self.handler = Histogram()
+		self.decode_time = 0.0
+		self.encode_time = 0.0
+		self.response_bytes = 0
+		self.max_response_bytes = 0
+
+	def add_response(self, encode_time, size):
+		self.encode_time += encode_time
+		self.response_bytes += size
+		self.max_response_bytes = max(self.max_response_bytes, size)
+
+	def merge(self, other):
+		self.calls += other.calls
+		self.errors += other.errors
+		self.handler.merge(other.handler)
+		self.decode_time += other.decode_time
+		self.encode_time += other.encode_time
+		self.response_bytes += other.response_bytes
+		self.max_response_bytes = max(self.max_response_bytes, other.max_response_bytes)
+
+	def summary(self):
+		return {
+			'calls': self.calls,
+			'errors': self.errors,
+			'handler': self.handler.summary(),
+			'decode_time': self.decode_time,
+			'encode_time': self.encode_time,
+			'response_bytes': self.response_bytes,
+			'max_response_bytes': self.max_response_bytes
+		}
+
+class Request():
+	''' A received request, checked by Server.parse_request '''
+	def __init__(self, client, topic, command, seq, data, func, stats, trace=None):
+		self.client = client
+		self.topic = topic
+		self.command = command
+		self.seq = seq
+		self.data = data
+		self.func = func
+		self.stats = stats
+		# Trace carried by the request (see tracing.py), or None
+		self.trace = trace
+		# Responses of a deferred request once it completed, or None
+		self.job = None
+
 class Server():
 
 	def __init__(self, config, commands):
@@ -29,8 +181,43 @@ class Server():
 		self.config = config
 		self.sock = sock
 		self.commands = commands
+		# Commands provided by the server itself, for any service
+		self.builtins = {
+			'stats': self.stats,
+			'profile': self.profile
+		}
+		self.reset_stats()
+		self.profiler = None
+		self.profile_remaining = 0
+		self.profile_top = 20
+		self.profile_result = None
+		self.tracer = tracing.Tracer(config.trace, config.trace_name) if config.trace else None
+		# Worker routing requests to this process, when serving with several (see workers.py)
+		self.worker = None
+		# Deferred requests which completed, and a socket pair to wake the
+		# thread handling requests when one does
+		self.completions = collections.deque()
+		self.wakeup = socket.socketpair()
+		for wakeup in self.wakeup:
+			wakeup.setblocking(False)
+		if config.workers > 1:
+			sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
 		sock.bind((config.rx_host, config.rx_port))
 
+	def reset_stats(self):
+		self.started = time.time()
+		self.requests = 0
+		self.invalid = 0
+		self.unrecognised = 0
+		self.command_stats = dict()
+
+	def get_command_stats(self, command):
+		stats = self.command_stats.get(command)
+		if stats is None:
+			stats = CommandStats()
+			self.command_stats[command] = stats
+		return stats
+
 	def handle_request(self, timeout = None):
 		if timeout is None:
 			self.sock.settimeout(None)
@@ -38,40 +225,95 @@ class Server():
 		else:
 			deadline = time.time() + float(timeout)
 			while time.time() < deadline:
-				timeout = max(deadline - time.time(), 0)
+				# A zero timeout would make the socket non-blocking
+				timeout = max(deadline - time.time(), 0.001)
 				self.sock.settimeout(timeout)
 				if self.try_handle_request():
 					break
 
 	def try_handle_request(self):
+		packet = self.recv_packet()
+		self.complete_deferred()
+		if packet is None:
+			return False
+		self.requests += 1
+		return self.profiled(self.process_request, packet)
+
+	def recv_packet(self):
+		'''
+		Receive a request, within the socket's timeout, returns None if there
+		is none, or at once if deferred requests completed meanwhile.
+		'''
+		if self.worker is not None:
+			return self.worker.recv(self.sock.gettimeout())
+		timeout = self.sock.gettimeout()
+		if timeout != 0:
+			if self.completions:
+				timeout = 0
+			if self.sock not in select.select([self.sock, self.wakeup[0]], [], [], timeout)[0]:
+				return None
 		try:
 			packet, addr = self.sock.recvfrom(self.config.max_read_size)
-		except socket.timeout:
+		except (socket.timeout, BlockingIOError):
+			return None
+		return packet
+
+	def profiled(self, func, arg, count=True):
+		'''
+		Call func(arg), profiling it if profiling was armed by an earlier
+		request.  Calls with count set are counted as requests profiled.
+		'''
+		profiler = self.profiler
+		if profiler is None:
+			return func(arg)
+		profiler.enable()
+		try:
+			return func(arg)
+		finally:
+			profiler.disable()
+			if count:
+				self.profile_remaining -= 1
+			if self.profile_remaining <= 0:
+				self.profile_result = self.summarise_profile(profiler)
+				self.profiler = None
+
+	def process_request(self, packet):
+		request = self.parse_request(packet)
+		if request is None:
 			return False
+		for msg in self.execute(request):
+			self.send_response(msg, request.stats)
+		return True
+
+	def parse_request(self, packet):
+		''' Parse and check a request, returns a Request, or None if it was ignored or rejected '''
 		# Deserialise
+		decode_start = time.perf_counter()
 		try:
 			msg = json.loads(str(packet, "utf-8"))
 		except json.decoder.JSONDecodeError:
+			self.invalid += 1
 			if not self.config.quiet:
 				print('Invalid JSON received, ignoring')
-			return False
+			return None
+		decode_time = time.perf_counter() - decode_start
 		# Check type (request/response/?)
 		type = msg.get('type')
 		if type != 'request':
 			if not self.config.quiet:
 				print('Message receieved for a different communication type')
-			return False
+			return None
 		# Check topic
 		topic = msg.get('topic')
 		if topic != self.config.topic:
 			if not self.config.quiet:
 				print('Message receieved for a different topic, ignoring')
-			return False
+			return None
 		# Get command
 		command = msg.get('command')
 		if command is None:
 			print('Error: No command specified')
-			return False
+			return None
 		# Get sequence value
 		seq = msg.get('seq')
 		if seq is None:
@@ -83,41 +325,126 @@ class Server():
 		# Get function for handling this command
 		func = self.commands.get(command)
 		if func is None:
+			func = self.builtins.get(command)
+		if func is None:
+			self.unrecognised += 1
 			self.send_error(client, topic, command, seq, 'Unrecognised command')
-			return False
-		# Get command parameters
-		req = msg.get('data')
+			return None
+		stats = self.get_command_stats(command)
+		stats.calls += 1
+		stats.decode_time += decode_time
+		trace = tracing.get_trace(msg)
+		if trace is not None and self.tracer is not None:
+			self.tracer.hop(trace, 'receive')
+		return Request(client, topic, command, seq, msg.get('data'), func, stats, trace)
+
+	def execute(self, request):
+		'''
+		Run the handler of a request, yielding the messages to send in
+		response.  Streamed responses are produced as they are consumed.
+		'''
+		stats = request.stats
 		if not self.config.quiet:
-			print('Info: Executing command "' + command + '"')
-		# Execute
+			print('Info: Executing command "' + request.command + '"')
+		elapsed = 0.0
+		handler_start = time.perf_counter()
 		try:
-			res = func(req, client)
+			res = request.func(request.data, request.client)
+			if isinstance(res, Deferred):
+				res.future.add_done_callback(lambda future: self.defer(future, request, handler_start))
+				return
+			for item in res.items if isinstance(res, Stream) else (res,):
+				msg = self.traced(request, self.make_response(request.client, request.topic, request.command, request.seq, item))
+				elapsed += time.perf_counter() - handler_start
+				yield msg
+				handler_start = time.perf_counter()
+		except GeneratorExit:
+			raise
 		except RejectRequest as err:
-			self.send_error(client, topic, command, seq, err.message)
+			stats.handler.add(elapsed + time.perf_counter() - handler_start)
+			stats.errors += 1
+			yield self.traced(request, self.make_error(request.client, request.topic, request.command, request.seq, err.message))
 			if not self.config.quiet:
 				print(err)
-			return True
+			return
 		except BaseException as err:
-			self.send_error(client, topic, command, seq, 'Command failed')
+			stats.handler.add(elapsed + time.perf_counter() - handler_start)
+			stats.errors += 1
+			yield self.traced(request, self.make_error(request.client, request.topic, request.command, request.seq, 'Command failed'))
 			print('')
 			traceback.print_exc()
 			print('')
-			return True
-		# Respond
-		msg = {
+			return
+		stats.handler.add(elapsed + time.perf_counter() - handler_start)
+
+	def defer(self, future, request, handler_start):
+		''' Called on completion of the future of a deferred request, on any thread '''
+		self.completions.append((future, request, time.perf_counter() - handler_start))
+		try:
+			self.wakeup[1].send(b'\0')
+		except BlockingIOError:
+			# Already due to wake up
+			pass
+
+	def complete_deferred(self):
+		''' Respond to deferred requests which completed '''
+		try:
+			while self.wakeup[0].recv(0x1000):
+				pass
+		except BlockingIOError:
+			pass
+		while self.completions:
+			future, request, elapsed = self.completions.popleft()
+			self.respond(request, self.deferred_responses(future, request, elapsed))
+
+	def respond(self, request, job):
+		''' Send the responses of a deferred request (see FairServer.respond) '''
+		for msg in job:
+			self.send_response(msg, request.stats)
+
+	def deferred_responses(self, future, request, elapsed):
+		''' Yield the response to a deferred request, given the result of its future '''
+		stats = request.stats
+		stats.handler.add(elapsed)
+		err = future.exception()
+		if err is None:
+			yield self.traced(request, self.make_response(request.client, request.topic, request.command, request.seq, future.result()))
+			return
+		stats.errors += 1
+		if isinstance(err, RejectRequest):
+			yield self.traced(request, self.make_error(request.client, request.topic, request.command, request.seq, err.message))
+			if not self.config.quiet:
+				print(err)
+		else:
+			yield self.traced(request, self.make_error(request.client, request.topic, request.command, request.seq, 'Command failed'))
+			print('')
+			traceback.print_exception(type(err), err, err.__traceback__)
+			print('')
+
+	def traced(self, request, msg):
+		''' Carry the trace of a request (if any) in a message responding to it '''
+		if request.trace is None:
+			return msg
+		# Each of several responses carries its own copy
+		trace = { 'id': request.trace['id'], 'hops': list(request.trace['hops']) }
+		if self.tracer is not None:
+			self.tracer.hop(trace, 'respond')
+		msg['trace'] = trace
+		return msg
+
+	def make_response(self, client, topic, command, seq, data):
+		return {
 			'type': 'response',
 			'client': client,
 			'topic': topic,
 			'command': command,
 			'seq': seq,
-			'data': res
+			'data': data
 		}
-		self.sock.sendto(bytes(json.dumps(msg), "utf-8"), (self.config.tx_host, self.config.tx_port))
-		return True
 
-	def send_error(self, client, topic, command, seq, error):
+	def make_error(self, client, topic, command, seq, error):
 		print('Error: ' + str(error));
-		msg = {
+		return {
 			'type': 'response',
 			'client': client,
 			'topic': topic,
@@ -125,13 +452,157 @@ class Server():
 			'seq': seq,
 			'error': error
 		}
-		self.sock.sendto(bytes(json.dumps(msg), "utf-8"), (self.config.tx_host, self.config.tx_port))
+
+	def send_error(self, client, topic, command, seq, error, stats=None):
+		self.send_response(self.make_error(client, topic, command, seq, error), stats)
+
+	def notify(self, client, command, data):
+		''' Send an event to a client, which is not a response to any request '''
+		msg = {
+			'type': 'event',
+			'client': client,
+			'topic': self.config.topic,
+			'command': command,
+			'data': data
+		}
+		self.send_response(msg)
+
+	def send_response(self, msg, stats=None):
+		''' Send a message, returns its size in bytes '''
+		encode_start = time.perf_counter()
+		packet = bytes(json.dumps(msg), "utf-8")
+		encode_time = time.perf_counter() - encode_start
+		if stats is not None:
+			stats.add_response(encode_time, len(packet))
+		self.sock.sendto(packet, (self.config.tx_host, self.config.tx_port))
+		return len(packet)
+
+	def stats(self, data, client):
+		if data == 'help':
+			return {
+				'help': 'Show per-command metrics (calls, errors, handler time histogram, JSON decode/encode time, response size).  Optionally restrict to a "command", or "reset" the metrics after reading them.'
+			}
+		if not isinstance(data, dict):
+			data = {}
+		command = data.get('command')
+		if command is not None and (not isinstance(command, str) or (command not in self.commands and command not in self.builtins)):
+			raise RejectRequest('Unrecognised command')
+		if self.worker is not None:
+			return self.worker_stats(data)
+		if command is None:
+			commands = self.command_stats
+		else:
+			# Without adding stats for a command which was not called
+			commands = { key: value for key, value in self.command_stats.items() if key == command }
+		res = {
+			'uptime': time.time() - self.started,
+			'requests': self.requests,
+			'invalid': self.invalid,
+			'unrecognised': self.unrecognised,
+			'commands': { key: value.summary() for key, value in commands.items() }
+		}
+		if data.get('reset'):
+			self.reset_stats()
+		return res
+
+	def stats_state(self):
+		''' Stats of this process, to be combined with those of other workers '''
+		return {
+			'started': self.started,
+			'requests': self.requests,
+			'invalid': self.invalid,
+			'unrecognised': self.unrecognised,
+			'commands': self.command_stats
+		}
+
+	def worker_stats(self, data):
+		''' Stats of all workers, as last published by each, combined '''
+		command = data.get('command')
+		started = time.time()
+		totals = { 'requests': 0, 'invalid': 0, 'unrecognised': 0 }
+		commands = dict()
+		workers = []
+		for index, stats, pid, restarts in self.worker.collect():
+			worker = { 'worker': index, 'pid': pid, 'restarts': restarts }
+			workers.append(worker)
+			if stats is None:
+				continue
+			started = min(started, stats['started'])
+			for key in totals.keys():
+				totals[key] += stats[key]
+			for key in ('requests', 'forwarded', 'received_forwarded', 'dropped'):
+				worker[key] = stats[key]
+			for key, value in stats['commands'].items():
+				if command is None or key == command:
+					commands.setdefault(key, CommandStats()).merge(value)
+		res = {
+			'uptime': time.time() - started,
+			'requests': totals['requests'],
+			'invalid': totals['invalid'],
+			'unrecognised': totals['unrecognised'],
+			'commands': { key: value.summary() for key, value in commands.items() },
+			'workers': workers
+		}
+		if data.get('reset'):
+			self.worker.board.reset()
+			self.worker.check_reset()
+		return res
+
+	def profile(self, data, client):
+		if data == 'help':
+			return {
+				'help': 'Enable profiling for the next "requests" requests, reporting the "top" functions by cumulative time.  Without "requests", returns the result of the last profiling run.'
+			}
+		if not isinstance(data, dict):
+			data = {}
+		requests = data.get('requests')
+		if requests is None:
+			if self.profiler is not None:
+				return {
+					'state': 'running',
+					'remaining': self.profile_remaining
+				}
+			return {
+				'state': 'idle' if self.profile_result is None else 'done',
+				'result': self.profile_result
+			}
+		requests = int(requests)
+		if requests <= 0:
+			raise RejectRequest('Number of requests to profile must be positive')
+		self.profile_top = int(data.get('top', 20))
+		self.profile_remaining = requests
+		self.profile_result = None
+		self.profiler = cProfile.Profile()
+		return {
+			'state': 'running',
+			'remaining': requests
+		}
+
+	def summarise_profile(self, profiler):
+		stats = pstats.Stats(profiler).stats
+		total = sum(value[2] for value in stats.values())
+		top = sorted(stats.items(), key=lambda item: item[1][3], reverse=True)[0:self.profile_top]
+		return {
+			'total_time': total,
+			'functions': [
+				{
+					'function': os.path.basename(filename) + ':' + str(line) + '(' + name + ')',
+					'calls': nc,
+					'primitive_calls': cc,
+					'tottime': tt,
+					'cumtime': ct
+				}
+				for (filename, line, name), (cc, nc, tt, ct, callers) in top
+			]
+		}
 
 	def __enter__(self):
 		self.sock.__enter__()
 		return self
 
 	def __exit__(self, *args, **kwargs):
+		for wakeup in self.wakeup:
+			wakeup.close()
 		self.sock.__exit__(*args, **kwargs)
 		return self
 
@@ -141,7 +612,7 @@ def parse_config(cmdline, initial=None):
 		config = Config()
 	else:
 		config = initial
-	opts, args = getopt.getopt(cmdline, '', ['tx_host=', 'tx_port=', 'rx_host=', 'rx_port=', 'max_read_size=', 'topic=', 'quiet'])
+	opts, args = getopt.getopt(cmdline, '', ['tx_host=', 'tx_port=', 'rx_host=', 'rx_port=', 'max_read_size=', 'topic=', 'quiet', 'trace=', 'trace_name=', 'workers='] + config.options)
 	for opt, val in opts:
 		if opt in ('--tx_host'):
 			config.tx_host = val
@@ -157,10 +628,18 @@ def parse_config(cmdline, initial=None):
 			config.topic = val
 		elif opt in ('--quiet'):
 			config.quiet = True
-		else:
+		elif opt in ('--trace'):
+			config.trace = val
+		elif opt in ('--trace_name'):
+			config.trace_name = val
+		elif opt in ('--workers'):
+			config.workers = int(val)
+		elif not config.parse_option(opt, val):
 			raise AssertionError('Unhandled option: ' + opt)
 	if None in (config.tx_host, config.tx_port, config.rx_host, config.rx_port, config.max_read_size, config.topic, config.quiet):
 		raise AssertionError('Required parameter missing')
+	if config.workers < 1:
+		raise AssertionError('--workers must be at least 1')
 	return (config, args)
 
 def show_usage(config=Config()):
@@ -169,6 +648,9 @@ def show_usage(config=Config()):
 	print('                  --topic=' + config.topic)
 	print('                  --max_read_size=' + hex(config.max_read_size))
 	print('                  --quiet')
+	print('                  --trace=' + str(config.trace) + ' --trace_name=' + config.trace_name + '  (trace spans to a file or udp://host:port collector)')
+	print('                  --workers=' + str(config.workers) + '  (processes sharing the port, each client being served by one of them)')
+	config.show_usage()
 	print('')
 
 #################### DEMO / CLI STUFF COMES BELOW ####################
@@ -207,8 +689,16 @@ class Program():
 		self.config = config
 
 	def run(self):
+		if self.config.workers > 1:
+			workers.Supervisor(self.config.workers, self.serve).run()
+		else:
+			self.serve(None)
+
+	def serve(self, worker):
 		service = ExampleService()
 		server = Server(self.config, service.commands)
+		if worker is not None:
+			server.worker = worker.attach(server)
 		while True:
 			server.handle_request()
 
@@ -0,0 +1,284 @@
+''' Linux inotify via ctypes, with a fallback to polling. '''
+
+import os
+import json
+import time
+import struct
+import ctypes
+import ctypes.util
+
+# inotify event masks (see inotify(7))
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_NONBLOCK = os.O_NONBLOCK
+IN_CLOEXEC = os.O_CLOEXEC
+
+WATCH_MASK = IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE | IN_DELETE_SELF | IN_MOVE_SELF
+
+event_header = struct.Struct('iIII')
+
+class TooManyWatchesError(ValueError):
+	pass
+
+class Inotify():
+	''' Minimal non-blocking inotify interface '''
+
+	def __init__(self):
+		libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+		if not hasattr(libc, 'inotify_init1'):
+			raise OSError('inotify is not available')
+		self.libc = libc
+		self.fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+		if self.fd < 0:
+			raise OSError(ctypes.get_errno(), 'inotify_init1 failed')
+
+	def add(self, path, mask=WATCH_MASK):
+		wd = self.libc.inotify_add_watch(self.fd, os.fsencode(path), ctypes.c_uint32(mask))
+		if wd < 0:
+			errno = ctypes.get_errno()
+			raise OSError(errno, os.strerror(errno), path)
+		return wd
+
+	def remove(self, wd):
+		self.libc.inotify_rm_watch(self.fd, wd)
+
+	def read(self):
+		''' Return the pending events, as a list of (wd, mask, name) '''
+		events = []
+		while True:
+			try:
+				buf = os.read(self.fd, 0x10000)
+			except BlockingIOError:
+				return events
+			offset = 0
+			while offset < len(buf):
+				wd, mask, cookie, length = event_header.unpack_from(buf, offset)
+				offset += event_header.size
+				name = os.fsdecode(buf[offset:offset + length].rstrip(b'\0'))
+				offset += length
+				events.append((wd, mask, name))
+
+	def close(self):
+		os.close(self.fd)
+
+def event_kind(mask):
+	if mask & (IN_CREATE | IN_MOVED_TO):
+		return 'created'
+	if mask & (IN_DELETE | IN_MOVED_FROM | IN_DELETE_SELF | IN_MOVE_SELF):
+		return 'deleted'
+	return 'modified'
+
+def snapshot(path):
+	''' State of a directory's entries (or of a single file) for detecting changes by polling '''
+	try:
+		if os.path.isdir(path):
+			state = dict()
+			with os.scandir(path) as entries:
+				for entry in entries:
+					try:
+						stat = entry.stat(follow_symlinks=False)
+					except FileNotFoundError:
+						continue
+					state[entry.name] = (stat.st_mtime_ns, stat.st_size, stat.st_ino)
+			return state
+		stat = os.stat(path)
+		return { '': (stat.st_mtime_ns, stat.st_size, stat.st_ino) }
+	except FileNotFoundError:
+		return dict()
+
+class Watch():
+	id = None
+	client = None
+	path = None
+	wd = None
+	state = None
+	expires = None
+	next_send = 0
+	overflow = False
+	# Set once the watched path was removed, the watch ending after its last notification
+	ended = False
+
+	def __init__(self, id, client, path):
+		self.id = id
+		self.client = client
+		self.path = path
+		# Changes since the last notification, name => kind
+		self.changes = dict()
+
+	def add(self, name, kind):
+		''' Coalesce a change with earlier changes to the same name '''
+		prev = self.changes.get(name)
+		if prev == 'created' and kind == 'deleted':
+			# Came and went between notifications
+			del self.changes[name]
+		elif prev == 'created' and kind == 'modified':
+			pass
+		elif prev == 'deleted' and kind == 'created':
+			self.changes[name] = 'modified'
+		else:
+			self.changes[name] = kind
+
+class Watcher():
+	'''
+	Watches on directories or files for clients.
+
+	Changes are detected with inotify where available, otherwise by
+	comparing snapshots every poll_interval seconds.  Changes are coalesced
+	and sent at most once per interval seconds for each watch, split into
+	several notifications if they would not fit in max_size bytes once
+	encoded as JSON.  Watches expire after ttl seconds unless renewed by
+	watching the same path again, and each client may have up to
+	max_watches of them.
+	'''
+
+	def __init__(self, interval=1.0, poll_interval=2.0, ttl=600, max_changes=1000, max_size=0x8000, max_watches=64):
+		self.interval = interval
+		self.poll_interval = poll_interval
+		self.ttl = ttl
+		self.max_changes = max_changes
+		self.max_size = max_size
+		self.max_watches = max_watches
+		self.watches = dict()
+		self.by_path = dict()
+		# Number of watches of each client
+		self.counts = dict()
+		self.by_wd = dict()
+		self.next_id = 1
+		self.next_poll = 0
+		try:
+			self.inotify = Inotify()
+		except OSError:
+			self.inotify = None
+
+	def watch(self, client, path):
+		''' Watch a path for a client, or renew an existing watch, returns the watch '''
+		watch = self.by_path.get((client, path))
+		if watch is not None and watch.ended:
+			# Watched path was removed (and has been created again)
+			self._remove(watch)
+			watch = None
+		if watch is None:
+			if not os.path.exists(path):
+				raise FileNotFoundError(path)
+			if self.counts.get(client, 0) >= self.max_watches:
+				raise TooManyWatchesError('Too many watches')
+			watch = Watch(self.next_id, client, path)
+			self.next_id += 1
+			if self.inotify is not None:
+				watch.wd = self.inotify.add(path)
+				self.by_wd.setdefault(watch.wd, []).append(watch)
+			else:
+				watch.state = snapshot(path)
+			self.watches[watch.id] = watch
+			self.by_path[(client, path)] = watch
+			self.counts[client] = self.counts.get(client, 0) + 1
+		watch.expires = time.time() + self.ttl
+		return watch
+
+	def unwatch(self, client, id):
+		watch = self.watches.get(id)
+		if watch is None or watch.client != client:
+			return False
+		self._remove(watch)
+		return True
+
+	def _remove(self, watch):
+		del self.watches[watch.id]
+		del self.by_path[(watch.client, watch.path)]
+		self.counts[watch.client] -= 1
+		if not self.counts[watch.client]:
+			del self.counts[watch.client]
+		if watch.wd is not None:
+			watches = self.by_wd[watch.wd]
+			watches.remove(watch)
+			if not watches:
+				del self.by_wd[watch.wd]
+				self.inotify.remove(watch.wd)
+
+	def timeout(self):
+		''' Seconds until poll() should next be called, or None if there are no watches '''
+		if not self.watches:
+			return None
+		return self.interval if self.inotify is not None else min(self.interval, self.poll_interval)
+
+	def poll(self):
+		''' Collect changes, returns a list of (client, data) notifications which are due '''
+		now = time.time()
+		if self.inotify is not None:
+			for wd, mask, name in self.inotify.read():
+				if mask & IN_Q_OVERFLOW:
+					for watch in self.watches.values():
+						watch.overflow = True
+					continue
+				if mask & IN_IGNORED:
+					# Watched path was removed, and the kernel may reuse its
+					# descriptor for another
+					for watch in self.by_wd.pop(wd, ()):
+						watch.add(name, 'deleted')
+						watch.wd = None
+						watch.ended = True
+					continue
+				for watch in self.by_wd.get(wd, ()):
+					watch.add(name, event_kind(mask))
+					if len(watch.changes) > self.max_changes:
+						watch.changes.clear()
+						watch.overflow = True
+		elif now >= self.next_poll:
+			self.next_poll = now + self.poll_interval
+			for watch in self.watches.values():
+				state = snapshot(watch.path)
+				for name, value in state.items():
+					prev = watch.state.get(name)
+					if prev is None:
+						watch.add(name, 'created')
+					elif prev != value:
+						watch.add(name, 'modified')
+				for name in watch.state.keys() - state.keys():
+					watch.add(name, 'deleted')
+				watch.state = state
+				if len(watch.changes) > self.max_changes:
+					watch.changes.clear()
+					watch.overflow = True
+		notifications = []
+		for watch in list(self.watches.values()):
+			if watch.expires < now:
+				self._remove(watch)
+				continue
+			if (watch.changes or watch.overflow) and now >= watch.next_send:
+				notifications += [(watch.client, data) for data in self.split(watch)]
+				watch.changes = dict()
+				watch.overflow = False
+				watch.next_send = now + self.interval
+			if watch.ended and not watch.changes:
+				self._remove(watch)
+		return notifications
+
+	def split(self, watch):
+		''' Notifications of the changes to a watch, each within max_size bytes once encoded '''
+		data = {
+			'watch': watch.id,
+			'path': watch.path,
+			'changes': dict(),
+			'overflow': watch.overflow
+		}
+		size = len(json.dumps(data))
+		notifications = [data]
+		for name, kind in watch.changes.items():
+			# As encoded by json.dumps, with a separator
+			change_size = len(json.dumps(name)) + len(json.dumps(kind)) + 4
+			if data['changes'] and size + change_size > self.max_size:
+				data = dict(data, changes=dict(), overflow=False)
+				size = len(json.dumps(data))
+				notifications.append(data)
+			data['changes'][name] = kind
+			size += change_size
+		return notifications
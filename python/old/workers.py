@@ -0,0 +1,274 @@
+''' Linux only.  Several server processes sharing a port, see udp_server.py --workers. '''
+
+import os
+import re
+import mmap
+import time
+import zlib
+import pickle
+import select
+import signal
+import socket
+import struct
+import traceback
+
+# Client id of a request, found without decoding it (as serialised by json.dumps)
+client_pattern = re.compile(rb'"client": *"([^"\\]*)"')
+
+class StatsBoard():
+	'''
+	Shared memory, created before the workers are forked, in which each
+	worker publishes its stats so that any of them can report the stats of
+	all of them.  Each worker has a slot, written only by that worker, with
+	a generation number which is odd while the slot is being written, so
+	that readers can retry rather than read a torn update.  The supervisor
+	records the process id and number of restarts of each worker in its
+	slot, and a reset number is shared by all workers.
+	'''
+
+	# Reset number
+	header = struct.Struct('<Q')
+	# Generation, length of pickled stats, process id, restarts
+	slot_header = struct.Struct('<QIii')
+
+	def __init__(self, count, slot_size=0x40000):
+		self.count = count
+		self.slot_size = slot_size
+		self.map = mmap.mmap(-1, self.header.size + count * slot_size)
+
+	def offset(self, index):
+		return self.header.size + index * self.slot_size
+
+	def end_write(self, index):
+		''' Empty a slot which a worker was killed while writing, so it no longer appears in progress (its stats may be torn) '''
+		offset = self.offset(index)
+		if struct.unpack_from('<Q', self.map, offset)[0] & 1:
+			struct.pack_into('<Q', self.map, offset, 0)
+
+	def set_process(self, index, pid, restarts):
+		struct.pack_into('<ii', self.map, self.offset(index) + 12, pid, restarts)
+
+	def write(self, index, stats):
+		data = pickle.dumps(stats)
+		if self.slot_header.size + len(data) > self.slot_size:
+			# Too many commands to fit, publish the totals only
+			stats = dict(stats)
+			stats['commands'] = dict()
+			data = pickle.dumps(stats)
+		offset = self.offset(index)
+		generation = struct.unpack_from('<Q', self.map, offset)[0]
+		struct.pack_into('<Q', self.map, offset, generation + 1)
+		self.map[offset + self.slot_header.size:offset + self.slot_header.size + len(data)] = data
+		struct.pack_into('<I', self.map, offset + 8, len(data))
+		struct.pack_into('<Q', self.map, offset, generation + 2)
+
+	def read(self, index):
+		''' Stats published by a worker (or None), with its process id and restarts '''
+		offset = self.offset(index)
+		while True:
+			generation, length, pid, restarts = self.slot_header.unpack_from(self.map, offset)
+			if generation == 0:
+				return (None, pid, restarts)
+			if generation & 1:
+				time.sleep(0.0001)
+				continue
+			data = self.map[offset + self.slot_header.size:offset + self.slot_header.size + length]
+			if struct.unpack_from('<Q', self.map, offset)[0] == generation:
+				return (pickle.loads(data), pid, restarts)
+
+	def reset_number(self):
+		return self.header.unpack_from(self.map, 0)[0]
+
+	def reset(self):
+		self.header.pack_into(self.map, 0, self.reset_number() + 1)
+
+class Worker():
+	'''
+	Routes the requests received by one worker.
+
+	Workers bind the same port with SO_REUSEPORT, so the kernel spreads the
+	datagrams received between them (by source address, so datagrams from
+	one bridge all go to the same worker).  Services such as file_server
+	keep state per client, so each client belongs to one worker, found by
+	hashing its client id: requests received by other workers are
+	forwarded to its inbox (a datagram socket pair created before the
+	workers were forked, which outlives restarts of the worker).
+	'''
+
+	# Most seconds between handling a request and publishing stats
+	publish_interval = 0.5
+
+	def __init__(self, index, inboxes, board):
+		self.index = index
+		self.inboxes = inboxes
+		self.board = board
+		self.inbox = inboxes[index][0]
+		self.server = None
+		self.published = 0
+		# Counts of requests when stats were last published
+		self.published_counts = None
+		self.reset_seen = board.reset_number()
+		self.forwarded = 0
+		self.received_forwarded = 0
+		self.dropped = 0
+
+	def attach(self, server):
+		self.server = server
+		return self
+
+	def owner(self, packet):
+		''' Index of the worker whose client sent a request '''
+		match = client_pattern.search(packet)
+		if match is None:
+			return self.index
+		return zlib.crc32(match.group(1)) % len(self.inboxes)
+
+	def recv(self, timeout):
+		'''
+		Receive a request belonging to this worker, forwarding those which
+		belong to others.  Returns None if there is none within timeout
+		seconds (or at once if timeout is 0, forever if None), or once
+		deferred requests of the server have completed.
+		'''
+		max_read_size = self.server.config.max_read_size
+		sock = self.server.sock
+		deadline = None if timeout is None else time.monotonic() + timeout
+		while True:
+			self.check_reset()
+			# Forwarded requests have waited longest
+			try:
+				packet = self.inbox.recv(max_read_size, socket.MSG_DONTWAIT)
+				self.received_forwarded += 1
+				return packet
+			except BlockingIOError:
+				pass
+			while True:
+				try:
+					packet, addr = sock.recvfrom(max_read_size, socket.MSG_DONTWAIT)
+				except BlockingIOError:
+					break
+				owner = self.owner(packet)
+				if owner == self.index:
+					return packet
+				try:
+					self.inboxes[owner][1].send(packet, socket.MSG_DONTWAIT)
+					self.forwarded += 1
+				except BlockingIOError:
+					self.dropped += 1
+			wait = None if deadline is None else max(deadline - time.monotonic(), 0)
+			if wait == 0 or self.server.completions:
+				return None
+			publish = self.publish()
+			if publish is not None and (wait is None or publish < wait):
+				wait = publish
+			select.select([self.inbox, sock, self.server.wakeup[0]], [], [], wait)
+
+	def check_reset(self):
+		''' Reset this worker's stats if any worker was asked to reset them '''
+		number = self.board.reset_number()
+		if number != self.reset_seen:
+			self.reset_seen = number
+			self.server.reset_stats()
+			self.forwarded = 0
+			self.received_forwarded = 0
+			self.dropped = 0
+
+	def publish(self, force=False):
+		'''
+		Publish stats if they changed, at most every publish_interval seconds
+		unless forced, returns the seconds until they can next be published,
+		or None if they are up to date.
+		'''
+		now = time.monotonic()
+		counts = (self.server.requests, self.forwarded, self.received_forwarded, self.dropped)
+		if counts == self.published_counts and not force:
+			return None
+		if not force and now - self.published < self.publish_interval:
+			return self.publish_interval - (now - self.published)
+		self.published = now
+		self.published_counts = counts
+		stats = self.server.stats_state()
+		stats['forwarded'] = self.forwarded
+		stats['received_forwarded'] = self.received_forwarded
+		stats['dropped'] = self.dropped
+		self.board.write(self.index, stats)
+		return None
+
+	def collect(self):
+		''' Stats published by all workers, as (index, stats, process id, restarts) '''
+		self.publish(True)
+		return [(index,) + self.board.read(index) for index in range(self.board.count)]
+
+class Supervisor():
+	'''
+	Forks count worker processes, each calling run(worker) with its Worker,
+	and restarts any which exit (after a delay, doubling up to max_delay
+	seconds while workers keep exiting within a second of starting).
+	Stops the workers when interrupted or terminated.
+	'''
+
+	max_delay = 10.0
+
+	def __init__(self, count, run):
+		self.count = count
+		self.run_worker = run
+		self.inboxes = [socket.socketpair(socket.AF_UNIX, socket.SOCK_DGRAM) for index in range(count)]
+		for recv_sock, send_sock in self.inboxes:
+			# Room for bursts of forwarded requests
+			recv_sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 0x100000)
+		self.board = StatsBoard(count)
+		# Worker pids => index, and when each worker was started
+		self.pids = dict()
+		self.started = [0.0] * count
+		self.restarts = [0] * count
+		self.delay = [0.0] * count
+
+	def start(self, index):
+		self.board.end_write(index)
+		self.board.set_process(index, 0, self.restarts[index])
+		pid = os.fork()
+		if pid == 0:
+			status = 0
+			try:
+				signal.signal(signal.SIGINT, signal.SIG_DFL)
+				signal.signal(signal.SIGTERM, signal.SIG_DFL)
+				self.run_worker(Worker(index, self.inboxes, self.board))
+			except BaseException:
+				traceback.print_exc()
+				status = 1
+			finally:
+				os._exit(status)
+		self.pids[pid] = index
+		self.started[index] = time.monotonic()
+		self.board.set_process(index, pid, self.restarts[index])
+
+	def run(self):
+		def terminate(signum, frame):
+			raise KeyboardInterrupt()
+		signal.signal(signal.SIGTERM, terminate)
+		try:
+			for index in range(self.count):
+				self.start(index)
+			while True:
+				pid, status = os.wait()
+				index = self.pids.pop(pid, None)
+				if index is None:
+					continue
+				print('Worker ' + str(index) + ' (pid ' + str(pid) + ') exited with status ' + str(status) + ', restarting')
+				if time.monotonic() - self.started[index] < 1.0:
+					self.delay[index] = min(max(2 * self.delay[index], 0.1), self.max_delay)
+				else:
+					self.delay[index] = 0.0
+				time.sleep(self.delay[index])
+				self.restarts[index] += 1
+				self.start(index)
+		except KeyboardInterrupt:
+			pass
+		finally:
+			for pid in self.pids:
+				try:
+					os.kill(pid, signal.SIGTERM)
+				except ProcessLookupError:
+					pass
+			for pid in list(self.pids):
+				os.waitpid(pid, 0)
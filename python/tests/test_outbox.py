@@ -0,0 +1,114 @@
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from Outbox import Outbox, OutboxFullError, encode_record
+
+def message(remote, index):
+	return [remote, b'message', b'%d' % index]
+
+class OutboxTest(unittest.TestCase):
+
+	def setUp(self):
+		self.path = tempfile.mkdtemp()
+
+	def tearDown(self):
+		shutil.rmtree(self.path)
+
+	def open(self, **kwargs):
+		return Outbox(self.path, sync=False, **kwargs)
+
+	def segments(self):
+		return sorted(name for name in os.listdir(self.path) if name.endswith('.log'))
+
+	def test_recovers_torn_record(self):
+		outbox = self.open()
+		for index in range(3):
+			outbox.append(message(b'a', index))
+		outbox.close()
+		segment = os.path.join(self.path, self.segments()[-1])
+		size = os.path.getsize(segment)
+		# Crash part way through appending a record
+		with open(segment, 'ab') as file:
+			file.write(encode_record(4, message(b'a', 3))[:-2])
+		outbox = self.open()
+		self.assertEqual(os.path.getsize(segment), size)
+		self.assertEqual(outbox.pending(), [(seq, message(b'a', seq - 1)) for seq in (1, 2, 3)])
+		self.assertEqual(outbox.append(message(b'a', 3)), 4)
+		outbox.close()
+		outbox = self.open()
+		self.assertEqual([seq for seq, parts in outbox.pending()], [1, 2, 3, 4])
+		outbox.close()
+
+	def test_recovers_torn_header(self):
+		outbox = self.open()
+		outbox.append(message(b'a', 0))
+		outbox.close()
+		segment = os.path.join(self.path, self.segments()[-1])
+		with open(segment, 'ab') as file:
+			file.write(b'\0\0\0')
+		outbox = self.open()
+		self.assertEqual(outbox.pending(), [(1, message(b'a', 0))])
+		outbox.close()
+
+	def test_ack_deletes_segments(self):
+		outbox = self.open(segment_bytes=64)
+		for index in range(6):
+			outbox.append(message(b'a', index))
+		self.assertGreater(len(self.segments()), 1)
+		outbox.ack(b'a', 6)
+		self.assertEqual(self.segments(), [])
+		self.assertEqual(outbox.summary()['size'], 0)
+		outbox.close()
+		outbox = self.open()
+		self.assertEqual(outbox.pending(), [])
+		self.assertEqual(outbox.append(message(b'a', 6)), 7)
+		outbox.close()
+
+	def test_compaction_after_torn_record(self):
+		outbox = self.open(segment_bytes=0x100000)
+		for index in range(20):
+			outbox.append(message(b'a' if index % 4 else b'b', index))
+		outbox.close()
+		segment = os.path.join(self.path, self.segments()[-1])
+		with open(segment, 'ab') as file:
+			file.write(encode_record(21, message(b'b', 20))[:10])
+		outbox = self.open(segment_bytes=0x100000)
+		self.assertEqual(len(outbox.pending()), 20)
+		outbox.ack(b'a', 20)
+		# Delivered messages take more space than the rest, but the log is
+		# only rewritten once they exceed a segment
+		self.assertEqual(len(self.segments()), 1)
+		outbox.compact(True)
+		expected = [(seq, message(b'b', seq - 1)) for seq in range(1, 21, 4)]
+		self.assertEqual(outbox.pending(), expected)
+		self.assertEqual(outbox.summary()['size'], os.path.getsize(os.path.join(self.path, self.segments()[0])))
+		outbox.close()
+		outbox = self.open()
+		self.assertEqual(outbox.pending(), expected)
+		self.assertEqual(outbox.append(message(b'b', 20)), 21)
+		self.assertEqual(outbox.floor(b'b'), 0)
+		self.assertEqual(outbox.floor(b'a'), 21)
+		outbox.close()
+
+	def test_compaction_when_full(self):
+		record = len(encode_record(1, message(b'a', 0)))
+		outbox = self.open(max_bytes=record * 4)
+		for index in range(4):
+			outbox.append(message(b'a', index))
+		with self.assertRaises(OutboxFullError):
+			outbox.append(message(b'a', 4))
+		outbox.ack(b'a', 2)
+		self.assertEqual(outbox.append(message(b'a', 4)), 5)
+		self.assertEqual([seq for seq, parts in outbox.pending()], [3, 4, 5])
+		outbox.close()
+		outbox = self.open(max_bytes=record * 4)
+		self.assertEqual([seq for seq, parts in outbox.pending()], [3, 4, 5])
+		outbox.close()
+
+if __name__ == '__main__':
+	unittest.main()